@@ -14,6 +14,8 @@
 
 import argparse
 
+from finder_tags_butler import properties
+
 # Style constants
 COLOR_BOLD = "\033[1m"
 COLOR_GREEN = "\033[92m"
@@ -27,6 +29,7 @@ COLOR_RST = "\033[0m"  # Restore
 MSG_OK = COLOR_GREEN + "[OK]" + COLOR_RST
 MSG_ERROR = COLOR_RED + "[ERROR]" + COLOR_RST
 MSG_WARNING = COLOR_YELLOW + "[WARNING]" + COLOR_RST
+MSG_INFO = COLOR_BLUE + "[INFO]" + COLOR_RST
 
 
 def run_parser() -> dict:
@@ -37,15 +40,237 @@ def run_parser() -> dict:
         - 'dump_opt'.
         - 'hard_dump_opt'.
         - 'soft_dump_opt'.
+        - 'watch_opt'.
+        - 'merge_opt'.
+        - 'query_opt'.
 
-    :return: A dict '{"path": args.path, "option": opt}'.
+    :return: A dict with the selected 'option' and the rest of the arguments
+        by their 'dest' names, see the definitions below.
     """
     parser = argparse.ArgumentParser(
         description="Finder Tags Butler",
         epilog="Synchronize Mac OS Finder tags between several machines.",
     )
     parser.add_argument(
-        "path", metavar="PATH", type=str, nargs=1, help="The directory where work...",
+        "paths",
+        metavar="PATH",
+        type=str,
+        nargs="*",
+        help="The directory where work... Several ones can be passed to "
+        "process all of them in a single run.",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        dest="config",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="A YAML file with the directories to process, with their own "
+        "options. See the 'logic_batch' module.",
+    )
+    parser.add_argument(
+        "-P",
+        "--parallel",
+        dest="parallel",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Processes up to N directories at the same time, sharing the "
+        f"workers. By default, {properties.BATCH_PARALLEL_NODES}.",
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        dest="backend",
+        choices=["tag", "xattr", "memory"],
+        default=None,
+        help="The tag backend to use: the 'tag' command line tool, direct "
+        "extended attributes access or a fake in-memory one, for tests. By "
+        "default, 'tag' on Mac OS.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help="Ignores the stat cache and reads the tags of all the paths when "
+        "saving a manifest.",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Shows the tag changes that a dump or a merge would do, without "
+        "doing them.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Walks the directory and reads the tags with N concurrent workers.",
+    )
+    parser.add_argument(
+        "--processes",
+        dest="processes",
+        action="store_true",
+        help="Reads the tags with worker processes instead of threads. Only "
+        "used by the 'tag' backend.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Dumps through a pipeline, whose stages check the paths, read "
+        "their tags and write the changed ones at the same time, each one with "
+        "N concurrent jobs.",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Gives up the tag operations of a dump that last more than this "
+        "time, reporting their paths as errors. Uses the pipeline.",
+    )
+    parser.add_argument(
+        "--retries",
+        dest="retries",
+        metavar="N",
+        type=int,
+        default=properties.TAG_RETRIES,
+        help="Retries up to N times, with a growing wait, the tag operations "
+        "of a dump failed by a busy file or an I/O error.",
+    )
+    parser.add_argument(
+        "--rate",
+        dest="rate",
+        metavar="N",
+        type=float,
+        default=None,
+        help="Reads and writes the tags of N paths per second at most, to not "
+        "overload the file provider.",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        dest="retry_failed",
+        action="store_true",
+        help="Dumps only the paths that the last dump could not apply.",
+    )
+    parser.add_argument(
+        "--failure-report",
+        dest="failure_report",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="Writes the paths that a dump could not apply to a JSON file.",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="manifest_format",
+        choices=properties.MANIFEST_FORMATS,
+        default=None,
+        help="The format of the saved manifest: a YAML stream (default) or a "
+        "compact binary file. Dumps detect it automatically.",
+    )
+    parser.add_argument(
+        "-z",
+        "--compression",
+        dest="compression",
+        choices=properties.MANIFEST_COMPRESSIONS,
+        default=None,
+        help="Compresses the saved manifest. Only for the binary format.",
+    )
+    parser.add_argument(
+        "--identity",
+        dest="identity",
+        action="store_true",
+        help="Saves also the fingerprints of the tagged files, so the dumps "
+        "can follow the files moved inside the directory.",
+    )
+    parser.add_argument(
+        "--shards",
+        dest="shards",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Splits the saved manifest in N files by top level entry, so "
+        "only the changed ones are rewritten and dumped again.",
+    )
+    parser.add_argument(
+        "--only",
+        dest="only",
+        metavar="SUBPATH",
+        type=str,
+        action="append",
+        default=None,
+        help="Dumps only the tags under this path, relative to the directory. "
+        "Accepts shell wildcards, like 'Projects/*/docs', and can be repeated. "
+        "Only the matching part of the manifest is read.",
+    )
+    parser.add_argument(
+        "--max-depth",
+        dest="max_depth",
+        metavar="N",
+        type=int,
+        default=None,
+        help="Walks only the paths up to N levels below the directory, 1 for "
+        "its direct children.",
+    )
+    parser.add_argument(
+        "--follow-symlinks",
+        dest="follow_symlinks",
+        action="store_true",
+        help="Walks also the symbolic links to directories, unless they point "
+        f"to one of their parents. The paths matching the patterns of a "
+        f"'{properties.IGNORE_FILE_NAME}' file in the directory are never "
+        "walked.",
+    )
+    parser.add_argument(
+        "--debounce",
+        dest="debounce",
+        metavar="SECONDS",
+        type=float,
+        default=properties.WATCH_DEBOUNCE,
+        help="In watch mode, waits this time without changes before reading "
+        "the changed paths.",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        dest="flush_interval",
+        metavar="SECONDS",
+        type=float,
+        default=properties.WATCH_FLUSH_INTERVAL,
+        help="In watch mode, writes the changed manifest at most once in this time.",
+    )
+    parser.add_argument(
+        "--poll",
+        dest="polling",
+        action="store_true",
+        help="In watch mode, walks the directory at regular intervals instead "
+        "of using the file system notifications.",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        help="Prints the time of every phase, the paths and tags processed, "
+        "the backend calls latency, the manifest bytes and the peak memory.",
+    )
+    parser.add_argument(
+        "--stats-json",
+        dest="stats_json",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="Writes the same data of '--stats' to a JSON file.",
     )
     options = parser.add_mutually_exclusive_group(required=True)
     options.add_argument(
@@ -83,9 +308,94 @@ def run_parser() -> dict:
         "directory, removing all the tags of the 'path' "
         "directory and children that are not in the manifest.",
     )
+    options.add_argument(
+        "-w",
+        "--watch",
+        dest="watch_opt",
+        action="store_true",
+        help="Saves the tags of the 'path' directory to a manifest and keeps "
+        "it up to date while the directory changes, until interrupted.",
+    )
+    options.add_argument(
+        "-m",
+        "--merge",
+        dest="merge_opt",
+        action="store_true",
+        help="Merges the tags of the 'path' directory and its manifest, "
+        "keeping the changes made on every machine since the last merge, and "
+        "writes the result to both.",
+    )
+    options.add_argument(
+        "-q",
+        "--query",
+        dest="query",
+        metavar="QUERY",
+        type=str,
+        default=None,
+        help="Prints the paths of the manifest of the 'path' directory with "
+        "the tags asked for, like 'Red AND (Work OR Proj*) AND NOT Old'. Quote "
+        "the tags with spaces.",
+    )
 
     # Parse
     args = parser.parse_args()
+    if not args.paths and not args.config:
+        parser.error("at least a PATH or a config file is needed")
+    if args.watch_opt and (len(args.paths) != 1 or args.config):
+        parser.error("the watch mode only accepts a single PATH")
+    if args.query is not None and (len(args.paths) != 1 or args.config):
+        parser.error("the query mode only accepts a single PATH")
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("the number of parallel directories must be a positive integer")
+    if args.jobs < 1:
+        parser.error("the number of jobs must be a positive integer")
+    if args.pipeline is not None and args.pipeline < 1:
+        parser.error("the number of pipeline jobs must be a positive integer")
+    if args.timeout is not None and args.timeout <= 0:
+        parser.error("the timeout must be a positive number of seconds")
+    if (args.pipeline or args.timeout) and not (
+        args.dump_opt or args.soft_dump_opt or args.hard_dump_opt
+    ):
+        parser.error("the '--pipeline' and '--timeout' options are only for the dumps")
+    if args.retries < 0:
+        parser.error("the number of retries can not be negative")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("the rate must be a positive number of paths per second")
+    if (args.retry_failed or args.failure_report) and not (
+        args.dump_opt or args.soft_dump_opt or args.hard_dump_opt
+    ):
+        parser.error(
+            "the '--retry-failed' and '--failure-report' options are only for "
+            "the dumps"
+        )
+    if args.failure_report and (len(args.paths) != 1 or args.config):
+        parser.error("the '--failure-report' option only accepts a single PATH")
+    if args.failure_report and args.dry_run:
+        parser.error("'--failure-report' can not be used with a dry run")
+    if args.dry_run and not (
+        args.dump_opt or args.soft_dump_opt or args.hard_dump_opt or args.merge_opt
+    ):
+        parser.error("the dry run is only for the dumps and the merges")
+    if args.retry_failed and (args.only or args.dry_run):
+        parser.error("'--retry-failed' can not be used with '--only' or a dry run")
+    if args.shards is not None and args.shards < 1:
+        parser.error("the number of shards must be a positive integer")
+    if args.max_depth is not None and args.max_depth < 1:
+        parser.error("the maximum depth must be a positive integer")
+    if args.compression and args.manifest_format != "binary":
+        parser.error("only binary manifests can be compressed")
+    if args.only and not (args.dump_opt or args.soft_dump_opt or args.hard_dump_opt):
+        parser.error("the '--only' option is only for the dumps")
+    if args.only:
+        from finder_tags_butler.logic_subpaths import check_pattern
+
+    for pattern in args.only or ():
+        try:
+            check_pattern(pattern)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.debounce < 0 or args.flush_interval < 0:
+        parser.error("the watch mode intervals can not be negative")
 
     # Catch the selected option
     if args.save_opt:
@@ -96,10 +406,45 @@ def run_parser() -> dict:
         opt = "soft_dump_opt"
     elif args.hard_dump_opt:
         opt = "hard_dump_opt"
+    elif args.watch_opt:
+        opt = "watch_opt"
+    elif args.merge_opt:
+        opt = "merge_opt"
+    elif args.query is not None:
+        opt = "query_opt"
 
     # Return the full user input order
     # noinspection PyUnboundLocalVariable
-    return {"path": args.path[0], "option": opt}
+    return {
+        "paths": args.paths,
+        "config": args.config,
+        "parallel": args.parallel,
+        "option": opt,
+        "backend": args.backend,
+        "use_cache": args.use_cache,
+        "dry_run": args.dry_run,
+        "jobs": args.jobs,
+        "processes": args.processes,
+        "pipeline": args.pipeline,
+        "timeout": args.timeout,
+        "retries": args.retries,
+        "rate": args.rate,
+        "retry_failed": args.retry_failed,
+        "failure_report": args.failure_report,
+        "manifest_format": args.manifest_format,
+        "compression": args.compression,
+        "identity": args.identity,
+        "shards": args.shards,
+        "only": args.only,
+        "max_depth": args.max_depth,
+        "follow_symlinks": args.follow_symlinks,
+        "debounce": args.debounce,
+        "flush_interval": args.flush_interval,
+        "polling": args.polling,
+        "stats": args.stats,
+        "stats_json": args.stats_json,
+        "query": args.query,
+    }
 
 
 def print_ok(msg_text: str) -> None:
@@ -110,6 +455,22 @@ def print_ok(msg_text: str) -> None:
     print(f"{MSG_OK}: {msg_text}")
 
 
+def print_info(msg_text: str) -> None:
+    """Print the input message with the proper information formatting.
+
+    :param msg_text: The message content text.
+    """
+    print(f"{MSG_INFO}: {msg_text}")
+
+
+def print_warning(msg_text: str) -> None:
+    """Print the input message with the proper warning formatting.
+
+    :param msg_text: The message content text.
+    """
+    print(f"{MSG_WARNING}: {msg_text}")
+
+
 def print_error(error: Exception) -> None:
     """Print the input error with the proper error formatting.
 
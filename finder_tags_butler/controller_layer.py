@@ -12,64 +12,381 @@
 
 """Finder Tags Butler core controller module."""
 
+import os
 import sys
+from typing import TYPE_CHECKING
 
-from finder_tags_butler.cli_layer import run_parser, print_error, print_ok
-from finder_tags_butler.errors import CorruptedManifestFileError
-from finder_tags_butler.logic_layer import *
-from finder_tags_butler.properties import MANIFEST_FILE_NAME
+from finder_tags_butler.cli_layer import (
+    run_parser,
+    print_error,
+    print_ok,
+    print_info,
+    print_warning,
+)
+from finder_tags_butler.errors import (
+    CorruptedManifestFileError,
+    InvalidBatchConfigFileError,
+    InvalidTagQueryError,
+)
+from finder_tags_butler.properties import BATCH_PARALLEL_NODES, MANIFEST_FILE_NAME
+
+if TYPE_CHECKING:
+    from finder_tags_butler.logic_backends import TagChange
+    from finder_tags_butler.logic_pipeline import PipelineOptions
+    from finder_tags_butler.logic_retry import TagOperationExecutor
+    from finder_tags_butler.logic_workers import WorkerPool
+
+# The logic modules are imported by the options that use them, after parsing
+# the user input, so a run does not pay for the ones it does not need
 
 
 def main():
     # First, run the parser
-    path, opt = run_parser().values()
+    user_input = run_parser()
+    opt = user_input["option"]
+
+    # Select the tag backend, if the user has asked for a specific one
+    if user_input["backend"]:
+        from finder_tags_butler.logic_backends import set_backend
+
+        set_backend(user_input["backend"])
+
+    # Collect the instrumentation data, if asked for
+    if user_input["stats"] or user_input["stats_json"]:
+        from finder_tags_butler.logic_stats import Stats, set_stats
+
+        set_stats(Stats())
+
+    # Prepare the concurrent workers, if asked for
+    workers = None
+    if user_input["jobs"] > 1:
+        from finder_tags_butler.logic_workers import WorkerPool
+
+        workers = WorkerPool(user_input["jobs"], processes=user_input["processes"])
+
+    # Dump through a pipeline, if asked for
+    pipeline = None
+    if user_input["pipeline"] or user_input["timeout"]:
+        from finder_tags_butler.logic_pipeline import PipelineOptions
+
+        jobs = user_input["pipeline"] or 1
+        pipeline = PipelineOptions(jobs, jobs, jobs, timeout=user_input["timeout"])
+
+    # Several directories are processed in a single batch
+    if len(user_input["paths"]) != 1 or user_input["config"]:
+        order_batch(user_input, workers, pipeline, order_executor_building(user_input))
 
     # Calculate paths
+    path = user_input["paths"][0]
     if not os.path.isdir(path):
         order_error_printing_and_exit(NotADirectoryError(path))
     manifest_path = os.path.join(path, MANIFEST_FILE_NAME)
 
     # Interpret the option selected by the user
     if opt == "save_opt":
-        save_manifest(path=path, manifest_path=manifest_path)
+        from finder_tags_butler.logic_layer import save_manifest
+
+        save_manifest(
+            path=path,
+            manifest_path=manifest_path,
+            use_cache=user_input["use_cache"],
+            workers=workers,
+            manifest_format=user_input["manifest_format"],
+            compression=user_input["compression"],
+            identity=user_input["identity"],
+            shards=user_input["shards"],
+            max_depth=user_input["max_depth"],
+            follow_symlinks=user_input["follow_symlinks"],
+        )
         # If the process finish well...
+        order_stats_reporting(user_input["stats"], user_input["stats_json"])
+        order_ok_printing_and_exit(f"The manifest of '{path}' has been " f"saved. 💾")
+    elif opt == "watch_opt":
+        from finder_tags_butler.logic_ignore import WalkRules
+        from finder_tags_butler.logic_watch import ManifestWatcher, open_event_source
+
+        watcher = ManifestWatcher(
+            path=path,
+            manifest_path=manifest_path,
+            events=open_event_source(
+                path,
+                workers,
+                polling=user_input["polling"],
+                rules=WalkRules.load(
+                    path, user_input["max_depth"], user_input["follow_symlinks"]
+                ),
+            ),
+            debounce=user_input["debounce"],
+            flush_interval=user_input["flush_interval"],
+            use_cache=user_input["use_cache"],
+            workers=workers,
+            manifest_format=user_input["manifest_format"],
+            compression=user_input["compression"],
+            identity=user_input["identity"],
+            shards=user_input["shards"],
+            max_depth=user_input["max_depth"],
+            follow_symlinks=user_input["follow_symlinks"],
+        )
+        # Stop cleanly also when the daemon is terminated
+        import signal
+
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        print_info(f"Watching '{path}'. Press Ctrl+C to stop.")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        order_stats_reporting(user_input["stats"], user_input["stats_json"])
         order_ok_printing_and_exit(f"The manifest of '{path}' has been " f"saved. 💾")
+    elif opt == "merge_opt":
+        from finder_tags_butler.logic_merge import merge_manifest
+
+        try:
+            report = merge_manifest(
+                manifest_path=manifest_path,
+                path=path,
+                use_cache=user_input["use_cache"],
+                dry_run=user_input["dry_run"],
+                workers=workers,
+                manifest_format=user_input["manifest_format"],
+                compression=user_input["compression"],
+                shards=user_input["shards"],
+                max_depth=user_input["max_depth"],
+                follow_symlinks=user_input["follow_symlinks"],
+            )
+        except CorruptedManifestFileError as e:
+            order_error_printing_and_exit(e)
+
+        # noinspection PyUnboundLocalVariable
+        for conflict in report.conflicts:
+            print_warning(str(conflict))
+        for tag_error in report.errors:
+            order_error_printing_without_exit(tag_error)
+
+        order_stats_reporting(user_input["stats"], user_input["stats_json"])
+        if user_input["dry_run"]:
+            order_plan_printing(report.changes)
+            order_ok_printing_and_exit(
+                f"The manifest of '{path}' has not been merged (dry run). 🔍"
+            )
+        order_ok_printing_and_exit(f"The manifest of '{path}' has been merged. 🔀")
+    elif opt == "query_opt":
+        # Check manifest existence
+        if not os.path.isfile(manifest_path):
+            order_error_printing_and_exit(FileNotFoundError(manifest_path))
+
+        from finder_tags_butler.logic_query import query_manifest
+
+        try:
+            matches = query_manifest(manifest_path, path, user_input["query"])
+        except (CorruptedManifestFileError, InvalidTagQueryError) as e:
+            order_error_printing_and_exit(e)
+
+        # noinspection PyUnboundLocalVariable
+        for match in matches:
+            print(match)
+        order_stats_reporting(user_input["stats"], user_input["stats_json"])
+        order_ok_printing_and_exit(
+            f"{len(matches)} paths of '{path}' match the query. 🔎"
+        )
     else:
         # Check manifest existence
         if not os.path.isfile(manifest_path):
             order_error_printing_and_exit(FileNotFoundError(manifest_path))
 
+        if opt == "dump_opt":
+            force_overwriting = None
+        elif opt == "soft_dump_opt":
+            force_overwriting = False
+        elif opt == "hard_dump_opt":
+            force_overwriting = True
+        else:  # If the parser is updated with this if-block, this won't occur
+            raise NotImplementedError
+
+        from finder_tags_butler.logic_layer import dump_manifest, plan_dump
+        from finder_tags_butler.logic_retry import FailureReport
+
         try:
-            if opt == "dump_opt":
-                tagging_errors = dump_manifest(
-                    manifest_path=manifest_path, path=path, force_overwriting=None
+            if user_input["dry_run"]:
+                changes, tagging_errors = plan_dump(
+                    manifest_path=manifest_path,
+                    path=path,
+                    force_overwriting=force_overwriting,
+                    workers=workers,
+                    only=user_input["only"],
+                    max_depth=user_input["max_depth"],
+                    follow_symlinks=user_input["follow_symlinks"],
                 )
-            elif opt == "soft_dump_opt":
+            else:
                 tagging_errors = dump_manifest(
-                    manifest_path=manifest_path, path=path, force_overwriting=False
+                    manifest_path=manifest_path,
+                    path=path,
+                    force_overwriting=force_overwriting,
+                    workers=workers,
+                    only=user_input["only"],
+                    max_depth=user_input["max_depth"],
+                    follow_symlinks=user_input["follow_symlinks"],
+                    pipeline=pipeline,
+                    executor=order_executor_building(user_input),
+                    retry_failed=user_input["retry_failed"],
                 )
-            elif opt == "hard_dump_opt":
-                tagging_errors = dump_manifest(
-                    manifest_path=manifest_path, path=path, force_overwriting=True
-                )
-            else:  # If the parser is updated with this if-block, this won't occur
-                raise NotImplementedError
         except CorruptedManifestFileError as e:
             order_error_printing_and_exit(e)
 
+        # Write the failures, if asked for
+        if user_input["failure_report"]:
+            report = FailureReport(
+                os.path.abspath(path), os.path.abspath(manifest_path)
+            )
+            # noinspection PyUnboundLocalVariable
+            report.add(tagging_errors)
+            report.save(user_input["failure_report"])
+
         # noinspection PyUnboundLocalVariable
         for tag_error in tagging_errors:
             order_error_printing_without_exit(tag_error)
+
+        order_stats_reporting(user_input["stats"], user_input["stats_json"])
+        if user_input["dry_run"]:
+            # noinspection PyUnboundLocalVariable
+            order_plan_printing(changes)
+            order_ok_printing_and_exit(
+                f"The manifest of '{path}' has not been dumped (dry run). 🔍"
+            )
         # If the process finish well...
         order_ok_printing_and_exit(f"The manifest of '{path}' has been dumped. 🏷")
 
 
+def order_batch(
+    user_input: dict,
+    workers: "WorkerPool",
+    pipeline: "PipelineOptions" = None,
+    executor: "TagOperationExecutor" = None,
+) -> None:
+    """Process all the directories of the user input and exit.
+
+    :param user_input: The dict returned by 'run_parser'.
+    :param workers: The pool shared by all the directories, or 'None'.
+    :param pipeline: The configuration of the dump pipelines, or 'None'.
+    :param executor: The executor of the tag operations shared by all the
+        dumps, or 'None'.
+    """
+    from finder_tags_butler.logic_batch import (
+        NodeTask,
+        check_tasks,
+        describe_result,
+        load_batch_config,
+        run_batch,
+    )
+
+    defaults = {
+        "option": user_input["option"],
+        "use_cache": user_input["use_cache"],
+        "dry_run": user_input["dry_run"],
+        "manifest_format": user_input["manifest_format"],
+        "compression": user_input["compression"],
+        "identity": user_input["identity"],
+        "shards": user_input["shards"],
+        "only": user_input["only"],
+        "max_depth": user_input["max_depth"],
+        "follow_symlinks": user_input["follow_symlinks"],
+        "retry_failed": user_input["retry_failed"],
+    }
+    tasks = [NodeTask(p, **defaults) for p in user_input["paths"]]
+    parallel = user_input["parallel"]
+    if user_input["config"]:
+        try:
+            config_tasks, config_parallel = load_batch_config(
+                user_input["config"], defaults
+            )
+        except InvalidBatchConfigFileError as e:
+            order_error_printing_and_exit(e)
+        # noinspection PyUnboundLocalVariable
+        tasks.extend(config_tasks)
+        if parallel is None:
+            parallel = config_parallel
+    try:
+        check_tasks(tasks)
+    except ValueError as e:
+        order_error_printing_and_exit(e)
+    if parallel is None:
+        parallel = BATCH_PARALLEL_NODES
+
+    results = run_batch(tasks, workers, parallel, pipeline, executor)
+
+    # Print a single summary of all the directories
+    for result in results:
+        for tag_error in result.tagging_errors:
+            order_error_printing_without_exit(tag_error)
+        if result.changes:
+            order_plan_printing(result.changes)
+    order_stats_reporting(user_input["stats"], user_input["stats_json"])
+    for result in results:
+        if result.ok:
+            print_ok(describe_result(result))
+        else:
+            print_error(describe_result(result))
+    failed = sum(1 for r in results if not r.ok)
+    if failed:
+        order_error_printing_and_exit(
+            RuntimeError(f"{failed} of {len(results)} directories have failed.")
+        )
+    order_ok_printing_and_exit(f"{len(results)} directories have been processed. 📚")
+
+
+def order_executor_building(user_input: dict) -> "TagOperationExecutor":
+    """Build the executor of the tag operations of the dumps, that retries
+    the failed ones and shares a single rate limit.
+
+    :param user_input: The dict returned by 'run_parser'.
+    :return: The executor.
+    """
+    from finder_tags_butler.logic_retry import RateLimiter, TagOperationExecutor
+
+    limiter = None
+    if user_input["rate"]:
+        limiter = RateLimiter(user_input["rate"])
+    return TagOperationExecutor(user_input["retries"], limiter=limiter)
+
+
 def order_ok_printing_and_exit(msg_text: str) -> None:
     """:param msg_text: The message text to print."""
     print_ok(msg_text)
     sys.exit(0)
 
 
+def order_stats_reporting(print_stats: bool, stats_json: str) -> None:
+    """
+    :param print_stats: If the instrumentation data should be printed.
+    :param stats_json: The path of a file to write it as JSON, or 'None'.
+    """
+    from finder_tags_butler.logic_stats import format_summary, get_stats
+
+    stats = get_stats()
+    if stats is None:
+        return
+    data = stats.summary()
+    if print_stats:
+        for line in format_summary(data):
+            print_info(line)
+    if stats_json:
+        import json
+
+        with open(stats_json, "w") as outfile:
+            json.dump(data, outfile, indent=2)
+
+
+def order_plan_printing(changes: ["TagChange"]) -> None:
+    """:param changes: The planned tag changes to print."""
+    from finder_tags_butler.logic_reconcile import count_changes
+
+    for change in changes:
+        signed_tags = [f"+{t}" for t in change.add] + [f"-{t}" for t in change.remove]
+        print_info(f"{change.path}: {', '.join(signed_tags)}")
+    paths, added, removed = count_changes(changes)
+    print_info(f"{paths} paths to change, {added} tags to add, {removed} to remove.")
+
+
 def order_error_printing_without_exit(error: Exception) -> None:
     """:param error: The error to print."""
     print_error(error)
@@ -79,3 +396,8 @@ def order_error_printing_and_exit(error: Exception) -> None:
     """:param error: The error to print."""
     print_error(error)
     sys.exit(1)
+
+
+def _raise_keyboard_interrupt(*args) -> None:
+    """Signal handler to stop the watch mode as with Ctrl+C."""
+    raise KeyboardInterrupt
@@ -15,17 +15,133 @@
 
 
 class CorruptedManifestFileError(Exception):
-    def __init__(self, *args):
+    def __init__(self, *args, reason: str = None, line: int = None, column: int = None):
+        """The optional 'reason', 'line' and 'column' locate the first bad
+        entry of the manifest file."""
         if args:
             self.path = args[0]
         else:
             self.path = None
+        self.reason = reason
+        self.line = line
+        self.column = column
 
     def __str__(self):
         if self.path:
             return (
                 f"Tha manifest file '{self.path}' is corrupted and can "
-                f"not be used by this program."
+                f"not be used by this program{self._location()}."
             )
         else:
             return "'CorruptedManifestFileError' has been raised."
+
+    def _location(self) -> str:
+        location = ""
+        if self.reason:
+            location += f": {self.reason}"
+        if self.line is not None:
+            location += f" (line {self.line}"
+            if self.column is not None:
+                location += f", column {self.column}"
+            location += ")"
+        return location
+
+
+class InvalidBatchConfigFileError(Exception):
+    def __init__(self, *args, reason: str = None):
+        """The optional 'reason' tells what is wrong in the batch config
+        file."""
+        if args:
+            self.path = args[0]
+        else:
+            self.path = None
+        self.reason = reason
+
+    def __str__(self):
+        if self.path:
+            reason = f": {self.reason}" if self.reason else ""
+            return f"The batch config file '{self.path}' is not valid{reason}."
+        else:
+            return "'InvalidBatchConfigFileError' has been raised."
+
+
+class InvalidTagQueryError(Exception):
+    def __init__(self, *args, reason: str = None, column: int = None):
+        """The optional 'reason' and 'column' locate the error in the query."""
+        if args:
+            self.query = args[0]
+        else:
+            self.query = None
+        self.reason = reason
+        self.column = column
+
+    def __str__(self):
+        if self.query is not None:
+            reason = f": {self.reason}" if self.reason else ""
+            if self.column is not None:
+                reason += f" (column {self.column})"
+            return f"The tag query '{self.query}' is not valid{reason}."
+        else:
+            return "'InvalidTagQueryError' has been raised."
+
+
+class TagOperationTimeoutError(TimeoutError):
+    def __init__(self, *args, operation: str = None, timeout: float = None):
+        """The optional 'operation' tells what was being done with the tags
+        of the path and 'timeout' the seconds waited for it."""
+        super().__init__(*args)
+        if args:
+            self.path = args[0]
+        else:
+            self.path = None
+        self.operation = operation
+        self.timeout = timeout
+
+    def __str__(self):
+        if self.path:
+            operation = self.operation or "processing"
+            timeout = f" in {self.timeout} seconds" if self.timeout else ""
+            return (
+                f"The tags of '{self.path}' have timed out{timeout} while "
+                f"{operation} them."
+            )
+        else:
+            return "'TagOperationTimeoutError' has been raised."
+
+
+class TagOperationError(Exception):
+    def __init__(
+        self,
+        *args,
+        operation: str = None,
+        kind: str = None,
+        cause: Exception = None,
+        paths: list = None,
+    ):
+        """The optional 'operation' tells what was being done with the tags
+        of the path, 'kind' the class of the failure, see
+        'logic_retry.classify_error', 'cause' the original error and 'paths'
+        the paths of an operation over several ones."""
+        super().__init__(*args)
+        if args:
+            self.path = args[0]
+        else:
+            self.path = None
+        self.operation = operation
+        self.kind = kind
+        self.cause = cause
+        self.paths = paths
+
+    def __str__(self):
+        operation = self.operation or "processing"
+        cause = f": {self.cause}" if self.cause is not None else ""
+        kind = f" ({self.kind})" if self.kind else ""
+        if self.path:
+            return f"Failed {operation} the tags of '{self.path}'{cause}{kind}."
+        elif self.paths:
+            return (
+                f"Failed {operation} the tags of {len(self.paths)} paths, from "
+                f"'{self.paths[0]}'{cause}{kind}."
+            )
+        else:
+            return "'TagOperationError' has been raised."
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Tag backends.
+
+A tag backend is the piece that really reads and writes the Finder tags of
+the files and folders. All of them offer bulk operations, so the upper layers
+can process thousands of paths without paying a fixed cost per path:
+
+    - 'TagBackend.get_many(paths)' returns the tags of every path.
+    - 'TagBackend.apply_many(changes)' applies a list of 'TagChange'.
+
+Available backends are:
+    - 'tag': uses the 'tag' command line tool through 'mac_tag', passing
+        chunks of paths to every call instead of one path per call.
+    - 'xattr': reads and writes the 'com.apple.metadata:_kMDItemUserTags'
+        extended attribute in process. On Linux the attribute is stored under
+        the 'user.' namespace.
+    - 'memory': a fake in-memory backend, useful for tests.
+"""
+
+import errno
+import os
+import sys
+from functools import partial
+from typing import Dict, Iterable, List, Union
+
+from finder_tags_butler import properties
+from finder_tags_butler.errors import TagOperationError
+
+# Marker to remove all the present tags of a path, see 'TagChange'
+ALL_TAGS = "*"
+
+# Errors of a missing extended attribute: 'ENODATA' on Linux and 'ENOATTR' on
+# Mac OS. The rest are real errors, that can be transient
+_NO_ATTRIBUTE_ERRNOS = frozenset(
+    getattr(errno, name) for name in ("ENODATA", "ENOATTR") if hasattr(errno, name)
+)
+
+
+class TagChange:
+    """Abstraction of the tags to add to and to remove from a path."""
+
+    def __init__(
+        self,
+        path: str,
+        add: Union[List[str], None] = None,
+        remove: Union[List[str], str, None] = None,
+    ):
+        """Pass 'remove' as 'ALL_TAGS' to remove all the present tags of the
+        path before adding the 'add' ones."""
+        self.path = path
+        self.add = add if add is not None else []
+        self.remove = remove if remove is not None else []
+
+    def __repr__(self):
+        return f"TagChange({self.path!r}, add={self.add!r}, remove={self.remove!r})"
+
+
+class TagBackend:
+    """Base class of the tag backends."""
+
+    name = None
+
+    def get_many(self, paths: Iterable[str]) -> Dict[str, List[str]]:
+        """Return the Finder tags of several files or folders.
+
+        :param paths: The paths of the files or folders to examine.
+        :raise FileNotFoundError: If some path does not point to anything
+            reachable.
+        :return: A dict with the list of tag names of every path.
+        """
+        raise NotImplementedError
+
+    def apply_many(self, changes: Iterable[TagChange]) -> [Exception]:
+        """Apply several tag changes.
+
+        A change over a path that does not exist does not stop the process.
+
+        :param changes: The 'TagChange' list to apply.
+        :return: A list of errors of the changes that have not been applied.
+        """
+        raise NotImplementedError
+
+    def _resolve_changes(self, changes: Iterable[TagChange]):
+        """Discard unreachable paths and resolve the 'ALL_TAGS' removals.
+
+        :return: A tuple with the list of '(path, tags_to_add, tags_to_remove)'
+            to apply and the list of errors.
+        """
+        errors = []
+        valid = []
+        for change in changes:
+            if not os.path.lexists(change.path):
+                errors.append(FileNotFoundError(change.path))
+            else:
+                valid.append(change)
+
+        # Read all the current tags needed by the 'ALL_TAGS' removals at once
+        current = self.get_many([c.path for c in valid if c.remove == ALL_TAGS])
+
+        resolved = []
+        for change in valid:
+            remove = change.remove
+            if remove == ALL_TAGS:
+                remove = current[change.path]
+            add = [t for t in change.add if t]
+            if len(add) != len(change.add):
+                raise ValueError("Null tags are not valid")
+            # Tags that are removed and added again are kept untouched
+            remove = [t for t in remove if t not in add]
+            resolved.append((change.path, add, remove))
+        return resolved, errors
+
+
+class MacTagBackend(TagBackend):
+    """Backend over the 'tag' command line tool.
+
+    'mac_tag' accepts lists of paths, so every call processes a chunk of paths
+    instead of starting a new process per path and tag.
+    """
+
+    name = "tag"
+
+    def __init__(self, chunk_size: int = properties.TAG_BACKEND_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def get_many(self, paths: Iterable[str]) -> Dict[str, List[str]]:
+        import mac_tag
+
+        tags = {}
+        for chunk in _chunks(list(paths), self.chunk_size):
+            try:
+                res = mac_tag.get(chunk)
+            except FileNotFoundError:
+                res = None  # Locate the unreachable path one by one
+
+            if res is not None and all(path in res for path in chunk):
+                for path in chunk:
+                    tags[path] = list(res[path])
+            else:
+                # The keys returned by the tool could not be exactly the passed
+                # paths with some complicated names, so they are not guessed
+                for path in chunk:
+                    tags[path] = _get_one_with_mac_tag(mac_tag, path)
+        return tags
+
+    def apply_many(self, changes: Iterable[TagChange]) -> [Exception]:
+        import mac_tag
+
+        resolved, errors = self._resolve_changes(changes)
+
+        # Group the paths by tag, so every tag only needs a few calls
+        to_add = {}
+        to_remove = {}
+        for path, add, remove in resolved:
+            for tag in remove:
+                to_remove.setdefault(tag, []).append(path)
+            for tag in add:
+                to_add.setdefault(tag, []).append(path)
+
+        for tag, paths in to_remove.items():
+            for chunk in _chunks(paths, self.chunk_size):
+                _change_with_mac_tag(mac_tag.remove, tag, chunk)
+        for tag, paths in to_add.items():
+            for chunk in _chunks(paths, self.chunk_size):
+                _change_with_mac_tag(mac_tag.add, tag, chunk)
+
+        return errors
+
+
+class XattrBackend(TagBackend):
+    """Backend that manages directly the tags extended attribute.
+
+    Finder stores the tags as a binary property list with an array of
+    '<name>\\n<color>' strings. The color suffix is discarded when reading and
+    preserved for the tags that are kept when writing.
+
+    The symbolic links are not followed, as in the tree walk, so a link is
+    tagged itself and a dangling one can be read.
+    """
+
+    name = "xattr"
+
+    def __init__(self, attribute: str = None):
+        if attribute is None:
+            attribute = properties.TAGS_XATTR_NAME
+            if sys.platform.startswith("linux"):
+                attribute = f"user.{attribute}"
+        self.attribute = attribute
+        self._getxattr, self._setxattr, self._removexattr = _xattr_functions()
+
+    def get_many(self, paths: Iterable[str]) -> Dict[str, List[str]]:
+        return {path: [_tag_name(t) for t in self._read(path)] for path in paths}
+
+    def apply_many(self, changes: Iterable[TagChange]) -> [Exception]:
+        resolved, errors = self._resolve_changes(changes)
+        for path, add, remove in resolved:
+            try:
+                raw_tags = self._read(path)
+            except FileNotFoundError as e:
+                errors.append(e)
+                continue
+
+            new_raw_tags = [t for t in raw_tags if _tag_name(t) not in remove]
+            present = {_tag_name(t) for t in new_raw_tags}
+            new_raw_tags.extend(t for t in add if t not in present)
+            if new_raw_tags != raw_tags:
+                self._write(path, new_raw_tags)
+        return errors
+
+    def _read(self, path: str) -> [str]:
+        """Return the raw tags stored in the attribute of 'path'."""
+        import plistlib
+
+        try:
+            value = self._getxattr(path, self.attribute)
+        except FileNotFoundError:
+            raise FileNotFoundError(path)
+        except OSError as e:
+            if e.errno not in _NO_ATTRIBUTE_ERRNOS:
+                raise
+            return []  # The attribute is not present
+        try:
+            raw_tags = plistlib.loads(value)
+        except Exception:  # A broken attribute is handled as an empty one
+            return []
+        return [t for t in raw_tags if isinstance(t, str)]
+
+    def _write(self, path: str, raw_tags: [str]) -> None:
+        """Store the raw tags into the attribute of 'path'."""
+        import plistlib
+
+        if raw_tags:
+            value = plistlib.dumps(raw_tags, fmt=plistlib.FMT_BINARY)
+            self._setxattr(path, self.attribute, value)
+        else:
+            try:
+                self._removexattr(path, self.attribute)
+            except FileNotFoundError:
+                raise FileNotFoundError(path)
+            except OSError as e:
+                if e.errno not in _NO_ATTRIBUTE_ERRNOS:
+                    raise
+
+
+class MemoryBackend(TagBackend):
+    """Fake backend that keeps the tags in memory.
+
+    The paths still must exist in the file system, so the errors reported are
+    the same as with the real backends.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.tags = {}
+
+    def get_many(self, paths: Iterable[str]) -> Dict[str, List[str]]:
+        res = {}
+        for path in paths:
+            if not os.path.lexists(path):
+                raise FileNotFoundError(path)
+            res[path] = list(self.tags.get(path, []))
+        return res
+
+    def apply_many(self, changes: Iterable[TagChange]) -> [Exception]:
+        resolved, errors = self._resolve_changes(changes)
+        for path, add, remove in resolved:
+            tags = [t for t in self.tags.get(path, []) if t not in remove]
+            tags.extend(t for t in add if t not in tags)
+            if tags:
+                self.tags[path] = tags
+            else:
+                self.tags.pop(path, None)
+        return errors
+
+
+BACKENDS = {
+    MacTagBackend.name: MacTagBackend,
+    XattrBackend.name: XattrBackend,
+    MemoryBackend.name: MemoryBackend,
+}
+
+_backend = None  # The backend in use, see 'get_backend'
+
+
+def get_backend() -> TagBackend:
+    """Return the tag backend in use.
+
+    If no one has been set, the 'FTB_TAG_BACKEND' environment variable selects
+    it. By default, the 'tag' backend is used on Mac OS and the 'xattr' one
+    elsewhere.
+    """
+    if _backend is None:
+        name = os.environ.get(properties.TAG_BACKEND_ENV_VAR)
+        if not name:
+            name = "tag" if sys.platform == "darwin" else "xattr"
+        set_backend(name)
+    return _backend
+
+
+def set_backend(backend: Union[TagBackend, str]) -> TagBackend:
+    """Select the tag backend to use.
+
+    :param backend: A 'TagBackend' instance or the name of a backend.
+    :raise ValueError: If the backend name is not known.
+    :return: The selected backend.
+    """
+    global _backend
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown tag backend '{backend}'")
+        backend = BACKENDS[backend]()
+    _backend = backend
+    return _backend
+
+
+def _chunks(items: list, size: int) -> [list]:
+    """Split 'items' into lists of 'size' elements at most."""
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _get_one_with_mac_tag(mac_tag, path: str) -> [str]:
+    """Return the tags of a single path using 'mac_tag'."""
+    try:
+        tags_dict = mac_tag.get(path)
+    except FileNotFoundError:
+        raise FileNotFoundError(path)
+    tags = []
+    for e in tags_dict:
+        tags.extend(tags_dict[e])
+    return tags
+
+
+def _change_with_mac_tag(function, tag: str, paths: [str]) -> None:
+    """Add or remove a tag of a chunk of paths using 'mac_tag'.
+
+    :raise TagOperationError: If the call fails, with the paths of the chunk,
+        so they can be tried one by one.
+    """
+    try:
+        function(tag, paths)
+    except Exception as e:
+        raise TagOperationError(operation="writing", cause=e, paths=paths)
+
+
+def _tag_name(raw_tag: str) -> str:
+    """Return the name of a raw tag discarding its color suffix."""
+    return raw_tag.split("\n", 1)[0]
+
+
+def _xattr_functions():
+    """Return the functions to get, set and remove extended attributes,
+    without following the symbolic links.
+
+    Use the 'os' ones where available (Linux) and the 'xattr' package
+    otherwise (Mac OS).
+    """
+    if hasattr(os, "getxattr"):
+        return (
+            partial(os.getxattr, follow_symlinks=False),
+            partial(os.setxattr, follow_symlinks=False),
+            partial(os.removexattr, follow_symlinks=False),
+        )
+    try:
+        import xattr
+    except ImportError:
+        raise ImportError(
+            "The 'xattr' tag backend needs the 'xattr' package on this platform"
+        )
+    return (
+        partial(xattr.getxattr, symlink=True),
+        partial(xattr.setxattr, symlink=True),
+        partial(xattr.removexattr, symlink=True),
+    )
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Batch mode.
+
+Process several nodes in a single run, a few of them at the same time. All
+the nodes share the tag backend in use and the worker pool, so the start up
+costs are paid once.
+
+The nodes can be listed in a YAML config file, like:
+
+    parallel: 4
+    nodes:
+      - ~/OneDrive
+      - path: ~/Dropbox
+        option: hard-dump
+        format: binary
+        compression: gzip
+        identity: true
+        shards: 16
+        only: [Projects/ftb, "Archive/*/docs"]
+        max-depth: 4
+        follow-symlinks: false
+        retry-failed: false
+        cache: false
+        dry-run: false
+
+A node given only by its path, or any option not set for a node, uses the
+command line options.
+"""
+
+import os
+import time
+from typing import Dict, List, Tuple, Union
+
+from finder_tags_butler import properties
+from finder_tags_butler.errors import InvalidBatchConfigFileError
+from finder_tags_butler.logic_layer import dump_manifest, plan_dump, save_manifest
+from finder_tags_butler.logic_merge import merge_manifest
+from finder_tags_butler.logic_pipeline import PipelineOptions
+from finder_tags_butler.logic_reconcile import count_changes
+from finder_tags_butler.logic_retry import TagOperationExecutor
+from finder_tags_butler.logic_subpaths import check_pattern
+from finder_tags_butler.logic_workers import WorkerPool
+
+# Names of the options in the config files
+CONFIG_OPTIONS = {
+    "save": "save_opt",
+    "dump": "dump_opt",
+    "soft-dump": "soft_dump_opt",
+    "hard-dump": "hard_dump_opt",
+    "merge": "merge_opt",
+}
+_NODE_KEYS = {
+    "path",
+    "option",
+    "format",
+    "compression",
+    "identity",
+    "shards",
+    "only",
+    "max-depth",
+    "follow-symlinks",
+    "retry-failed",
+    "cache",
+    "dry-run",
+}
+_FORCE_OVERWRITING = {
+    "dump_opt": None,
+    "soft_dump_opt": False,
+    "hard_dump_opt": True,
+}
+
+
+class NodeTask:
+    """Abstraction of the work to do over a node."""
+
+    def __init__(
+        self,
+        path: str,
+        option: str,
+        use_cache: bool = True,
+        dry_run: bool = False,
+        manifest_format: str = None,
+        compression: str = None,
+        identity: bool = False,
+        shards: int = None,
+        only: List[str] = None,
+        max_depth: int = None,
+        follow_symlinks: bool = False,
+        retry_failed: bool = False,
+    ):
+        """
+        :param path: The path of the node.
+        :param option: 'save_opt', 'dump_opt', 'soft_dump_opt',
+            'hard_dump_opt' or 'merge_opt'.
+        :param use_cache: See 'save_manifest'.
+        :param dry_run: Only plan the changes of a dump.
+        :param manifest_format: See 'save_manifest'.
+        :param compression: See 'save_manifest'.
+        :param identity: See 'save_manifest'.
+        :param shards: See 'save_manifest'.
+        :param only: See 'dump_manifest'.
+        :param max_depth: See 'save_manifest'.
+        :param follow_symlinks: See 'save_manifest'.
+        :param retry_failed: See 'dump_manifest'.
+        """
+        self.path = path
+        self.option = option
+        self.use_cache = use_cache
+        self.dry_run = dry_run
+        self.manifest_format = manifest_format
+        self.compression = compression
+        self.identity = identity
+        self.shards = shards
+        self.only = only
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.retry_failed = retry_failed
+
+
+class NodeResult:
+    """Abstraction of the result of a 'NodeTask'."""
+
+    def __init__(self, task: NodeTask):
+        self.task = task
+        self.error = None  # The error that has stopped the task, if any
+        self.tagging_errors = []
+        self.changes = None  # The planned changes of a dry run
+        self.conflicts = []  # Of a merge
+        self.seconds = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def load_batch_config(path: str, defaults: dict) -> Tuple[List[NodeTask], int]:
+    """Read a batch config file.
+
+    :param path: The path of the config file.
+    :param defaults: A dict with the 'option', 'use_cache', 'dry_run',
+        'manifest_format', 'compression', 'identity', 'shards', 'only',
+        'max_depth', 'follow_symlinks' and 'retry_failed' of the nodes that do
+        not set them.
+    :raise InvalidBatchConfigFileError: If the file can not be read or it is
+        not valid.
+    :return: A tuple with the list of tasks and the number of nodes to process
+        at the same time, or 'None' if not set.
+    """
+    import yaml
+
+    try:
+        with open(path, "r", encoding="utf-8") as infile:
+            config = yaml.safe_load(infile)
+    except (OSError, yaml.YAMLError) as e:
+        raise InvalidBatchConfigFileError(path, reason=str(e))
+
+    if not isinstance(config, dict) or not isinstance(config.get("nodes"), list):
+        raise InvalidBatchConfigFileError(path, reason="a 'nodes' list is needed")
+    unknown = set(config) - {"nodes", "parallel"}
+    if unknown:
+        raise InvalidBatchConfigFileError(
+            path, reason=f"unknown keys {', '.join(sorted(unknown))}"
+        )
+    parallel = config.get("parallel")
+    if parallel is not None and (not isinstance(parallel, int) or parallel < 1):
+        raise InvalidBatchConfigFileError(
+            path, reason="'parallel' must be a positive integer"
+        )
+
+    tasks = []
+    for i, node in enumerate(config["nodes"], 1):
+        try:
+            tasks.append(_node_task(node, defaults))
+        except ValueError as e:
+            raise InvalidBatchConfigFileError(path, reason=f"node {i}: {e}")
+    try:
+        check_tasks(tasks)
+    except ValueError as e:
+        raise InvalidBatchConfigFileError(path, reason=str(e))
+    return tasks, parallel
+
+
+def check_tasks(tasks: List[NodeTask]) -> None:
+    """Check that no node is processed twice.
+
+    :raise ValueError: If a node appears more than once.
+    """
+    seen = set()
+    for task in tasks:
+        path = os.path.abspath(os.path.expanduser(task.path))
+        if path in seen:
+            raise ValueError(f"the node '{task.path}' is repeated")
+        seen.add(path)
+
+
+def run_batch(
+    tasks: List[NodeTask],
+    workers: WorkerPool = None,
+    parallel: int = properties.BATCH_PARALLEL_NODES,
+    pipeline: PipelineOptions = None,
+    executor: TagOperationExecutor = None,
+) -> List[NodeResult]:
+    """Process several nodes, 'parallel' of them at the same time at most.
+
+    The errors of a node do not stop the rest.
+
+    :param tasks: The tasks of the nodes.
+    :param workers: A pool shared by all the nodes to walk their trees and
+        read their tags concurrently.
+    :param parallel: The maximum number of nodes processed at the same time.
+    :param pipeline: The configuration of the pipeline of every dump, see
+        'dump_manifest'.
+    :param executor: The executor of the tag operations shared by all the
+        dumps, see 'dump_manifest'.
+    :return: The results, in the order of the tasks.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max(1, min(parallel, len(tasks)))) as nodes:
+        return list(
+            nodes.map(lambda t: run_node(t, workers, pipeline, executor), tasks)
+        )
+
+
+def run_node(
+    task: NodeTask,
+    workers: WorkerPool = None,
+    pipeline: PipelineOptions = None,
+    executor: TagOperationExecutor = None,
+) -> NodeResult:
+    """Process a node, catching any error.
+
+    :param task: The task of the node.
+    :param workers: A pool to walk the tree and read the tags concurrently.
+    :param pipeline: The configuration of the pipeline of a dump, see
+        'dump_manifest'.
+    :param executor: The executor of the tag operations of a dump, see
+        'dump_manifest'.
+    :return: The result of the task.
+    """
+    result = NodeResult(task)
+    start = time.perf_counter()
+    try:
+        if not os.path.isdir(task.path):
+            raise NotADirectoryError(task.path)
+        manifest_path = os.path.join(task.path, properties.MANIFEST_FILE_NAME)
+
+        if task.option == "save_opt":
+            save_manifest(
+                path=task.path,
+                manifest_path=manifest_path,
+                use_cache=task.use_cache,
+                workers=workers,
+                manifest_format=task.manifest_format,
+                compression=task.compression,
+                identity=task.identity,
+                shards=task.shards,
+                max_depth=task.max_depth,
+                follow_symlinks=task.follow_symlinks,
+            )
+        elif task.option == "merge_opt":
+            report = merge_manifest(
+                manifest_path=manifest_path,
+                path=task.path,
+                use_cache=task.use_cache,
+                dry_run=task.dry_run,
+                workers=workers,
+                manifest_format=task.manifest_format,
+                compression=task.compression,
+                shards=task.shards,
+                max_depth=task.max_depth,
+                follow_symlinks=task.follow_symlinks,
+            )
+            result.tagging_errors = report.errors
+            result.conflicts = report.conflicts
+            if task.dry_run:
+                result.changes = report.changes
+        else:
+            if not os.path.isfile(manifest_path):
+                raise FileNotFoundError(manifest_path)
+            force_overwriting = _FORCE_OVERWRITING[task.option]
+            if task.dry_run:
+                result.changes, result.tagging_errors = plan_dump(
+                    manifest_path=manifest_path,
+                    path=task.path,
+                    force_overwriting=force_overwriting,
+                    workers=workers,
+                    only=task.only,
+                    max_depth=task.max_depth,
+                    follow_symlinks=task.follow_symlinks,
+                )
+            else:
+                result.tagging_errors = dump_manifest(
+                    manifest_path=manifest_path,
+                    path=task.path,
+                    force_overwriting=force_overwriting,
+                    workers=workers,
+                    only=task.only,
+                    max_depth=task.max_depth,
+                    follow_symlinks=task.follow_symlinks,
+                    pipeline=pipeline,
+                    executor=executor,
+                    retry_failed=task.retry_failed,
+                )
+    except Exception as e:
+        result.error = e
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def describe_result(result: NodeResult) -> str:
+    """Return a summary line of the result of a node."""
+    task = result.task
+    action = {"save_opt": "saved", "merge_opt": "merged"}.get(task.option, "dumped")
+    if not result.ok:
+        return f"'{task.path}': {result.error}"
+    if result.changes is not None:
+        paths, added, removed = count_changes(result.changes)
+        text = (
+            f"'{task.path}' has not been {action} (dry run): {paths} paths to "
+            f"change, {added} tags to add, {removed} to remove"
+        )
+    else:
+        text = f"'{task.path}' has been {action}"
+    if result.conflicts:
+        text += f", with {len(result.conflicts)} merged conflicts"
+    if result.tagging_errors:
+        text += f", with {len(result.tagging_errors)} tagging errors"
+    return f"{text} ({result.seconds:.2f} s)."
+
+
+def _node_task(node: Union[str, Dict], defaults: dict) -> NodeTask:
+    """Build the task of a node of a config file.
+
+    :raise ValueError: If the node is not valid.
+    """
+    if isinstance(node, str):
+        node = {"path": node}
+    if not isinstance(node, dict) or not isinstance(node.get("path"), str):
+        raise ValueError("a node must be a path or have a 'path'")
+    unknown = set(node) - _NODE_KEYS
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(sorted(unknown))}")
+
+    option = defaults["option"]
+    if "option" in node:
+        if node["option"] not in CONFIG_OPTIONS:
+            raise ValueError(f"the option must be one of {', '.join(CONFIG_OPTIONS)}")
+        option = CONFIG_OPTIONS[node["option"]]
+    manifest_format = node.get("format", defaults["manifest_format"])
+    if manifest_format not in (None,) + properties.MANIFEST_FORMATS:
+        raise ValueError(f"unknown format '{manifest_format}'")
+    compression = node.get("compression", defaults["compression"])
+    if compression is not None:
+        if compression not in properties.MANIFEST_COMPRESSIONS:
+            raise ValueError(f"unknown compression '{compression}'")
+        if manifest_format != "binary":
+            raise ValueError("only binary manifests can be compressed")
+    use_cache = node.get("cache", defaults["use_cache"])
+    dry_run = node.get("dry-run", defaults["dry_run"])
+    identity = node.get("identity", defaults["identity"])
+    follow_symlinks = node.get("follow-symlinks", defaults["follow_symlinks"])
+    retry_failed = node.get("retry-failed", defaults["retry_failed"])
+    if not all(
+        isinstance(v, bool)
+        for v in (use_cache, dry_run, identity, follow_symlinks, retry_failed)
+    ):
+        raise ValueError(
+            "'cache', 'dry-run', 'identity', 'follow-symlinks' and "
+            "'retry-failed' must be booleans"
+        )
+    shards = node.get("shards", defaults["shards"])
+    if shards is not None and (
+        not isinstance(shards, int) or isinstance(shards, bool) or shards < 1
+    ):
+        raise ValueError("'shards' must be a positive integer")
+    max_depth = node.get("max-depth", defaults["max_depth"])
+    if max_depth is not None and (
+        not isinstance(max_depth, int) or isinstance(max_depth, bool) or max_depth < 1
+    ):
+        raise ValueError("'max-depth' must be a positive integer")
+    only = node.get("only", defaults["only"])
+    if only is not None:
+        if not isinstance(only, list) or not all(isinstance(p, str) for p in only):
+            raise ValueError("'only' must be a list of subpaths")
+        for pattern in only:
+            check_pattern(pattern)
+        if option not in _FORCE_OVERWRITING:
+            raise ValueError("'only' is only for the dumps")
+    if node.get("dry-run") and option == "save_opt":
+        raise ValueError("'dry-run' is only for the dumps and the merges")
+    if retry_failed and (option not in _FORCE_OVERWRITING or only or dry_run):
+        raise ValueError(
+            "'retry-failed' is only for the dumps, without 'only' or 'dry-run'"
+        )
+
+    return NodeTask(
+        os.path.expanduser(node["path"]),
+        option,
+        use_cache=use_cache,
+        dry_run=dry_run,
+        manifest_format=manifest_format,
+        compression=compression,
+        identity=identity,
+        shards=shards,
+        only=only,
+        max_depth=max_depth,
+        follow_symlinks=follow_symlinks,
+        retry_failed=retry_failed,
+    )
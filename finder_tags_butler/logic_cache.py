@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Stat cache.
+
+The stat cache remembers, for every path of the node, its stat data (inode,
+modification time, status change time and size) and the tags read for it.
+Changing the tags of a file updates its status change time, so the tags of
+the paths whose stat data is unchanged can be reused without reading them
+again.
+
+The stat data is only valid on the machine that has read it, so the cache is
+kept in the local state directory, out of the synchronized node, see
+'logic_journal'.
+"""
+
+import json
+import os
+import platform
+import time
+from typing import Dict, List, Union
+
+from finder_tags_butler.logic_files import AtomicFile
+from finder_tags_butler.logic_journal import node_state_path
+
+CACHE_VERSION = 1
+
+# File systems with coarse timestamps could not reflect a change made just
+# after the scan, so the entries changed around the scan are not trusted
+RACY_WINDOW_NS = 2 * 10**9
+
+
+class StatCache:
+    """Abstraction of the stat cache of a node."""
+
+    def __init__(self):
+        self.machine = platform.node()
+        self.scan_started_ns = time.time_ns()
+        self.entries = {}  # path -> [inode, mtime_ns, ctime_ns, size, tags]
+        self._paths_by_inode = None
+
+    @classmethod
+    def load(cls, path: str) -> "StatCache":
+        """Read a cache file.
+
+        A missing, broken or foreign cache file returns an empty cache, since
+        the cache is only an optimization.
+
+        :param path: The path of the cache file.
+        :return: The loaded cache.
+        """
+        cache = cls()
+        try:
+            with open(path, "r") as infile:
+                data = json.load(infile)
+            if data["version"] != CACHE_VERSION or data["machine"] != cache.machine:
+                return cache  # Inodes and times are only valid on this machine
+            scan_started_ns = data["scan_started_ns"]
+            entries = data["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return cache
+
+        cache.entries = {
+            p: e for p, e in entries.items() if e[2] < scan_started_ns - RACY_WINDOW_NS
+        }
+        return cache
+
+    def save(self, path: str) -> None:
+        """Write the cache to a file, atomically.
+
+        :param path: The path of the cache file.
+        """
+        data = {
+            "version": CACHE_VERSION,
+            "machine": self.machine,
+            "scan_started_ns": self.scan_started_ns,
+            "entries": self.entries,
+        }
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        data = json.dumps(data, separators=(",", ":"))
+        with AtomicFile(path) as outfile:
+            outfile.write(data.encode("utf-8"))
+
+    def lookup(self, path: str, st: os.stat_result) -> Union[List[str], None]:
+        """Return the cached tags of a path, if its stat data is unchanged.
+
+        A path that is not in the cache is looked up by inode to detect renames:
+        if the previous path of the inode does not exist any more and the rest
+        of the stat data is unchanged, its tags are reused.
+
+        :param path: The path to look up.
+        :param st: The current stat data of the path.
+        :return: The cached tags or 'None' if they have to be read again.
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            if self._paths_by_inode is None:
+                self._paths_by_inode = {e[0]: p for p, e in self.entries.items()}
+            old_path = self._paths_by_inode.get(st.st_ino)
+            if old_path is None or os.path.lexists(old_path):
+                return None
+            entry = self.entries[old_path]
+
+        if entry[:4] == [st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size]:
+            return entry[4]
+        return None
+
+    def update(self, entries: Dict[str, tuple]) -> None:
+        """Replace the cache content.
+
+        :param entries: A dict with the '(stat_result, tags)' of every path.
+        """
+        self.entries = {
+            p: [st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size, t]
+            for p, (st, t) in entries.items()
+        }
+        self._paths_by_inode = None
+
+
+def stat_cache_path(root: str, manifest_path: str, state_dir: str = None) -> str:
+    """Return the path of the stat cache of a node.
+
+    :param root: The node path.
+    :param manifest_path: The path of the manifest of the node.
+    :param state_dir: The directory of the local state. By default, see
+        'default_state_dir'.
+    """
+    return node_state_path(root, manifest_path, state_dir) + ".cache"
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Crash-safe file writes and node locks.
+
+The manifests are written to a temporary file in their directory, flushed to
+the disk and then renamed over the old file, so a crash, or a cloud client
+uploading the file while it is written, never sees a truncated manifest. If
+the new content is the same as the old one, the old file is kept untouched,
+so it is not uploaded and synchronized again.
+
+The runs over the same node on the same machine take an advisory lock, kept
+in the local state directory, so they wait for each other instead of racing.
+"""
+
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+from finder_tags_butler.logic_journal import node_state_path
+
+try:
+    import fcntl
+except ImportError:  # Not a POSIX system, the runs are not serialized
+    fcntl = None
+
+
+class AtomicFile:
+    """A binary file written to a temporary file and renamed over its path
+    once completed."""
+
+    mode = "wb"
+
+    def __init__(self, path: str, replace_unchanged: bool = False):
+        """
+        :param path: The path of the file.
+        :param replace_unchanged: Passing this param as 'True', the file is
+            replaced even if its content has not changed.
+        """
+        self.path = path
+        self.name = path  # Stored in the header of the gzip files
+        self.replace_unchanged = replace_unchanged
+        self.tmp_path = f"{path}.tmp"
+        self.size = 0
+        self.changed = None  # If the file has been replaced, once closed
+        self._digest = hashlib.blake2b(digest_size=16)
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.tmp_path, "wb")
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+            if exc_type is not None:
+                os.remove(self.tmp_path)
+        if exc_type is None:
+            self._commit()
+
+    def write(self, data: bytes) -> int:
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def _commit(self) -> None:
+        """Replace the file with the temporary one, unless they are equal."""
+        if not self.replace_unchanged and self._is_unchanged():
+            os.remove(self.tmp_path)
+            self.changed = False
+            return
+        try:
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            os.remove(self.tmp_path)
+            raise
+        fsync_dir(os.path.dirname(self.path))
+        self.changed = True
+
+    def _is_unchanged(self) -> bool:
+        """Tell if the current file has the written content. Only the files
+        of the same size are read."""
+        try:
+            if os.path.getsize(self.path) != self.size:
+                return False
+            digest = hashlib.blake2b(digest_size=16)
+            with open(self.path, "rb") as infile:
+                for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        except OSError:
+            return False
+        return digest.digest() == self._digest.digest()
+
+
+def fsync_dir(path: str) -> None:
+    """Flush the entries of a directory to the disk, so a rename in it
+    survives a crash. Not supported by every system."""
+    try:
+        fd = os.open(path or os.curdir, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _NodeLock:
+    """An advisory lock of a node, reentrant in the same process."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            if self._depth == 0 and fcntl is not None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, "a")
+                try:
+                    fcntl.flock(self._file, fcntl.LOCK_EX)
+                except BaseException:
+                    self._file.close()
+                    raise
+        except BaseException:
+            self._lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self._depth -= 1
+        try:
+            if self._depth == 0 and self._file is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+
+_node_locks = {}  # Lock file path -> '_NodeLock'
+_node_locks_guard = threading.Lock()
+
+
+@contextmanager
+def node_lock(root: str, manifest_path: str, state_dir: str = None) -> Iterator:
+    """Hold the lock of a node and its manifest, waiting for the other runs
+    that hold it.
+
+    The lock is reentrant, so a run can call another locked function over
+    the same node.
+
+    :param root: The node path.
+    :param manifest_path: The path of the manifest of the node.
+    :param state_dir: The directory of the local state. By default, see
+        'default_state_dir'.
+    """
+    path = node_state_path(root, manifest_path, state_dir) + ".lock"
+    with _node_locks_guard:
+        lock = _node_locks.get(path)
+        if lock is None:
+            lock = _node_locks[path] = _NodeLock(path)
+    with lock:
+        yield
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Identity index.
+
+The manifest entries are keyed by path, so the tags of a file moved inside the
+node would be lost. The identity index is an optional sidecar file of the
+manifest with a content fingerprint of every tagged file, so a dump can find
+the new location of the entries whose path has vanished.
+
+A fingerprint is the size of the file and a hash of its first and last
+blocks, which is fast to compute for any size. When two tagged files share
+it, a hash of their full content is added. The fingerprints are cached by
+inode, modification time and size in the local state directory, out of the
+synchronized node, so unchanged files are never hashed again.
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import platform
+import stat
+from typing import Callable, Dict, Iterable, Union
+
+from finder_tags_butler import properties
+from finder_tags_butler.logic_files import AtomicFile
+from finder_tags_butler.logic_journal import node_state_path
+from finder_tags_butler.logic_manifest import TagAssociation
+from finder_tags_butler.logic_paths import absolute_path, relative_path
+
+INDEX_VERSION = 1
+CACHE_VERSION = 1
+
+
+class FingerprintCache:
+    """Abstraction of the fingerprints cache of a node."""
+
+    def __init__(self):
+        self.machine = platform.node()
+        self.entries = {}  # path -> [inode, mtime_ns, size, quick, full]
+        self.changed = False
+
+    @classmethod
+    def load(cls, path: str) -> "FingerprintCache":
+        """Read a cache file.
+
+        A missing, broken or foreign cache file returns an empty cache.
+
+        :param path: The path of the cache file.
+        :return: The loaded cache.
+        """
+        cache = cls()
+        try:
+            with open(path, "r") as infile:
+                data = json.load(infile)
+            if data["version"] != CACHE_VERSION or data["machine"] != cache.machine:
+                return cache  # Inodes and times are only valid on this machine
+            cache.entries = dict(data["entries"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return cache
+
+    def save(self, path: str) -> None:
+        """Write the cache to a file, if it has changed.
+
+        :param path: The path of the cache file.
+        """
+        if not self.changed:
+            return
+        data = {
+            "version": CACHE_VERSION,
+            "machine": self.machine,
+            "entries": self.entries,
+        }
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        data = json.dumps(data, separators=(",", ":"))
+        with AtomicFile(path) as outfile:
+            outfile.write(data.encode("utf-8"))
+        self.changed = False
+
+    def fingerprint(self, path: str, st: os.stat_result, full: bool = False) -> str:
+        """Return the fingerprint of a file, hashing it only if it has changed.
+
+        :param path: The path of the file.
+        :param st: The current stat data of the file.
+        :param full: Passing this param as 'True', the fingerprint includes
+            the hash of the full content.
+        :raise OSError: If the file can not be read.
+        :return: The fingerprint.
+        """
+        key = [st.st_ino, st.st_mtime_ns, st.st_size]
+        entry = self.entries.get(path)
+        if entry is None or entry[:3] != key:
+            entry = key + [quick_hash(path, st.st_size), None]
+            self.entries[path] = entry
+            self.changed = True
+        if full and entry[4] is None:
+            entry[4] = full_hash(path)
+            self.changed = True
+        fingerprint = f"{st.st_size}:{entry[3]}"
+        return f"{fingerprint}:{entry[4]}" if full else fingerprint
+
+
+def fingerprint_cache_path(root: str, manifest_path: str, state_dir: str = None) -> str:
+    """Return the path of the fingerprints cache of a node.
+
+    :param root: The node path.
+    :param manifest_path: The path of the manifest of the node.
+    :param state_dir: The directory of the local state. By default, see
+        'default_state_dir'.
+    """
+    return node_state_path(root, manifest_path, state_dir) + ".fpcache"
+
+
+class IdentityIndex:
+    """Abstraction of the identity index of a manifest."""
+
+    def __init__(self, root: str, entries: Dict[str, str] = None):
+        """
+        :param root: The node path. The paths are stored relative to it, so the
+            index is valid on every machine.
+        :param entries: A dict with the fingerprint of every tagged file.
+        """
+        self.root = root
+        self.entries = entries if entries is not None else {}
+
+    @classmethod
+    def load(cls, path: str, root: str) -> Union["IdentityIndex", None]:
+        """Read an index file.
+
+        :param path: The path of the index file.
+        :param root: The node path.
+        :return: The loaded index, or 'None' if it is missing or broken.
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as infile:
+                data = json.load(infile)
+            if data["version"] != INDEX_VERSION:
+                return None
+            entries = {absolute_path(p, root): f for p, f in data["entries"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+        return cls(root, entries)
+
+    def save(self, path: str) -> None:
+        """Write the index to a file.
+
+        :param path: The path of the index file.
+        """
+        data = {
+            "version": INDEX_VERSION,
+            "entries": {
+                relative_path(p, self.root): f for p, f in sorted(self.entries.items())
+            },
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(data, outfile, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+
+def build_identity_index(
+    root: str, stats: Dict[str, os.stat_result], cache: FingerprintCache
+) -> IdentityIndex:
+    """Fingerprint the tagged files of a node.
+
+    :param root: The node path.
+    :param stats: A dict with the stat data of every tagged path. Only the
+        regular files are fingerprinted.
+    :param cache: The fingerprints cache to use.
+    :return: The index of the files.
+    """
+    by_fingerprint = {}
+    for path, st in stats.items():
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        try:
+            by_fingerprint.setdefault(cache.fingerprint(path, st), []).append(path)
+        except OSError:  # Unreadable, it can not be followed
+            continue
+
+    entries = {}
+    for fingerprint, paths in by_fingerprint.items():
+        if len(paths) == 1:
+            entries[paths[0]] = fingerprint
+            continue
+        for path in paths:  # Collision, use the full content
+            try:
+                entries[path] = cache.fingerprint(path, stats[path], full=True)
+            except OSError:
+                continue
+    return IdentityIndex(root, entries)
+
+
+def remap_moved_entries(
+    entries: Iterable[TagAssociation],
+    index: IdentityIndex,
+    candidates: Iterable[str],
+    cache: FingerprintCache,
+    exists: Callable[[str], bool] = os.path.lexists,
+) -> Iterable[TagAssociation]:
+    """Move the entries whose path has vanished to the file with the same
+    fingerprint, if there is exactly one.
+
+    :param entries: The manifest entries, sorted by path.
+    :param index: The identity index of the manifest.
+    :param candidates: The paths of the node, the new locations are searched
+        between them. They are not iterated if no entry has vanished.
+    :param cache: The fingerprints cache to use.
+    :param exists: The function to check if a path exists.
+    :return: The entries, with the found ones moved, sorted by path.
+    """
+    missing = {}  # Fingerprint -> entries
+    for entry in entries:
+        fingerprint = index.entries.get(entry.path)
+        if fingerprint is not None and not exists(entry.path):
+            missing.setdefault(fingerprint, []).append(entry)
+    if not missing:
+        return entries
+
+    # Only the files with the size of some missing entry are hashed, and only
+    # the ones that collide with a full fingerprint are fully hashed
+    sizes = {int(f.split(":", 1)[0]) for f in missing}
+    full_quick = {f.rsplit(":", 1)[0] for f in missing if f.count(":") == 2}
+    found = {}  # Fingerprint -> candidate paths
+    for candidate in candidates:
+        if candidate in index.entries:  # Already tagged, it has not moved here
+            continue
+        try:
+            st = os.lstat(candidate)
+            if not stat.S_ISREG(st.st_mode) or st.st_size not in sizes:
+                continue
+            fingerprint = cache.fingerprint(candidate, st)
+            if fingerprint in full_quick:
+                fingerprint = cache.fingerprint(candidate, st, full=True)
+        except OSError:
+            continue
+        if fingerprint in missing:
+            found.setdefault(fingerprint, []).append(candidate)
+
+    moved = {}  # Old path -> moved entry
+    for fingerprint, missing_entries in missing.items():
+        paths = found.get(fingerprint, [])
+        if len(paths) == 1 and len(missing_entries) == 1:
+            moved[missing_entries[0].path] = TagAssociation(
+                paths[0], missing_entries[0].tags
+            )
+        # Otherwise, not found or ambiguous, they are reported as missing
+    if not moved:
+        return entries
+    return heapq.merge(
+        (e for e in entries if e.path not in moved), sorted(moved.values())
+    )
+
+
+def quick_hash(path: str, size: int) -> str:
+    """Return a hash of the first and last blocks of a file."""
+    block = properties.IDENTITY_BLOCK_SIZE
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as infile:
+        digest.update(infile.read(block))
+        if size > block:
+            infile.seek(max(block, size - block))
+            digest.update(infile.read(block))
+    return digest.hexdigest()
+
+
+def full_hash(path: str) -> str:
+    """Return a hash of the full content of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
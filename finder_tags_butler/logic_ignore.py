@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Walk rules.
+
+The hidden files and folders are never walked. Besides, a node can have an
+ignore file in its root, with a pattern per line in the gitignore syntax:
+
+    # Comments and blank lines are skipped
+    node_modules/
+    *.photoslibrary/
+    /build
+    Projects/**/dist
+    !Projects/keep/dist
+
+- A pattern with a slash, but not only at its end, is matched against the
+  path relative to the node. Otherwise, against the name at any level.
+- A pattern ending with a slash only matches directories.
+- '*', '?' and '[...]' do not match a slash. '**/' matches any number of
+  directories and a final '/**' all the content of a directory.
+- A pattern starting with '!' includes again the paths excluded by the
+  previous ones. The last matching pattern wins.
+
+The patterns are compiled once in regular expressions. An excluded directory
+is not even listed, so nothing inside it can be included again, like in git.
+The walk can also be limited to a maximum depth below the node, and follow
+or not the symbolic links to directories.
+"""
+
+import hashlib
+import json
+import os
+import re
+from typing import Iterable, List, Union
+
+from finder_tags_butler import properties
+from finder_tags_butler.logic_paths import relative_path
+
+
+class IgnoreMatcher:
+    """Compiled gitignore-style patterns."""
+
+    def __init__(self, lines: Iterable[str]):
+        """
+        :param lines: The lines of an ignore file.
+        """
+        self.rules = []  # (regex, negated, only_dirs), in the file order
+        for line in lines:
+            rule = _compile_line(line)
+            if rule is not None:
+                self.rules.append(rule)
+
+        # Without negated patterns, a path is excluded if any pattern matches,
+        # so all of them are joined in a single expression
+        self._any_file = self._any_dir = None
+        if not any(negated for _, negated, _ in self.rules):
+            self._any_dir = _join(r for r, _, _ in self.rules)
+            self._any_file = _join(r for r, _, only_dirs in self.rules if not only_dirs)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, path: str, is_dir: bool) -> bool:
+        """Tell if a path is excluded by the patterns.
+
+        :param path: The path relative to the node.
+        :param is_dir: If the path is a directory.
+        """
+        if self._any_dir is not None:
+            regex = self._any_dir if is_dir else self._any_file
+            return regex is not None and regex.match(path) is not None
+        for regex, negated, only_dirs in reversed(self.rules):
+            if (is_dir or not only_dirs) and regex.match(path):
+                return not negated
+        return False
+
+
+class WalkRules:
+    """Abstraction of the paths of a node to walk."""
+
+    def __init__(
+        self,
+        root: str = None,
+        matcher: IgnoreMatcher = None,
+        max_depth: int = None,
+        follow_symlinks: bool = False,
+    ):
+        """
+        :param root: The node path. Not needed without matcher nor maximum
+            depth.
+        :param matcher: The patterns of the paths to exclude. By default,
+            only the hidden ones are.
+        :param max_depth: The maximum depth of the walked paths below the
+            node, '1' for its direct children. By default, no limit.
+        :param follow_symlinks: Passing this param as 'True', the symbolic
+            links to directories are walked, unless they point to one of
+            the directories walked to reach them.
+        """
+        self.root = root
+        self.matcher = matcher if matcher else None
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self._excluded_dirs = {}  # Relative path -> if excluded
+
+    @classmethod
+    def load(
+        cls, root: str, max_depth: int = None, follow_symlinks: bool = False
+    ) -> "WalkRules":
+        """Build the rules of a node, reading its ignore file, if any.
+
+        :param root: The node path.
+        :param max_depth: See 'WalkRules'.
+        :param follow_symlinks: See 'WalkRules'.
+        :return: The rules.
+        """
+        try:
+            with open(
+                os.path.join(root, properties.IGNORE_FILE_NAME), "r", encoding="utf-8"
+            ) as infile:
+                matcher = IgnoreMatcher(infile)
+        except FileNotFoundError:
+            matcher = None
+        return cls(root, matcher, max_depth, follow_symlinks)
+
+    @property
+    def key(self) -> str:
+        """A checksum of the rules, equal for the walks that reach the same
+        paths of a node."""
+        patterns = []
+        if self.matcher is not None:
+            patterns = [[r.pattern, n, d] for r, n, d in self.matcher.rules]
+        data = json.dumps([self.max_depth, self.follow_symlinks, patterns])
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=8).hexdigest()
+
+    @property
+    def excludes_paths(self) -> bool:
+        """Tell if some visible paths can be excluded."""
+        return self.matcher is not None or self.max_depth is not None
+
+    def keep(self, path: str, is_dir: bool) -> bool:
+        """Tell if a path found while walking the node has to be kept. Its
+        parents are supposed to be kept.
+
+        :param path: The absolute path.
+        :param is_dir: If the path is a directory.
+        """
+        if os.path.basename(path).startswith("."):
+            return False
+        if not self.excludes_paths:
+            return True
+        rel_path = relative_path(path, self.root)
+        if self.max_depth is not None and _depth(rel_path) > self.max_depth:
+            return False
+        return self.matcher is None or not self.matcher.match(rel_path, is_dir)
+
+    def descend(self, path: str, is_symlink: bool = False) -> bool:
+        """Tell if a kept directory has to be walked.
+
+        :param path: The absolute path of the directory.
+        :param is_symlink: If the directory is a symbolic link.
+        """
+        if is_symlink:
+            if not self.follow_symlinks or self._walked_to(path):
+                return False  # Not followed, or a loop
+        if self.max_depth is None:
+            return True
+        return _depth(relative_path(path, self.root)) < self.max_depth
+
+    def excludes(self, path: str) -> bool:
+        """Tell if a path of the node, maybe missing, is out of the walk
+        because of the ignore patterns or the maximum depth.
+
+        :param path: The absolute path.
+        """
+        if not self.excludes_paths:
+            return False
+        rel_path = relative_path(path, self.root)
+        if not rel_path or os.path.isabs(rel_path):  # The node or out of it
+            return False
+        if self.max_depth is not None and _depth(rel_path) > self.max_depth:
+            return True
+        if self.matcher is None:
+            return False
+        if self._excludes_dir(os.path.dirname(rel_path)):
+            return True
+        if self.matcher.match(rel_path, False):
+            return True
+        return self.matcher.match(rel_path, True) and os.path.isdir(path)
+
+    def _walked_to(self, path: str) -> bool:
+        """Tell if the real directory of a path is one of the directories
+        walked to reach it, from the node.
+
+        They are compared by device and inode, so the loops of several links
+        pointing to each other are found too. Only the branch of the path is
+        checked, so the result does not depend on the order of the walk.
+        """
+        try:
+            target = _dir_key(path)
+        except OSError:
+            return True
+        parent = os.path.dirname(path)
+        while True:
+            try:
+                if _dir_key(parent) == target:
+                    return True
+            except OSError:
+                pass
+            if parent == self.root or os.path.dirname(parent) == parent:
+                return False
+            parent = os.path.dirname(parent)
+
+    def _excludes_dir(self, rel_path: str) -> bool:
+        """Tell if a directory, given relative to the node, or one of its
+        parents is excluded by the patterns."""
+        if not rel_path:
+            return False
+        excluded = self._excluded_dirs.get(rel_path)
+        if excluded is None:
+            excluded = self._excludes_dir(
+                os.path.dirname(rel_path)
+            ) or self.matcher.match(rel_path, True)
+            self._excluded_dirs[rel_path] = excluded
+        return excluded
+
+
+# Only the hidden paths are excluded
+DEFAULT_RULES = WalkRules()
+
+
+def _compile_line(line: str) -> Union[tuple, None]:
+    """Compile a line of an ignore file.
+
+    :return: A tuple with the regex, if it is negated and if it only matches
+        directories, or 'None' for blank lines and comments.
+    """
+    line = line.rstrip("\n")
+    if not line.endswith("\\ "):
+        line = line.rstrip(" ")
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated or line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+    only_dirs = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+
+    anchored = "/" in line
+    body = _translate(line.lstrip("/"))
+    if not anchored:
+        body = "(?:.*/)?" + body
+    return re.compile(body + r"\Z", re.DOTALL), negated, only_dirs
+
+
+def _translate(pattern: str) -> str:
+    """Translate a gitignore pattern, without its anchor, to a regex."""
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/"):
+            if i + 2 == n:  # All the content of a directory
+                parts.append(".*")
+                i += 2
+                continue
+            if pattern[i + 2] == "/":  # Any number of directories
+                parts.append("(?:.*/)?")
+                i += 3
+                continue
+        if c == "*":
+            parts.append("[^/]*")
+            while i + 1 < n and pattern[i + 1] == "*":
+                i += 1
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                chars = pattern[i + 1 : end].replace("\\", "\\\\")
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                elif chars.startswith("^"):
+                    chars = "\\" + chars
+                parts.append(f"(?!/)[{chars}]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return "".join(parts)
+
+
+def _join(regexes: Iterable) -> Union[re.Pattern, None]:
+    """Join several compiled regexes in a single one, if any."""
+    patterns: List[str] = [r.pattern for r in regexes]
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{p})" for p in patterns), re.DOTALL)
+
+
+def _dir_key(path: str) -> tuple:
+    """Return the device and the inode of a directory, following the links."""
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def _depth(rel_path: str) -> int:
+    """Return the depth of a path relative to the node, '0' for the node."""
+    return rel_path.count(os.sep) + 1 if rel_path else 0
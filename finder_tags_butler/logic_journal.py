@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Applied-state journal.
+
+Every dump records, in a journal of the machine stored out of the node, a
+checksum of the tags of every manifest entry it applies and, once it ends
+without errors, a checksum of the whole manifest file. So dumping the same
+manifest again ends just after hashing its file, and dumping a changed one
+skips the entries already applied. Like the skipped shards, the tags changed
+by hand since are kept, unless the node is fully overwritten.
+
+The mode of the dump is recorded too, as a soft dump keeps the tags that a
+normal one would remove. A manifest or an entry is only skipped if it was
+applied by a dump at least as strong, see 'dump_mode'. And a manifest is only
+skipped after a dump with the same walk rules, as the paths out of the walk
+of a limited one were never applied, see 'logic_ignore'.
+
+The journal of a node is a snapshot file and a log file. The log is appended
+and flushed to the disk after every applied batch, so an interrupted dump
+resumes from its last applied batch. A completed dump compacts the log in a
+new snapshot, written to a temporary file and then renamed.
+"""
+
+import hashlib
+import json
+import os
+import platform
+from typing import List, Union
+
+from finder_tags_butler import properties
+from finder_tags_butler.logic_paths import relative_path
+
+JOURNAL_VERSION = 1
+
+# Strength of the dump modes, see 'dump_mode'
+SOFT_DUMP = 0  # The tags not in the manifest are never removed
+DUMP = 1  # They are removed if the manifest comes from another machine
+HARD_DUMP = 2  # The node is fully overwritten
+
+
+class DumpJournal:
+    """Abstraction of the applied-state journal of a node."""
+
+    def __init__(
+        self,
+        root: str,
+        manifest_path: str,
+        state_dir: str = None,
+        mode: int = DUMP,
+        rules: str = None,
+    ):
+        """
+        :param root: The node path.
+        :param manifest_path: The path of the manifest dumped to the node.
+        :param state_dir: The directory of the local state. By default, see
+            'default_state_dir'.
+        :param mode: The strength of the mode of the dump, see 'dump_mode'.
+        :param rules: The key of the walk rules of the dump, see
+            'WalkRules.key'.
+        """
+        self.machine = platform.node()
+        self.root = root
+        self.manifest_path = manifest_path
+        self.mode = mode
+        self.rules = rules
+        self.manifest = None  # Checksum of the last fully applied manifest
+        self.manifest_mode = None  # Mode of the dump that applied it
+        self.manifest_rules = None  # Key of the walk rules of that dump
+        self.entries = {}  # Relative path -> [checksum of its tags, mode]
+        self.pending = {}  # Path -> tags of the batch being applied
+        self.seen_all = False  # If every entry of the manifest has been seen
+        self._seen = set()
+        self._log = None
+
+        base = node_state_path(root, manifest_path, state_dir)
+        self.snapshot_path = f"{base}.state"
+        self.log_path = f"{base}.log"
+
+    @classmethod
+    def load(
+        cls,
+        root: str,
+        manifest_path: str,
+        state_dir: str = None,
+        mode: int = DUMP,
+        rules: str = None,
+    ) -> "DumpJournal":
+        """Read the journal of a node, replaying the log of an interrupted
+        dump.
+
+        A missing, broken or foreign snapshot is handled as an empty one, and
+        a line of the log cut by a crash is ignored.
+
+        :param root: The node path.
+        :param manifest_path: The path of the manifest dumped to the node.
+        :param state_dir: The directory of the local state.
+        :param mode: The strength of the mode of the dump.
+        :param rules: The key of the walk rules of the dump.
+        :return: The loaded journal.
+        """
+        journal = cls(root, manifest_path, state_dir, mode, rules)
+        try:
+            with open(journal.snapshot_path, "r", encoding="utf-8") as infile:
+                data = json.load(infile)
+            if (
+                data["version"] == JOURNAL_VERSION
+                and data["machine"] == journal.machine
+                and data["root"] == root
+            ):
+                journal.manifest_rules = data["rules"]
+                journal.manifest_mode = data["mode"]
+                journal.manifest = data["manifest"]
+                journal.entries = dict(data["entries"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        try:
+            with open(journal.log_path, "r", encoding="utf-8") as infile:
+                for line in infile:
+                    try:
+                        journal.entries.update(json.loads(line)["entries"])
+                    except (ValueError, KeyError, TypeError):
+                        break  # Cut by a crash, the rest was never applied
+            journal.manifest = None  # That dump has not ended
+        except OSError:
+            pass
+        return journal
+
+    def is_manifest_applied(self, checksum: str) -> bool:
+        """Tell if a manifest is the last one fully applied, by a dump at
+        least as strong as this one and with the same walk rules.
+
+        :param checksum: The checksum of the manifest file.
+        """
+        return (
+            self.manifest == checksum
+            and self.manifest_mode is not None
+            and self.manifest_mode >= self.mode
+            and self.manifest_rules == self.rules
+        )
+
+    def is_applied(self, path: str, tags: List[str]) -> bool:
+        """Tell if the tags of a manifest entry are the last ones applied, by
+        a dump at least as strong as this one.
+
+        :param path: The absolute path of the entry.
+        :param tags: The tags of the entry.
+        """
+        rel_path = relative_path(path, self.root)
+        self._seen.add(rel_path)
+        entry = self.entries.get(rel_path)
+        return (
+            entry is not None
+            and entry[0] == _tags_checksum(tags)
+            and entry[1] >= self.mode
+        )
+
+    def begin(self) -> None:
+        """Open the log to record a dump."""
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        self._log = open(self.log_path, "a", encoding="utf-8")
+
+    def record(self, failed: set, pending: dict = None) -> None:
+        """Append the pending entries to the log, once applied.
+
+        :param failed: The paths of the pending entries that have not been
+            applied.
+        :param pending: The path and tags of the applied entries. By default,
+            the 'pending' ones, which are then cleared.
+        """
+        if pending is None:
+            pending, self.pending = self.pending, {}
+        entries = {
+            relative_path(p, self.root): [_tags_checksum(t), self.mode]
+            for p, t in pending.items()
+            if p not in failed
+        }
+        if not entries:
+            return
+        self.entries.update(entries)
+        self._log.write(json.dumps({"entries": entries}, ensure_ascii=False) + "\n")
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def complete(self, manifest: Union[str, None]) -> None:
+        """Compact the log in a new snapshot, at the end of a dump.
+
+        :param manifest: The checksum of the manifest file, or 'None' if it
+            has not been fully applied.
+        """
+        self.close()
+        self.manifest = manifest
+        self.manifest_mode = self.mode if manifest is not None else None
+        self.manifest_rules = self.rules if manifest is not None else None
+        if self.seen_all:  # Forget the entries not in the manifest any more
+            self.entries = {p: c for p, c in self.entries.items() if p in self._seen}
+        data = {
+            "version": JOURNAL_VERSION,
+            "machine": self.machine,
+            "root": self.root,
+            "manifest": self.manifest,
+            "mode": self.manifest_mode,
+            "rules": self.manifest_rules,
+            "entries": self.entries,
+        }
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(data, outfile, ensure_ascii=False, separators=(",", ":"))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if os.path.lexists(self.log_path):
+            os.remove(self.log_path)
+
+    def close(self) -> None:
+        """Close the log, keeping it to resume the dump."""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def dump_mode(force_overwriting: Union[bool, None]) -> int:
+    """Return the strength of the mode of a dump.
+
+    :param force_overwriting: See 'dump_manifest'.
+    :return: 'SOFT_DUMP', 'DUMP' or 'HARD_DUMP'.
+    """
+    if force_overwriting is None:
+        return DUMP
+    return HARD_DUMP if force_overwriting else SOFT_DUMP
+
+
+def default_state_dir() -> str:
+    """Return the directory of the local state of the machine."""
+    state_dir = os.environ.get(properties.STATE_DIR_ENV_VAR) or properties.STATE_DIR
+    return os.path.abspath(os.path.expanduser(state_dir))
+
+
+def node_state_path(root: str, manifest_path: str, state_dir: str = None) -> str:
+    """Return the path, without extension, of the local state files of a node
+    and its manifest.
+
+    :param root: The node path.
+    :param manifest_path: The path of the manifest of the node.
+    :param state_dir: The directory of the local state. By default, see
+        'default_state_dir'.
+    """
+    key = hashlib.blake2b(
+        f"{root}\0{manifest_path}".encode("utf-8", "surrogateescape"),
+        digest_size=16,
+    ).hexdigest()
+    return os.path.join(state_dir or default_state_dir(), key)
+
+
+def file_checksum(path: str) -> str:
+    """Return a checksum of the content of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _tags_checksum(tags: List[str]) -> str:
+    """Return a short checksum of a list of tags."""
+    text = json.dumps(tags, ensure_ascii=False)
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
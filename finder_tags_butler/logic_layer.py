@@ -12,98 +12,229 @@
 
 """Business logic layer."""
 
+import glob
 import os
 import platform
-from typing import Union, List
-
-import yaml
-
-from finder_tags_butler import properties
-from finder_tags_butler.errors import CorruptedManifestFileError
-from finder_tags_butler.logic_tags import (
-    get_finder_tags_for_path,
-    add_finder_tag_for_path,
-    rm_all_finder_tags_for_path,
+import threading
+from functools import partial
+from typing import Iterator, List, Tuple, Union
+
+from finder_tags_butler import logic_stats, properties
+from finder_tags_butler.errors import (
+    CorruptedManifestFileError,
+    TagOperationTimeoutError,
 )
+from finder_tags_butler.logic_backends import TagChange
+from finder_tags_butler.logic_cache import StatCache, stat_cache_path
+from finder_tags_butler.logic_files import node_lock
+from finder_tags_butler.logic_identity import (
+    FingerprintCache,
+    IdentityIndex,
+    build_identity_index,
+    fingerprint_cache_path,
+    remap_moved_entries,
+)
+from finder_tags_butler.logic_ignore import WalkRules
+from finder_tags_butler.logic_journal import DumpJournal, dump_mode, file_checksum
+from finder_tags_butler.logic_manifest import (
+    ManifestReader,
+    ManifestWriter,
+    TagAssociation,
+    load_manifest,
+)
+from finder_tags_butler.logic_paths import relative_path
+from finder_tags_butler.logic_pipeline import (
+    PipelineOptions,
+    Stage,
+    run_inline,
+    run_pipeline,
+)
+from finder_tags_butler.logic_reconcile import count_changes, plan_changes
+from finder_tags_butler.logic_retry import (
+    FailureReport,
+    TagOperationExecutor,
+    failed_paths,
+)
+from finder_tags_butler.logic_shards import (
+    AppliedShards,
+    applied_shards_path,
+    remove_shards,
+    shard_of,
+)
+from finder_tags_butler.logic_subpaths import SubpathFilter
+from finder_tags_butler.logic_walk import (
+    get_tags,
+    iter_batches,
+    iter_children_of_path,
+    iter_children_of_subtrees,
+    merge_entries,
+)
+from finder_tags_butler.logic_workers import WorkerPool, stat_paths
+
+
+def save_manifest(
+    path: str,
+    manifest_path: str,
+    use_cache: bool = True,
+    workers: WorkerPool = None,
+    manifest_format: str = None,
+    compression: str = None,
+    identity: bool = False,
+    shards: int = None,
+    max_depth: int = None,
+    follow_symlinks: bool = False,
+) -> None:
+    """Save a manifest of the given 'path' into the given 'manifest_path'.
 
+    The entries are written while the tree is walked, so the memory used does
+    not depend on the number of tagged files. By default, a stat cache is kept
+    in the local state directory, so only the tags of the paths that have
+    changed since the last save are read, see 'logic_cache'.
 
-class TagAssociation:
-    """Abstraction of a manifest content entry."""
-
-    def __init__(self, path: str, tags: Union[List[str], None]):
-        self.path = path
-        self.tags = tags
-
-    def __lt__(self, other):
-        return self.path.__lt__(other.path)
-
-
-class Manifest:
-    """Abstraction of a manifest."""
-
-    def __init__(self, content: List[TagAssociation] = None):
-        """To load a manifest file, let 'content' set to 'None'."""
-        if content is None:
-            content = []
-        self.content = content
-        self.machine = platform.node()
-
-    def save(self, path: str) -> None:
-        """Save the current manifest object to a 'path''s YAML file.
-
-        Warning: the path should be checked before call this function.
-
-        :param path: The param of the output file.
-        """
-        with open(path, "w") as outfile:
-            outfile.writelines(properties.MANIFEST_HEAD_COMMENT)
-            yaml.dump(self, outfile)
-
-    def load(self, path: str) -> None:
-        """Read a 'path''s YAML file to the current 'Manifest' object.
-
-        Warning: the path should be checked before call this function.
-
-        :param path: The param of the output file.
-        """
-        with open(path, "r") as infile:
-            file_manifest = yaml.load(infile, Loader=yaml.FullLoader)
-            self.content = file_manifest.content
-            self.machine = file_manifest.machine
-
-
-def save_manifest(path: str, manifest_path: str,) -> None:
-    """Save a manifest of the given 'path' into the given 'manifest_path'.
+    The paths excluded by the ignore file of the node are not walked, see
+    'logic_ignore'. The manifest is written atomically, and not replaced if
+    it has not changed. The other saves, dumps and merges of the node on the
+    machine wait for this one to end, see 'logic_files'.
 
     Warning: the paths should be checked before call this function.
 
     :param path: The path to explore.
     :param manifest_path: The path of the output manifest (it would be
         overriding).
+    :param use_cache: Passing this param as 'False', the stat cache is
+        ignored and the tags of all the paths are read.
+    :param workers: A pool to walk the tree and read the tags concurrently. By
+        default, all is done sequentially.
+    :param manifest_format: The format of the manifest: 'stream' (default) or
+        'binary'.
+    :param compression: The compression of a binary manifest: 'None', 'gzip'
+        or 'zstd'.
+    :param identity: Passing this param as 'True', an identity index with the
+        fingerprints of the tagged files is saved next to the manifest, so the
+        dumps can follow the moved files. See 'logic_identity'.
+    :param shards: Split the manifest in this number of shards, so only the
+        changed ones are rewritten and dumped. See 'logic_shards'. By default,
+        a single manifest file is saved.
+    :param max_depth: The maximum depth of the walked paths below the node.
+        By default, no limit.
+    :param follow_symlinks: Passing this param as 'True', the symbolic links
+        to directories are walked.
     """
     # Assert the paths are correct and absolutely
     path = os.path.abspath(os.path.expanduser(path))
     manifest_path = os.path.abspath(os.path.expanduser(manifest_path))
 
-    # Get all the child files and folders recursively
-    children = _get_children_of_path(path)
-
-    # Prepare the content entries after explore the child elements
-    content = []
-    for child in children:
-        tags = get_finder_tags_for_path(child)
-        if not tags == []:
-            content.append(TagAssociation(child, tags))
-
-    # Finally, create the manifest and write it to a file
-    manifest = Manifest(content)
+    with node_lock(path, manifest_path):
+        manifest_dir = os.path.dirname(manifest_path)
+        cache_path = stat_cache_path(path, manifest_path)
+        index_path = os.path.join(manifest_dir, properties.IDENTITY_INDEX_FILE_NAME)
+        with logic_stats.phase("load_cache"):
+            cache = StatCache.load(cache_path) if use_cache else StatCache()
+        cache_entries = {}
+        tagged_stats = {}
+        rules = WalkRules.load(path, max_depth, follow_symlinks)
+
+        # Walk all the child files and folders recursively, by batches. The
+        # children are sorted, so the manifest is deterministic
+        with ManifestWriter(
+            manifest_path,
+            manifest_format=manifest_format,
+            root=path,
+            compression=compression,
+            shards=shards,
+        ) as writer:
+            children_iter = logic_stats.timed_iter(
+                "walk", iter_children_of_path(path, workers, rules=rules)
+            )
+            for children in iter_batches(children_iter, workers):
+                logic_stats.count("paths_walked", len(children))
+
+                # Reuse the cached tags of the unchanged children and read all the
+                # rest at once
+                with logic_stats.phase("stat"):
+                    if workers is None:
+                        stats = stat_paths(children)
+                    else:
+                        stats = workers.stat_many(children)
+                tags_by_child = {}
+                for child, st in stats.items():
+                    tags = cache.lookup(child, st)
+                    if tags is not None:
+                        tags_by_child[child] = tags
+                logic_stats.count("cache_hits", len(tags_by_child))
+                tags_by_child.update(
+                    _get_present_tags(
+                        [c for c in children if c not in tags_by_child], workers
+                    )
+                )
+
+                # Write the content entries of the tagged children. The ones
+                # removed since the walk are left out
+                with logic_stats.phase("write_manifest"):
+                    for child in children:
+                        tags = tags_by_child.get(child)
+                        if tags:
+                            writer.write(TagAssociation(child, tags))
+                if use_cache:
+                    cache_entries.update(
+                        (c, (st, tags_by_child[c]))
+                        for c, st in stats.items()
+                        if c in tags_by_child
+                    )
+                if identity:
+                    tagged_stats.update(
+                        (c, st) for c, st in stats.items() if tags_by_child.get(c)
+                    )
+
+        # The tags of the node match the saved shards. The shards of a previous
+        # save are removed if not asked for
+        applied_path = applied_shards_path(path, manifest_path)
+        if shards is not None:
+            AppliedShards(path, shards, writer.checksums, rules=rules.key).save(
+                applied_path
+            )
+        else:
+            remove_shards(path, manifest_path)
+
+        # Save the cache for the next time
+        if use_cache:
+            with logic_stats.phase("save_cache"):
+                cache.update(cache_entries)
+                cache.save(cache_path)
+
+        # Fingerprint the tagged files. An index of a previous save would not
+        # match the new manifest, so it is removed if not asked for
+        if identity:
+            with logic_stats.phase("identity_index"):
+                fingerprints_path = fingerprint_cache_path(path, manifest_path)
+                if use_cache:
+                    fingerprints = FingerprintCache.load(fingerprints_path)
+                else:
+                    fingerprints = FingerprintCache()
+                build_identity_index(path, tagged_stats, fingerprints).save(index_path)
+                if use_cache:
+                    fingerprints.save(fingerprints_path)
+        elif os.path.lexists(index_path):
+            os.remove(index_path)
 
-    # Save the manifest
-    manifest.save(manifest_path)
+        # The clocks of a previous merge do not match the saved manifest
+        clocks_path = os.path.join(manifest_dir, properties.ENTRY_CLOCKS_FILE_NAME)
+        if os.path.lexists(clocks_path):
+            os.remove(clocks_path)
 
 
 def dump_manifest(
-    manifest_path: str, path: str, force_overwriting: Union[bool, None] = False
+    manifest_path: str,
+    path: str,
+    force_overwriting: Union[bool, None] = False,
+    dry_run: bool = False,
+    workers: WorkerPool = None,
+    only: List[str] = None,
+    max_depth: int = None,
+    follow_symlinks: bool = False,
+    pipeline: PipelineOptions = None,
+    executor: TagOperationExecutor = None,
+    retry_failed: bool = False,
 ) -> [Exception]:
     """Dump a 'manifest_path''s manifest writing tags into the node's 'path'
     location.
@@ -114,6 +245,47 @@ def dump_manifest(
     will be presented. Using the 'force_overwriting' param this behaviour can be
     forced.
 
+    Only the paths whose tags differ from the manifest ones are touched. The
+    entries are applied by batches while the manifest is read, see
+    'iter_dump_changes', so the manifest is never held in memory. Every entry
+    is checked when read, and a batch is only applied once all its entries
+    have passed the check: a corrupted manifest stops the dump at the batch
+    of its first bad entry, and the journal keeps the batches applied before
+    it. If the manifest has an identity index, the entries of the
+    moved files follow them to their new paths, reading the manifest twice.
+
+    Only the shards of a sharded manifest that have changed since they were
+    last applied on this machine, by a dump without errors or a save, are
+    dumped, unless 'force_overwriting' is 'True'. So the tags changed by hand
+    in the paths of the skipped shards are kept.
+
+    In the same way, the entries applied by the previous dumps are recorded
+    in a local journal, see 'logic_journal'. Dumping again the last fully
+    applied manifest does nothing, the entries already applied are skipped,
+    and an interrupted dump resumes from its last applied batch.
+
+    The dump can be limited to some subtrees of the node with 'only'. Then
+    only their entries are read from the manifest and only they are walked,
+    see 'logic_subpaths'. Such a dump is never recorded as a full one.
+
+    The paths excluded by the ignore file of the node are neither walked nor
+    dumped, see 'logic_ignore'. The node is locked while dumped, like in
+    'save_manifest'.
+
+    With a 'pipeline', the batches are checked, compared with the current
+    tags and written by the concurrent stages of a pipeline, see
+    'logic_pipeline', so the next batches are read while one is written.
+    The calls that time out are returned as errors, and their entries are
+    applied again by the next dump. A timed out write starts no other tag
+    operation, but the one in progress can not be interrupted and may still
+    complete after the dump has returned.
+
+    The tags are read and written by a 'TagOperationExecutor', which retries
+    the operations failed by transient errors and returns the rest as
+    errors, see 'logic_retry'. The errors of a dump that is not limited with
+    'only' are kept in the failure report of the node, and a later dump with
+    'retry_failed' applies only their paths again.
+
     Warning: the paths should be checked before call this function.
 
     :param manifest_path: The path of the input manifest.
@@ -123,6 +295,23 @@ def dump_manifest(
         manifest. Passing as 'False', they won't be removed never.
         Letting as 'None', they will be removed if the manifest
         provides from other machine.
+    :param dry_run: Passing this param as 'True', the changes are planned but
+        not applied.
+    :param workers: A pool to walk the tree and read the tags concurrently. By
+        default, all is done sequentially.
+    :param only: The patterns of the subtrees to dump, relative to the node.
+        By default, the whole node is dumped.
+    :param max_depth: See 'save_manifest'.
+    :param follow_symlinks: See 'save_manifest'.
+    :param pipeline: The configuration of the stages of the dump. By
+        default, every batch is processed after the previous one, in the
+        calling thread.
+    :param executor: The executor of the tag operations. By default, one
+        with the default retries and without a rate limit.
+    :param retry_failed: Passing this param as 'True', only the paths of the
+        failure report of the node are dumped, and 'only' is ignored. If
+        some failure has no path or is of the node itself, the whole node is
+        dumped.
     :return: A list of errors of the tags that have not been correctly
         processed.
     :raise: CorruptedManifestFileError, if the manifest file is corrupted.
@@ -130,62 +319,541 @@ def dump_manifest(
     # Assert the paths are correct and absolutely
     manifest_path = os.path.abspath(os.path.expanduser(manifest_path))
     path = os.path.abspath(os.path.expanduser(path))
-
-    # Read the manifest
-    if not _validate_mainifest_file(manifest_path):  # First check integrity
-        raise CorruptedManifestFileError(manifest_path)
-    manifest = Manifest()
-    manifest.load(manifest_path)
-
-    # Get all the child files and folders recursively
-    children = _get_children_of_path(path)
-
-    # First clean all the tags of the node, if it apply
-    if force_overwriting is True or (
-        platform.node() != manifest.machine and force_overwriting is not False
+    with node_lock(path, manifest_path):
+        applied_path = applied_shards_path(path, manifest_path)
+        applied = AppliedShards.load(applied_path, path)
+
+        # Nothing to do if the manifest is the last one fully applied, by a
+        # dump at least as strong and with the same walk rules
+        checksum = file_checksum(manifest_path)
+        mode = dump_mode(force_overwriting)
+        rules = WalkRules.load(path, max_depth, follow_symlinks)
+        journal = DumpJournal.load(path, manifest_path, mode=mode, rules=rules.key)
+        if force_overwriting is not True and journal.is_manifest_applied(checksum):
+            logic_stats.count("manifests_skipped")
+            return []
+
+        # Only the failed paths, if asked for. Nothing to do without failures
+        report = FailureReport.load(path, manifest_path)
+        if retry_failed:
+            failed = report.paths
+            if failed == []:
+                return []
+            only = None
+            if failed is not None and path not in failed:
+                only = [glob.escape(relative_path(p, path)) for p in failed]
+
+        tagging_errors = []
+        if not dry_run:
+            journal.begin()
+        try:
+            plan = _DumpPlan(
+                manifest_path,
+                path,
+                force_overwriting,
+                workers,
+                applied,
+                journal,
+                only,
+                max_depth,
+                follow_symlinks,
+                executor,
+            )
+            stages = _dump_stages(plan, pipeline or PipelineOptions(), dry_run)
+            if pipeline is None:
+                batches = run_inline(plan.batches(), stages)
+            else:
+                batches = run_pipeline(plan.batches(), stages, pipeline.queue_size)
+            for batch in batches:
+                tagging_errors.extend(batch.errors)
+                if not dry_run:
+                    journal.record(
+                        failed_paths(batch.errors, batch.desired), batch.desired
+                    )
+            plan.finish()
+        finally:
+            journal.close()
+        if dry_run:
+            return tagging_errors
+        journal.complete(None if tagging_errors or only else checksum)
+        if retry_failed or not only:
+            report.failures = []
+            report.add(tagging_errors)
+            report.save()
+
+        # Remember the applied shards. With errors, they are all applied again
+        if not tagging_errors and not only:
+            if applied.shards is not None:
+                applied.save(applied_path)
+            elif os.path.lexists(applied_path):
+                os.remove(applied_path)
+        return tagging_errors
+
+
+def plan_dump(
+    manifest_path: str,
+    path: str,
+    force_overwriting: Union[bool, None] = False,
+    workers: WorkerPool = None,
+    only: List[str] = None,
+    max_depth: int = None,
+    follow_symlinks: bool = False,
+) -> ([TagChange], [Exception]):
+    """Compute the minimal tag changes to dump a 'manifest_path''s manifest
+    into the node's 'path' location, without applying them.
+
+    See 'dump_manifest' for the meaning of the params.
+
+    :return: A tuple with the list of changes to apply and the list of errors
+        of the manifest entries that can not be processed.
+    :raise: CorruptedManifestFileError, if the manifest file is corrupted.
+    """
+    # Assert the paths are correct and absolutely
+    manifest_path = os.path.abspath(os.path.expanduser(manifest_path))
+    path = os.path.abspath(os.path.expanduser(path))
+    applied = AppliedShards.load(applied_shards_path(path, manifest_path), path)
+    journal = DumpJournal.load(
+        path,
+        manifest_path,
+        mode=dump_mode(force_overwriting),
+        rules=WalkRules.load(path, max_depth, follow_symlinks).key,
+    )
+    if force_overwriting is not True and journal.is_manifest_applied(
+        file_checksum(manifest_path)
     ):
-        for child in children:
-            rm_all_finder_tags_for_path(child)
+        return [], []
 
-    # Set new tags
+    all_changes = []
     tagging_errors = []
-    try:
-        for child in manifest.content:
-            for tag in child.tags:
-                if os.path.exists(child.path):
-                    add_finder_tag_for_path(child.path, tag)
-                else:
-                    tagging_errors.append(FileNotFoundError(child.path))
-                    continue  # Do not raise exception, the full process must go on
-    except AttributeError:
-        raise CorruptedManifestFileError(manifest_path)
+    for changes, errors in iter_dump_changes(
+        manifest_path,
+        path,
+        force_overwriting,
+        workers,
+        applied,
+        journal,
+        only,
+        max_depth,
+        follow_symlinks,
+    ):
+        all_changes.extend(changes)
+        tagging_errors.extend(errors)
+    return all_changes, tagging_errors
+
+
+def iter_dump_changes(
+    manifest_path: str,
+    path: str,
+    force_overwriting: Union[bool, None] = False,
+    workers: WorkerPool = None,
+    applied: AppliedShards = None,
+    journal: DumpJournal = None,
+    only: List[str] = None,
+    max_depth: int = None,
+    follow_symlinks: bool = False,
+) -> Iterator[Tuple[List[TagChange], List[Exception]]]:
+    """Compute by batches the minimal tag changes to dump a 'manifest_path''s
+    manifest into the node's 'path' location.
+
+    The manifest entries and the node children are both sorted by path, so
+    they are merged while the node is walked, without holding all the children
+    in memory.
+
+    See 'dump_manifest' for the meaning of the rest of the params.
+
+    :param applied: The shards last applied on the node. Only the pending
+        shards of a sharded manifest are read, and the node is only walked
+        under their paths. Once all the changes are computed, it is updated
+        to the shards of the manifest.
+    :param journal: The journal of the node. The entries already applied are
+        skipped, and the 'pending' entries of every batch are set to the ones
+        that its changes apply.
+    :param only: The patterns of the subtrees to dump. Only their entries are
+        read and only they are walked. The applied shards are not updated.
+    :param max_depth: See 'save_manifest'. The entries below are skipped, like
+        the ones excluded by the ignore file.
+    :param follow_symlinks: See 'save_manifest'.
+
+    :return: An iterator of tuples with the list of changes to apply and the
+        list of errors of the manifest entries that can not be processed.
+    :raise: CorruptedManifestFileError, if the manifest file is corrupted.
+    """
+    plan = _DumpPlan(
+        manifest_path,
+        path,
+        force_overwriting,
+        workers,
+        applied,
+        journal,
+        only,
+        max_depth,
+        follow_symlinks,
+    )
+    for batch in plan.batches():
+        batch = plan.diff(plan.check(batch))
+        if journal is not None:
+            journal.pending = batch.desired
+        yield batch.changes, batch.errors
+    plan.finish()
+
+
+class _DumpBatch:
+    """A batch of manifest entries on its way through the steps of a dump."""
+
+    def __init__(
+        self,
+        items: List[Tuple[str, List[str], bool]],
+        desired: dict = None,
+        to_read: List[str] = None,
+        changes: List[TagChange] = None,
+        errors: List[Exception] = None,
+    ):
+        """Build a batch from the results of the steps done so far.
+
+        :param items: The tuples of every path, its tags in the manifest and
+            if it is a child of the node.
+        :param desired: The tags to apply to every reachable path.
+        :param to_read: The reachable paths, whose current tags are needed.
+        :param changes: The changes to apply.
+        :param errors: The errors of the entries that can not be processed.
+        """
+        self.items = items
+        self.desired = desired if desired is not None else {}
+        self.to_read = to_read if to_read is not None else []
+        self.changes = changes if changes is not None else []
+        self.errors = errors if errors is not None else []
+        # Set when the step running over the batch has timed out
+        self.cancelled = threading.Event()
+
+
+class _DumpPlan:
+    """The steps to compute by batches the tag changes of a dump.
+
+    The batches are read from the manifest by 'batches', then 'check' finds
+    their reachable paths, 'diff' compares their tags and 'apply' writes
+    them. Every step returns a new batch, so they can also be run as the
+    stages of a pipeline, see 'logic_pipeline'. The tags are read and
+    written by the 'executor', see 'logic_retry'. See 'iter_dump_changes'
+    for the meaning of the rest of the params.
+    """
 
-    return tagging_errors
+    def __init__(
+        self,
+        manifest_path: str,
+        path: str,
+        force_overwriting: Union[bool, None] = False,
+        workers: WorkerPool = None,
+        applied: AppliedShards = None,
+        journal: DumpJournal = None,
+        only: List[str] = None,
+        max_depth: int = None,
+        follow_symlinks: bool = False,
+        executor: TagOperationExecutor = None,
+    ):
+        # Assert the paths are correct and absolutely
+        manifest_path = os.path.abspath(os.path.expanduser(manifest_path))
+        path = os.path.abspath(os.path.expanduser(path))
+        self.workers = workers
+        self.executor = executor if executor is not None else TagOperationExecutor()
+        self.applied = applied
+        self.journal = journal
+        self.mode = dump_mode(force_overwriting)
+        rules = WalkRules.load(path, max_depth, follow_symlinks)
+        self.rules = rules
+
+        # Check the header of the manifest and select the shards to read, if
+        # it is a sharded one
+        with ManifestReader(manifest_path, path) as reader:
+            machine = reader.machine
+            self.checksums, options = reader.shards, reader.shard_options
+        pending = None
+        if applied is not None:
+            if self.checksums is not None and force_overwriting is not True:
+                pending = applied.pending(
+                    self.checksums, options[0], self.mode, rules.key
+                )
+                logic_stats.count("shards_skipped", len(self.checksums) - len(pending))
+            self.shards = options[0] if self.checksums is not None else None
+        self.pending_shards = pending
+
+        self.skip_applied = journal is not None and force_overwriting is not True
+        subpaths = SubpathFilter(path, only) if only else None
+        self.subpaths = subpaths
+
+        # The entries are read and checked while the batches are built, so a
+        # batch is only applied once all its entries have passed the check.
+        # Limited to some subtrees, only the part of the manifest with their
+        # entries is read and checked
+        entries = _ManifestEntries(manifest_path, path, pending, subpaths)
+
+        # The existence of the entries is checked against the listings of
+        # their directories, so every directory is read once instead of a
+        # stat per entry
+        self.live_tree = _LiveTreeIndex(path)
+
+        # Follow the moved files, if the manifest has an identity index
+        manifest_dir = os.path.dirname(manifest_path)
+        index = IdentityIndex.load(
+            os.path.join(manifest_dir, properties.IDENTITY_INDEX_FILE_NAME), path
+        )
+        if index is not None:
+            with logic_stats.phase("remap_moved"):
+                fingerprints_path = fingerprint_cache_path(path, manifest_path)
+                fingerprints = FingerprintCache.load(fingerprints_path)
+                entries = remap_moved_entries(
+                    entries,
+                    index,
+                    iter_children_of_path(path, workers, rules=rules),
+                    fingerprints,
+                    exists=self.live_tree.exists,
+                )
+                fingerprints.save(fingerprints_path)
+            if subpaths is not None:  # Maybe moved out of the subtrees
+                entries = (e for e in entries if subpaths.matches(e.path))
+        if rules.excludes_paths:
+            entries = (e for e in entries if not rules.excludes(e.path))
+        self.entries = entries
+
+        # The tags not in the manifest are removed, if it apply. Otherwise,
+        # the node does not need to be walked
+        self.overwrite = force_overwriting is True or (
+            platform.node() != machine and force_overwriting is not False
+        )
+        if self.overwrite:
+            keep = None
+            if pending is not None:
+                keep = partial(
+                    _in_shards, root=path, shards=options[0], selected=pending
+                )
+            if subpaths is not None:
+                children = iter_children_of_subtrees(subpaths, workers, rules)
+                if keep is not None:
+                    children = filter(keep, children)
+            else:
+                children = iter_children_of_path(path, workers, keep, rules)
+            self.children = logic_stats.timed_iter("walk", children)
+        else:
+            self.children = iter(())
+
+    def batches(self) -> Iterator[_DumpBatch]:
+        """Merge the manifest entries with the children of the node, by
+        batches, skipping the entries already applied."""
+        batches = iter_batches(merge_entries(self.children, self.entries), self.workers)
+        for items in batches:
+            logic_stats.count("paths_walked", sum(1 for item in items if item[2]))
+            if self.skip_applied:
+                kept = []
+                for item in items:
+                    if item[1] and self.journal.is_applied(item[0], item[1]):
+                        logic_stats.count("entries_skipped")
+                    else:
+                        kept.append(item)
+                items = kept
+            yield _DumpBatch(items)
+
+    def check(self, batch: _DumpBatch) -> _DumpBatch:
+        """Collect the desired tags of the reachable paths of a batch.
+        Unreachable paths are returned as errors, they do not stop the full
+        process."""
+        errors = list(batch.errors)
+        desired = {}
+        to_read = []
+        for child_path, tags, in_tree in batch.items:
+            if in_tree or self.live_tree.exists(child_path):
+                to_read.append(child_path)
+                if tags:
+                    desired[child_path] = tags
+            elif tags:
+                errors.append(FileNotFoundError(child_path))
+        return _DumpBatch(batch.items, desired, to_read, errors=errors)
+
+    def diff(self, batch: _DumpBatch) -> _DumpBatch:
+        """Read all the current tags of a batch at once and compare them with
+        the desired ones. The paths that can not be read are returned as
+        errors."""
+        with logic_stats.phase("read_tags"):
+            current, errors = self.executor.get_many(batch.to_read, self.workers)
+        if logic_stats.get_stats() is not None:
+            logic_stats.count("paths_read", len(current))
+            logic_stats.count("tags_read", sum(len(t) for t in current.values()))
+        with logic_stats.phase("plan"):
+            changes = plan_changes(batch.desired, current, self.overwrite)
+        if logic_stats.get_stats() is not None:
+            paths_changed, added, removed = count_changes(changes)
+            logic_stats.count("paths_changed", paths_changed)
+            logic_stats.count("tags_added", added)
+            logic_stats.count("tags_removed", removed)
+        return _DumpBatch(
+            batch.items, batch.desired, batch.to_read, changes, batch.errors + errors
+        )
+
+    def apply(self, batch: _DumpBatch) -> _DumpBatch:
+        """Apply the changes of a batch, adding the errors of the changes
+        that have not been applied. Nothing more is written once the batch
+        is cancelled."""
+        errors = batch.errors
+        if batch.changes and not batch.cancelled.is_set():
+            with logic_stats.phase("apply_tags"):
+                errors = errors + self.executor.apply_many(
+                    batch.changes, batch.cancelled
+                )
+        return _DumpBatch(
+            batch.items, batch.desired, batch.to_read, batch.changes, errors
+        )
+
+    def finish(self) -> None:
+        """Update the journal and the applied shards, once all the batches
+        have been computed."""
+        if self.journal is not None:
+            self.journal.seen_all = (
+                self.skip_applied
+                and self.pending_shards is None
+                and self.subpaths is None
+            )
+        if self.applied is not None and self.subpaths is None:
+            if self.checksums is None:
+                self.applied.shards, self.applied.checksums = None, {}
+                self.applied.modes = {}
+            else:
+                self.applied.update(
+                    self.checksums, self.shards, self.mode, self.rules.key
+                )
+
+
+def _dump_stages(
+    plan: _DumpPlan, pipeline: PipelineOptions, dry_run: bool
+) -> List[Stage]:
+    """Return the stages of a dump: the existence check, the comparison
+    with the current tags and, unless it is a dry run, the tag writer.
+
+    A timed out call of a stage returns the paths of its batch as errors,
+    and its batch is cancelled, so the call does not start other writes.
+    """
+    timeout = pipeline.timeout
+    stages = [
+        Stage(
+            "check",
+            plan.check,
+            pipeline.check_jobs,
+            timeout,
+            lambda b: _timed_out_batch(
+                b, [i[0] for i in b.items if i[1]], "checking", timeout
+            ),
+        ),
+        Stage(
+            "diff",
+            plan.diff,
+            pipeline.read_jobs,
+            timeout,
+            lambda b: _timed_out_batch(b, list(b.desired), "reading", timeout),
+        ),
+    ]
+    if not dry_run:
+        stages.append(
+            Stage(
+                "write",
+                plan.apply,
+                pipeline.write_jobs,
+                timeout,
+                lambda b: _timed_out_batch(
+                    b, [c.path for c in b.changes], "writing", timeout
+                ),
+            )
+        )
+    return stages
+
+
+def _timed_out_batch(
+    batch: _DumpBatch, paths: List[str], operation: str, timeout: float
+) -> _DumpBatch:
+    """Cancel a timed out batch and return a batch with nothing more to
+    apply, and a timeout error for every one of the given 'paths'."""
+    batch.cancelled.set()
+    errors = batch.errors + [
+        TagOperationTimeoutError(p, operation=operation, timeout=timeout) for p in paths
+    ]
+    return _DumpBatch(batch.items, batch.desired, batch.to_read, errors=errors)
+
+
+class _ManifestEntries:
+    """The entries of a manifest, read from the file again on every
+    iteration, so they are never all held in memory."""
+
+    def __init__(
+        self,
+        path: str,
+        root: str,
+        only_shards: set = None,
+        only: SubpathFilter = None,
+    ):
+        """
+        :param path: The path of the manifest file.
+        :param root: The node path.
+        :param only_shards: See 'ManifestReader'.
+        :param only: See 'ManifestReader'.
+        """
+        self.path = path
+        self.root = root
+        self.only_shards = only_shards
+        self.only = only
 
+    def __iter__(self) -> Iterator[TagAssociation]:
+        with ManifestReader(
+            self.path, self.root, self.only_shards, self.only
+        ) as reader:
+            yield from logic_stats.timed_iter("load_manifest", reader)
 
-def _get_children_of_path(path: str) -> [str]:
-    """Return all the children files and folders recursively.
 
-    Discard hidden files and folders.
+class _LiveTreeIndex:
+    """Index of the names present in the directories of a node.
 
-    :param path: The path of the node directory to explore.
-    :return: A list with the children files and folders paths.
+    Every directory is listed the first time one of its paths is looked up,
+    so checking the existence of many paths is a dictionary lookup for each
+    one instead of a stat. A name missing in the listing is checked with a
+    stat too, as the case insensitive file systems and the ones that
+    normalize the Unicode names find it with other spellings.
     """
-    children = [path]
-    for root, directories, files in os.walk(path):
-        # Disable hidden contents
-        directories[:] = [d for d in directories if not d.startswith(".")]
-        files[:] = [d for d in files if not d.startswith(".")]
-
-        for directory in directories:
-            children.append(os.path.join(root, directory))
-        for file in files:
-            children.append(os.path.join(root, file))
 
-    return children
+    def __init__(self, root: str):
+        self.root = root
+        self._names = {}  # Directory path -> names of its entries
+
+    def exists(self, path: str) -> bool:
+        """Tell if a path exists, without following a final symbolic link."""
+        if path == self.root or not path.startswith(self.root + os.sep):
+            return os.path.lexists(path)  # Out of the node
+        directory, name = os.path.split(path)
+        names = self._names.get(directory)
+        if names is None:
+            try:
+                names = frozenset(os.listdir(directory))
+            except OSError:
+                names = frozenset()
+            self._names[directory] = names
+        return name in names or os.path.lexists(path)
+
+
+def _in_shards(path: str, root: str, shards: int, selected: set) -> bool:
+    """Tell if a path is in one of the selected shards of a node."""
+    return shard_of(path, root, shards) in selected
+
+
+def _get_present_tags(paths: List[str], workers: WorkerPool = None) -> dict:
+    """Read the tags of several paths, leaving out the ones that do not exist
+    anymore. If some path is missing, they are read again one by one."""
+    try:
+        return get_tags(paths, workers)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    tags = {}
+    for path in paths:
+        try:
+            tags.update(get_tags([path]))
+        except (FileNotFoundError, NotADirectoryError):
+            logic_stats.count("paths_vanished")
+    return tags
 
 
-# noinspection PyStatementEffect
 def _validate_mainifest_file(manifest_path: str) -> bool:
     """Check the integrity of a manifest file.
 
@@ -193,16 +861,8 @@ def _validate_mainifest_file(manifest_path: str) -> bool:
     :return: True or false of the manifest is valid or not, respectively.
     """
     try:
-        manifest = Manifest()
-        manifest.load(manifest_path)
-
-        # Check access to all the stuff
-        manifest.machine
-        manifest.content
-        for child in manifest.content:
-            child.path
-            child.tags
-    except AttributeError:
+        load_manifest(manifest_path)
+    except CorruptedManifestFileError:
         return False
 
     return True
@@ -0,0 +1,973 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Manifest abstractions and files.
+
+A manifest file is written as a stream: a YAML document stream with a header
+document and then one document per entry, sorted by path. Every document is
+written in a single line in JSON flow style, which is a subset of YAML, so
+the entries can be written while the node is walked and read one by one,
+without holding the whole manifest in memory. The paths are stored relative
+to the node, so the manifest is valid wherever the node is mounted on every
+machine.
+
+A compact binary format is also available, see 'logic_manifest_binary', and
+the manifest of a very large node can be split in shards, see 'logic_shards'.
+Every manifest file is written atomically, and kept untouched if its content
+has not changed, see 'logic_files'. The format of a manifest file is detected
+when reading it, and the manifests written by the first versions, a single
+YAML document with the full 'Manifest' object, are still readable. All the
+formats are plain data: the stream documents are parsed as JSON and the
+legacy YAML is only composed with the safe loader, so no object is ever
+constructed from a manifest.
+"""
+
+import heapq
+import json
+import os
+import platform
+from array import array
+from contextlib import ExitStack
+from typing import Dict, Iterable, Iterator, List, Union
+
+from finder_tags_butler import logic_stats, properties
+from finder_tags_butler.errors import CorruptedManifestFileError
+from finder_tags_butler.logic_files import AtomicFile, fsync_dir
+from finder_tags_butler.logic_manifest_binary import (
+    MAGIC,
+    BinaryManifestDecoder,
+    BinaryManifestEncoder,
+)
+from finder_tags_butler.logic_paths import absolute_path, relative_path
+from finder_tags_butler.logic_shards import (
+    ShardChecksum,
+    shard_file_path,
+    shard_of,
+)
+from finder_tags_butler.logic_subpaths import SubpathFilter
+
+# Prefix of every document of a stream manifest
+_DOC_START = "--- "
+_DOC_START_BYTES = _DOC_START.encode()
+
+# Below this span of bytes, the entries of a stream are scanned instead of
+# searched
+_SEEK_LINEAR_SPAN = 16 * 1024
+
+# Tags of the legacy manifests
+_MAPPING_TAG = "tag:yaml.org,2002:map"
+_SEQ_TAG = "tag:yaml.org,2002:seq"
+_STR_TAG = "tag:yaml.org,2002:str"
+_LEGACY_MANIFEST_TAG = (
+    "tag:yaml.org,2002:python/object:finder_tags_butler.logic_layer.Manifest"
+)
+_LEGACY_ENTRY_TAG = (
+    "tag:yaml.org,2002:python/object:finder_tags_butler.logic_layer.TagAssociation"
+)
+
+
+class TagAssociation:
+    """Abstraction of a manifest content entry."""
+
+    __slots__ = ("path", "tags")
+
+    def __init__(self, path: str, tags: Union[List[str], None]):
+        self.path = path
+        self.tags = tags
+
+    def __lt__(self, other):
+        return self.path.__lt__(other.path)
+
+
+class ManifestContent:
+    """Compact columnar store of the manifest entries, sorted by path.
+
+    The entries are not kept as objects: the paths, relative to the node, are
+    stored UTF-8 encoded one after another in a single buffer, every tag name
+    is interned once in a tags table and the tags of every entry are stored as
+    integer ids in a flat array. Iterating builds a 'TagAssociation' for every
+    entry on the fly.
+    """
+
+    __slots__ = (
+        "root",
+        "tags_table",
+        "_tag_ids",
+        "_paths",
+        "_path_ends",
+        "_tags",
+        "_tags_ends",
+        "_last_path",
+    )
+
+    def __init__(self, root: str = None, entries: Iterable[TagAssociation] = ()):
+        """
+        :param root: The node path, the entries are stored relative to it. If
+            'None', the paths are stored as they are.
+        :param entries: The initial entries, sorted by path or not.
+        """
+        self.root = root
+        self.tags_table = []
+        self._tag_ids = {}
+        self._paths = bytearray()
+        self._path_ends = array("I")
+        self._tags = array("I")
+        self._tags_ends = array("I")
+        self._last_path = None
+
+        entries = iter(entries)
+        for entry in entries:
+            if self._last_path is not None and entry.path < self._last_path:
+                # Unsorted entries, so sort all of them and start again
+                unsorted = list(self)
+                unsorted.append(entry)
+                unsorted.extend(entries)
+                self.__init__(root, sorted(unsorted))
+                return
+            self.append(entry.path, entry.tags)
+
+    def append(self, path: str, tags: [str]) -> None:
+        """Append an entry, after all the present ones.
+
+        :param path: The absolute path of the entry.
+        :param tags: The tags of the entry.
+        :raise ValueError: If the path sorts before the last entry.
+        """
+        if self._last_path is not None and path < self._last_path:
+            raise ValueError("The manifest entries must be appended sorted by path")
+        self._last_path = path
+
+        self._paths += relative_path(path, self.root).encode()
+        self._path_ends.append(len(self._paths))
+        for tag in tags:
+            tag_id = self._tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self._tag_ids[tag] = len(self.tags_table)
+                self.tags_table.append(tag)
+            self._tags.append(tag_id)
+        self._tags_ends.append(len(self._tags))
+
+    def __len__(self) -> int:
+        return len(self._path_ends)
+
+    def __getitem__(self, index: int) -> TagAssociation:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("manifest entry index out of range")
+        path_start = self._path_ends[index - 1] if index else 0
+        tags_start = self._tags_ends[index - 1] if index else 0
+        return self._entry(
+            path_start, self._path_ends[index], tags_start, self._tags_ends[index]
+        )
+
+    def __iter__(self) -> Iterator[TagAssociation]:
+        path_start = 0
+        tags_start = 0
+        for path_end, tags_end in zip(self._path_ends, self._tags_ends):
+            yield self._entry(path_start, path_end, tags_start, tags_end)
+            path_start = path_end
+            tags_start = tags_end
+
+    def nbytes(self) -> int:
+        """Return the approximate memory used by the stored entries."""
+        return (
+            len(self._paths)
+            + self._path_ends.itemsize * len(self._path_ends)
+            + self._tags.itemsize * len(self._tags)
+            + self._tags_ends.itemsize * len(self._tags_ends)
+            + sum(len(t) for t in self.tags_table)
+        )
+
+    def _entry(self, path_start, path_end, tags_start, tags_end) -> TagAssociation:
+        path = self._paths[path_start:path_end].decode()
+        table = self.tags_table
+        return TagAssociation(
+            absolute_path(path, self.root),
+            [table[i] for i in self._tags[tags_start:tags_end]],
+        )
+
+
+class Manifest:
+    """Abstraction of a manifest."""
+
+    def __init__(self, content: Iterable[TagAssociation] = None, root: str = None):
+        """To load a manifest file, let 'content' set to 'None'.
+
+        The content is kept in a compact 'ManifestContent' store, relative to
+        the 'root' node path, if given.
+        """
+        if content is None:
+            content = []
+        self.content = ManifestContent(root, content)
+        self.machine = platform.node()
+
+    def save(
+        self, path: str, manifest_format: str = None, compression: str = None
+    ) -> None:
+        """Save the current manifest object to a 'path''s manifest file.
+
+        Warning: the path should be checked before call this function.
+
+        :param path: The param of the output file.
+        :param manifest_format: The format of the file, see 'ManifestWriter'.
+        :param compression: The compression of the file, see 'ManifestWriter'.
+        """
+        with ManifestWriter(
+            path, self.machine, manifest_format, compression=compression
+        ) as writer:
+            for entry in self.content:
+                writer.write(entry)
+
+    def load(
+        self,
+        path: str,
+        root: str = None,
+        only_shards: set = None,
+        only: SubpathFilter = None,
+    ) -> None:
+        """Read a 'path''s manifest file to the current 'Manifest' object.
+
+        The file is parsed only once, checking its structure at the same time.
+
+        Warning: the path should be checked before call this function.
+
+        :param path: The param of the output file.
+        :param root: The node path, for the formats that store relative paths.
+            By default, the directory of the manifest.
+        :param only_shards: For a sharded manifest, read only these shards. By
+            default, all of them.
+        :param only: Read only the entries of these subtrees, see
+            'ManifestReader'. By default, all of them.
+        :raise: CorruptedManifestFileError, if the manifest file is corrupted,
+            locating the first bad entry.
+        """
+        with ManifestReader(path, root, only_shards, only) as reader:
+            self.content = ManifestContent(reader.root, reader)
+            self.machine = reader.machine
+
+
+def load_manifest(
+    path: str, root: str = None, only_shards: set = None, only: SubpathFilter = None
+) -> Manifest:
+    """Read and validate a manifest file in a single pass.
+
+    :param path: The path of the manifest file.
+    :param root: The node path, for the formats that store relative paths.
+        By default, the directory of the manifest.
+    :param only_shards: For a sharded manifest, read only these shards. By
+        default, all of them.
+    :param only: Read only the entries of these subtrees, see
+        'ManifestReader'. By default, all of them.
+    :raise: CorruptedManifestFileError, if the manifest file is corrupted,
+        locating the first bad entry.
+    :return: The validated manifest, with its content sorted by path.
+    """
+    manifest = Manifest()
+    manifest.load(path, root, only_shards, only)
+    return manifest
+
+
+class ManifestWriter:
+    """Write a manifest file entry by entry.
+
+    The entries must be written sorted by path.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        machine: str = None,
+        manifest_format: str = None,
+        root: str = None,
+        compression: str = None,
+        shards: int = None,
+        atomic: bool = True,
+    ):
+        """
+        :param path: The path of the output file.
+        :param machine: The machine name to store. By default, the current one.
+        :param manifest_format: 'stream' or 'binary'. By default, 'stream'.
+        :param root: The node path, for the formats that store relative paths.
+            By default, the directory of the manifest.
+        :param compression: 'None', 'gzip' or 'zstd', only for the 'binary'
+            format.
+        :param shards: Split the entries in this number of shards, written in
+            the given format, and write the root index of the shards to
+            'path'. Only the shards whose entries have changed are replaced.
+            By default, a single file is written.
+        :param atomic: Write to a temporary file, renamed over 'path' once
+            completed and only if the content has changed. Passing this param
+            as 'False', 'path' is written directly, but also flushed to the
+            disk.
+        """
+        if manifest_format is None:
+            manifest_format = properties.MANIFEST_FORMATS[0]
+        if manifest_format not in properties.MANIFEST_FORMATS:
+            raise ValueError(f"Unknown manifest format '{manifest_format}'")
+        if compression is not None and manifest_format != "binary":
+            raise ValueError("Only binary manifests can be compressed")
+        if shards is not None and shards < 1:
+            raise ValueError("The number of shards must be positive")
+
+        self.path = path
+        self.machine = machine if machine is not None else platform.node()
+        self.manifest_format = manifest_format
+        self.root = root if root is not None else os.path.dirname(path)
+        self.compression = compression
+        self.shards = shards
+        self.atomic = atomic
+        self.changed = None  # If the file has been replaced, once written
+        self.checksums = None  # Of the shards, once written
+        self._file = None
+        self._encoder = None
+        self._shard_writers = None
+        self._shard_checksums = None
+        self._stack = None
+
+    def __enter__(self):
+        if self.shards is not None:
+            self._shard_writers = {}
+            self._shard_checksums = {}
+            self._stack = ExitStack()
+            os.makedirs(os.path.dirname(shard_file_path(self.path, 0)), exist_ok=True)
+            return self
+        self._file = self._open(self.path)
+        try:
+            if self.manifest_format == "binary":
+                self._encoder = BinaryManifestEncoder(
+                    self._file, self.machine, self.root, self.compression
+                )
+            else:
+                self._file.write(properties.MANIFEST_HEAD_COMMENT.encode())
+                self._write_doc(
+                    {
+                        "format": properties.MANIFEST_STREAM_FORMAT,
+                        "version": properties.MANIFEST_STREAM_VERSION,
+                        "machine": self.machine,
+                    }
+                )
+        except BaseException as e:
+            self._file.__exit__(type(e), e, e.__traceback__)
+            raise
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.shards is not None:
+            self._close_shards(exc_type, *args)
+            return
+        try:
+            if self._encoder is not None and exc_type is None:
+                self._encoder.close()
+        except BaseException as e:
+            self._file.__exit__(type(e), e, e.__traceback__)
+            raise
+        self._file.__exit__(exc_type, *args)
+        self._count_written(self._file)
+
+    def _open(self, path: str):
+        """Open a file to write, atomically or not."""
+        if self.atomic:
+            return AtomicFile(path).__enter__()
+        return _SyncedFile(path).__enter__()
+
+    def _count_written(self, outfile) -> None:
+        """Count the bytes written to a manifest file, or the write
+        skipped."""
+        if isinstance(outfile, AtomicFile):
+            self.changed = outfile.changed
+        else:
+            self.changed = True
+        if logic_stats.get_stats() is None:
+            return
+        if self.changed:
+            logic_stats.count("manifest_bytes_written", outfile.size)
+        else:
+            logic_stats.count("manifest_writes_skipped")
+
+    def write(self, entry: TagAssociation) -> None:
+        """Append an entry to the manifest file.
+
+        :param entry: The entry to write.
+        """
+        if self._shard_writers is not None:
+            self._write_shard(entry)
+        elif self._encoder is not None:
+            self._encoder.write(entry.path, entry.tags)
+        else:
+            path = relative_path(entry.path, self.root)
+            self._write_doc({"path": path, "tags": entry.tags})
+
+    def _write_doc(self, doc: dict) -> None:
+        line = _DOC_START + json.dumps(doc, ensure_ascii=False) + "\n"
+        self._file.write(line.encode())
+
+    def _write_shard(self, entry: TagAssociation) -> None:
+        """Append an entry to a temporary file of its shard."""
+        shard = shard_of(entry.path, self.root, self.shards)
+        writer = self._shard_writers.get(shard)
+        if writer is None:
+            writer = self._stack.enter_context(
+                ManifestWriter(
+                    shard_file_path(self.path, shard) + ".tmp",
+                    self.machine,
+                    self.manifest_format,
+                    self.root,
+                    self.compression,
+                    atomic=False,  # Replaced once all of them are written
+                )
+            )
+            self._shard_writers[shard] = writer
+            self._shard_checksums[shard] = ShardChecksum()
+        writer.write(entry)
+        self._shard_checksums[shard].update(
+            relative_path(entry.path, self.root), entry.tags
+        )
+
+    def _close_shards(self, exc_type, *args) -> None:
+        """Close the temporary files of the shards, replace the changed ones
+        and write the root index."""
+        tmp_paths = [w.path for w in self._shard_writers.values()]
+        try:
+            self._stack.__exit__(exc_type, *args)
+        finally:
+            if exc_type is not None:
+                for tmp_path in tmp_paths:
+                    if os.path.lexists(tmp_path):
+                        os.remove(tmp_path)
+        if exc_type is not None:
+            return
+
+        previous = _previous_shards(
+            self.path,
+            self.root,
+            (self.shards, self.manifest_format, self.compression),
+        )
+        self.checksums = {
+            s: c.hexdigest() for s, c in sorted(self._shard_checksums.items())
+        }
+        for shard, checksum in self.checksums.items():
+            shard_path = shard_file_path(self.path, shard)
+            if previous.get(shard) == checksum and os.path.isfile(shard_path):
+                os.remove(f"{shard_path}.tmp")  # Unchanged, keep the old file
+            else:
+                os.replace(f"{shard_path}.tmp", shard_path)
+        for shard in set(previous).difference(self.checksums):
+            shard_path = shard_file_path(self.path, shard)
+            if os.path.lexists(shard_path):
+                os.remove(shard_path)
+        fsync_dir(os.path.dirname(shard_file_path(self.path, 0)))
+
+        with AtomicFile(self.path) as self._file:
+            self._file.write(properties.MANIFEST_HEAD_COMMENT.encode())
+            self._write_doc(
+                {
+                    "format": properties.MANIFEST_SHARDS_FORMAT,
+                    "version": properties.MANIFEST_SHARDS_VERSION,
+                    "machine": self.machine,
+                    "shards": self.shards,
+                    "manifest_format": self.manifest_format,
+                    "compression": self.compression,
+                }
+            )
+            for shard, checksum in self.checksums.items():
+                self._write_doc(
+                    {
+                        "shard": shard,
+                        "checksum": checksum,
+                        "entries": self._shard_checksums[shard].entries,
+                    }
+                )
+        self._count_written(self._file)
+
+
+class _SyncedFile:
+    """A binary file flushed to the disk once written, like 'AtomicFile' but
+    written in place."""
+
+    def __init__(self, path: str):
+        self.path = self.name = path
+        self.size = 0
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "wb")
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        return self._file.write(data)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+
+def _seek_entry(infile, size: int, prefix: str, fail) -> int:
+    """Find the offset of the first entry of a stream file from which all the
+    entries with a path starting by 'prefix' follow, by a binary search.
+
+    :param infile: The binary file object.
+    :param size: The size of the file.
+    :param prefix: The prefix of the stored paths.
+    :param fail: The function to raise an error with a reason.
+    :return: The offset of a line. All the entries before it have a path
+        lower than the prefix.
+    """
+    low, high = 0, size
+    while high - low > _SEEK_LINEAR_SPAN:
+        middle = (low + high) // 2
+        infile.seek(middle)
+        infile.readline()  # Go to the start of the next line
+        for line in infile:
+            doc = _parse_entry_line(line, fail)
+            path = doc.get("path") if isinstance(doc, dict) else None
+            if isinstance(path, str):
+                break
+        else:
+            path = None
+        if path is None or path >= prefix:
+            high = middle
+        else:
+            low = infile.tell()
+    return low
+
+
+def _is_header(doc) -> bool:
+    """Tell if a document of a stream is its header."""
+    return isinstance(doc, dict) and "format" in doc and "path" not in doc
+
+
+def _parse_entry_line(line: bytes, fail) -> Union[dict, None]:
+    """Parse a line of a stream file read in binary mode.
+
+    :return: The document, or 'None' if the line is not a document.
+    """
+    if not line.startswith(_DOC_START_BYTES):
+        if line.strip() and not line.startswith(b"#"):
+            fail("not a manifest entry")
+        return None
+    try:
+        return json.loads(line[len(_DOC_START_BYTES) :].decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        fail(str(e))
+
+
+def _previous_shards(path: str, root: str, options: tuple) -> Dict[int, str]:
+    """Return the checksums of the shards of a manifest file, if it is a
+    sharded one with the given number of shards, format and compression."""
+    try:
+        with ManifestReader(path, root) as reader:
+            if reader.shards is not None and reader.shard_options == options:
+                return reader.shards
+    except (OSError, CorruptedManifestFileError):
+        pass
+    return {}
+
+
+def _check_shard(reader: "ManifestReader", checksum: str) -> Iterator[TagAssociation]:
+    """Iterate the entries of a shard, checking them against its checksum.
+
+    :raise: CorruptedManifestFileError, if the shard does not match, once all
+        its entries have been read.
+    """
+    digest = ShardChecksum()
+    for entry in reader:
+        digest.update(relative_path(entry.path, reader.root), entry.tags)
+        yield entry
+    if digest.hexdigest() != checksum:
+        raise CorruptedManifestFileError(
+            reader.path, reason="the shard does not match the manifest"
+        )
+
+
+class ManifestReader:
+    """Read a manifest file entry by entry.
+
+    The format of the file is detected automatically. The 'machine' attribute
+    is available just after opening the reader, and iterating over it yields
+    the entries sorted by path.
+
+    For a sharded manifest, the 'shards' attribute is also available just
+    after opening the reader, with the checksum of every shard, and the
+    entries of all the shards, or the selected ones, are merged while read.
+
+    The entries can be limited to some subtrees of the node. Then only the
+    parts of the file that can hold them are read and checked: the entries of
+    a stream are found by a binary search over the file offsets, the reading
+    of a binary file stops after the last match and only the shards of their
+    top level entries are read.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        root: str = None,
+        only_shards: set = None,
+        only: SubpathFilter = None,
+    ):
+        """
+        :param path: The path of the input file.
+        :param root: The node path, for the formats that store relative paths.
+            By default, the directory of the manifest.
+        :param only_shards: For a sharded manifest, read only these shards. By
+            default, all of them.
+        :param only: Read only the entries of these subtrees. By default, all
+            of them.
+        """
+        self.path = path
+        self.root = root if root is not None else os.path.dirname(path)
+        self.only_shards = only_shards
+        self.only = only
+        self.machine = None
+        self.shards = None  # Shard -> checksum, for a sharded manifest
+        self.shard_options = None  # Number of shards, format and compression
+        self._file = None
+        self._decoder = None
+        self._legacy_content = None
+        self._line_no = 0
+
+    def __enter__(self):
+        self._file = open(self.path, "rb")
+        try:
+            if self._file.read(len(MAGIC)) == MAGIC:
+                self._decoder = BinaryManifestDecoder(self._file, self.root, self.path)
+                self.machine = self._decoder.machine
+            else:
+                self._file.close()
+                self._file = open(self.path, "r", encoding="utf-8")
+                self._open()
+        except BaseException:
+            self._file.close()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+    def __iter__(self) -> Iterator[TagAssociation]:
+        if self.only is not None and self._is_plain_stream():
+            yield from self._iter_subtrees()
+            return
+        if logic_stats.get_stats() is not None:
+            logic_stats.count(
+                "manifest_bytes_read", os.fstat(self._file.fileno()).st_size
+            )
+        if self.shards is not None:
+            yield from self._iter_shards()
+            return
+        if self._legacy_content is not None:
+            yield from self._filter(self._legacy_content)
+            return
+        if self._decoder is not None:
+            entries = (TagAssociation(p, t) for p, t in self._decoder)
+            yield from self._filter(entries)
+            return
+
+        last_path = None
+        for doc in self._iter_docs():
+            entry = self._entry(doc, last_path, self._raise)
+            last_path = entry.path
+            yield entry
+
+    def _entry(self, doc, last_path: Union[str, None], fail) -> TagAssociation:
+        """Check a document of a stream and build its entry.
+
+        :param doc: The parsed document.
+        :param last_path: The path of the previous entry, if any.
+        :param fail: The function to raise an error with a reason.
+        """
+        if not isinstance(doc, dict) or set(doc) != {"path", "tags"}:
+            fail("an entry must have only a 'path' and 'tags'")
+        entry = TagAssociation(doc["path"], doc["tags"])
+        if not isinstance(entry.path, str):
+            fail("the entry 'path' must be a string")
+        entry.path = absolute_path(entry.path, self.root)
+        if not isinstance(entry.tags, list) or not all(
+            isinstance(t, str) for t in entry.tags
+        ):
+            fail("the entry 'tags' must be a list of strings")
+        if last_path is not None and entry.path < last_path:
+            fail("the entries are not sorted by path")
+        return entry
+
+    def _filter(self, entries: Iterable[TagAssociation]) -> Iterator[TagAssociation]:
+        """Yield only the sorted entries of the selected subtrees, stopping
+        after the last one that can match."""
+        if self.only is None:
+            yield from entries
+            return
+        last_prefix = absolute_path(self.only.prefixes[-1], self.root)
+        for entry in entries:
+            if entry.path > last_prefix and not entry.path.startswith(last_prefix):
+                return
+            if self.only.matches(entry.path):
+                yield entry
+
+    def _iter_subtrees(self) -> Iterator[TagAssociation]:
+        """Yield the entries of the selected subtrees of a stream, reading
+        only the ranges of the file that can hold them."""
+
+        def fail(reason: str) -> None:
+            raise CorruptedManifestFileError(self.path, reason=reason)
+
+        bytes_read = 0
+        with open(self.path, "rb") as infile:
+            size = os.fstat(infile.fileno()).st_size
+            last_path = None
+            for prefix in self.only.prefixes:
+                infile.seek(_seek_entry(infile, size, prefix, fail))
+                for line in infile:
+                    bytes_read += len(line)
+                    doc = _parse_entry_line(line, fail)
+                    if doc is None or _is_header(doc):
+                        continue
+                    path = doc.get("path") if isinstance(doc, dict) else None
+                    if isinstance(path, str) and not path.startswith(prefix):
+                        if path > prefix:
+                            break
+                        continue
+                    entry = self._entry(doc, last_path, fail)
+                    last_path = entry.path
+                    if self.only.matches(entry.path):
+                        yield entry
+        logic_stats.count("manifest_bytes_read", bytes_read)
+
+    def _is_plain_stream(self) -> bool:
+        """Tell if the file is a stream manifest, not sharded or legacy."""
+        return (
+            self.shards is None
+            and self._legacy_content is None
+            and self._decoder is None
+        )
+
+    def _raise(self, reason: str, column: int = None) -> None:
+        """Raise a 'CorruptedManifestFileError' at the current line."""
+        if column is None:
+            column = len(_DOC_START) + 1
+        raise CorruptedManifestFileError(
+            self.path, reason=reason, line=self._line_no, column=column
+        )
+
+    def _open(self) -> None:
+        """Detect the format of a text file and read its header."""
+        try:
+            header = self._read_header()
+        except UnicodeDecodeError:
+            header = None
+
+        if header is None:  # Not a stream, so it should be a legacy manifest
+            self._read_legacy()
+        elif header.get("format") == properties.MANIFEST_SHARDS_FORMAT:
+            self._read_shard_index(header)
+        elif (
+            header.get("format") != properties.MANIFEST_STREAM_FORMAT
+            or header.get("version") != properties.MANIFEST_STREAM_VERSION
+            or not isinstance(header.get("machine"), str)
+        ):
+            self._raise("unknown manifest header")
+        else:
+            self.machine = header["machine"]
+
+    def _read_shard_index(self, header: dict) -> None:
+        """Read the root index of a sharded manifest, after its header."""
+        shards = header.get("shards")
+        manifest_format = header.get("manifest_format")
+        compression = header.get("compression")
+        if (
+            header.get("version") != properties.MANIFEST_SHARDS_VERSION
+            or not isinstance(header.get("machine"), str)
+            or not isinstance(shards, int)
+            or shards < 1
+            or manifest_format not in properties.MANIFEST_FORMATS
+            or compression not in (None,) + properties.MANIFEST_COMPRESSIONS
+        ):
+            self._raise("unknown manifest header")
+        self.machine = header["machine"]
+        self.shard_options = (shards, manifest_format, compression)
+
+        self.shards = {}
+        for doc in self._iter_docs():
+            if (
+                not isinstance(doc, dict)
+                or set(doc) != {"shard", "checksum", "entries"}
+                or not isinstance(doc["shard"], int)
+                or not 0 <= doc["shard"] < shards
+                or doc["shard"] in self.shards
+                or not isinstance(doc["checksum"], str)
+            ):
+                self._raise("not a shard of the manifest")
+            self.shards[doc["shard"]] = doc["checksum"]
+
+    def _iter_docs(self) -> Iterator:
+        """Iterate the documents of a stream, after its header."""
+        for line in self._file:
+            self._line_no += 1
+            if not line.startswith(_DOC_START):
+                if line.strip() and not line.startswith("#"):
+                    self._raise("not a manifest entry", 1)
+                continue
+            try:
+                yield json.loads(line[len(_DOC_START) :])
+            except json.JSONDecodeError as e:
+                self._raise(e.msg, len(_DOC_START) + e.colno)
+
+    def _iter_shards(self) -> Iterator[TagAssociation]:
+        """Merge the entries of the selected shards, checking their
+        checksums."""
+        shards = set(self.shards)
+        if self.only_shards is not None:
+            shards.intersection_update(self.only_shards)
+        if self.only is not None and self.root not in self.only.subtrees:
+            # The shards are split by the top level entry of the paths
+            shards.intersection_update(
+                shard_of(p, self.root, self.shard_options[0])
+                for p in self.only.subtrees
+            )
+        with ExitStack() as stack:
+            iterators = []
+            for shard in sorted(shards):
+                shard_path = shard_file_path(self.path, shard)
+                try:
+                    reader = stack.enter_context(
+                        ManifestReader(shard_path, self.root, only=self.only)
+                    )
+                except FileNotFoundError:
+                    raise CorruptedManifestFileError(
+                        self.path, reason=f"the shard '{shard_path}' is missing"
+                    )
+                if reader.shards is not None:
+                    raise CorruptedManifestFileError(
+                        shard_path, reason="a shard can not be sharded"
+                    )
+                if self.only is not None:  # Partially read, it can not be checked
+                    iterators.append(iter(reader))
+                else:
+                    iterators.append(_check_shard(reader, self.shards[shard]))
+            yield from heapq.merge(*iterators)
+
+    def _read_header(self) -> Union[dict, None]:
+        """Read the header document of a stream manifest.
+
+        :return: The header or 'None' if the file is not a stream.
+        """
+        for line in self._file:
+            self._line_no += 1
+            if not line.strip() or line.startswith("#"):
+                continue
+            if not line.startswith(_DOC_START + "{"):
+                return None
+            try:
+                header = json.loads(line[len(_DOC_START) :])
+            except json.JSONDecodeError as e:
+                self._raise(e.msg, len(_DOC_START) + e.colno)
+            return header if isinstance(header, dict) else None
+        return None
+
+    def _read_legacy(self) -> None:
+        """Read a legacy manifest, a single YAML document with the full
+        'Manifest' object.
+
+        The document is only composed, never constructed, so its Python object
+        tags can not build arbitrary objects: the structure is checked and the
+        entries are built from the composed nodes. 'yaml' is only imported
+        here, as the current manifests do not need it.
+        """
+        import yaml
+
+        # Use the 'libyaml' bindings, if available
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        self._file.seek(0)
+        try:
+            root = yaml.compose(self._file, Loader=loader)
+        except yaml.MarkedYAMLError as e:
+            mark = e.problem_mark or e.context_mark
+            raise CorruptedManifestFileError(
+                self.path,
+                reason=e.problem,
+                line=mark.line + 1 if mark else None,
+                column=mark.column + 1 if mark else None,
+            )
+        except (yaml.YAMLError, ValueError):  # Also decoding errors
+            raise CorruptedManifestFileError(self.path, reason="not a manifest")
+
+        fields = self._legacy_mapping(
+            root, _LEGACY_MANIFEST_TAG, {"content", "machine"}
+        )
+        self.machine = self._legacy_str(fields["machine"])
+        self._legacy_list(fields["content"], "content")
+
+        content = []
+        for node in fields["content"].value:
+            entry = self._legacy_mapping(node, _LEGACY_ENTRY_TAG, {"path", "tags"})
+            self._legacy_list(entry["tags"], "tags")
+            content.append(
+                TagAssociation(
+                    self._legacy_str(entry["path"]),
+                    [self._legacy_str(t) for t in entry["tags"].value],
+                )
+            )
+        self._legacy_content = sorted(content)
+
+    def _legacy_mapping(self, node, tag: str, keys: set) -> dict:
+        """Check that a node is a mapping, plain or with the given Python object
+        tag, with the given string keys.
+
+        :return: A dict with the value node of every key.
+        """
+        import yaml
+
+        if node is None or not isinstance(node, yaml.MappingNode):
+            self._raise_at(node, "not a manifest")
+        if node.tag not in (tag, _MAPPING_TAG):
+            self._raise_at(node, f"unexpected tag '{node.tag}'")
+        fields = {}
+        for key_node, value_node in node.value:
+            key = self._legacy_str(key_node)
+            if key not in keys:
+                self._raise_at(key_node, f"unexpected key '{key}'")
+            fields[key] = value_node
+        for key in keys.difference(fields):
+            self._raise_at(node, f"missing key '{key}'")
+        return fields
+
+    def _legacy_list(self, node, name: str) -> None:
+        """Check that a node is a plain list."""
+        import yaml
+
+        if not isinstance(node, yaml.SequenceNode) or node.tag != _SEQ_TAG:
+            self._raise_at(node, f"the '{name}' must be a list")
+
+    def _legacy_str(self, node) -> str:
+        """Check that a node is a string scalar and return its value."""
+        import yaml
+
+        if not isinstance(node, yaml.ScalarNode) or node.tag != _STR_TAG:
+            self._raise_at(node, "a string was expected")
+        return node.value
+
+    def _raise_at(self, node, reason: str) -> None:
+        """Raise a 'CorruptedManifestFileError' at the position of a node."""
+        mark = node.start_mark if node is not None else None
+        raise CorruptedManifestFileError(
+            self.path,
+            reason=reason,
+            line=mark.line + 1 if mark else None,
+            column=mark.column + 1 if mark else None,
+        )
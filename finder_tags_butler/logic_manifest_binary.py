@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Binary manifest format.
+
+A compact alternative to the manifest stream. The file starts with a header:
+
+    - The magic bytes 'FTBM'.
+    - A byte with the format version.
+    - A byte with the compression of the rest of the file: none, gzip or
+        zstd.
+
+Then, all the integers are unsigned LEB128 varints and all the strings are
+UTF-8 bytes prefixed by their length:
+
+    - The machine name.
+    - Every entry, sorted by path, as a '1' followed by:
+        - The length of the prefix shared with the path of the previous entry
+            and the rest of the path. Paths are relative to the node.
+        - The number of tags and their ids. The first time a tag appears, its
+            id is the next one of the tags table and is followed by its name,
+            so every tag name is stored only once.
+    - A '0' as end mark, so truncated files are detected.
+"""
+
+import gzip
+from typing import Iterator, Union
+
+from finder_tags_butler.errors import CorruptedManifestFileError
+from finder_tags_butler.logic_paths import absolute_path, relative_path
+
+MAGIC = b"FTBM"
+VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_GZIP = 1
+COMPRESSION_ZSTD = 2
+COMPRESSIONS = {
+    None: COMPRESSION_NONE,
+    "gzip": COMPRESSION_GZIP,
+    "zstd": COMPRESSION_ZSTD,
+}
+
+_READ_SIZE = 64 * 1024
+
+
+class BinaryManifestEncoder:
+    """Encode manifest entries into a binary file object."""
+
+    def __init__(self, outfile, machine: str, root: str, compression: str = None):
+        """
+        :param outfile: The binary file object to write to.
+        :param machine: The machine name to store.
+        :param root: The node path, the entries are stored relative to it.
+        :param compression: 'None', 'gzip' or 'zstd'.
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown manifest compression '{compression}'")
+        outfile.write(MAGIC + bytes([VERSION, COMPRESSIONS[compression]]))
+        self._raw_file = outfile
+        self._file = _compressor(outfile, compression)
+        self._root = root
+        self._buffer = bytearray()
+        self._last_path = b""
+        self._tag_ids = {}
+        _put_bytes(self._buffer, machine.encode())
+
+    def write(self, path: str, tags: [str]) -> None:
+        """Append an entry.
+
+        :param path: The absolute path of the entry.
+        :param tags: The tags of the entry.
+        """
+        buffer = self._buffer
+        path = relative_path(path, self._root).encode()
+        shared = _shared_prefix_len(self._last_path, path)
+        buffer.append(1)
+        _put_varint(buffer, shared)
+        _put_bytes(buffer, path[shared:])
+        self._last_path = path
+
+        _put_varint(buffer, len(tags))
+        for tag in tags:
+            tag_id = self._tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self._tag_ids[tag] = len(self._tag_ids)
+                _put_varint(buffer, tag_id)
+                _put_bytes(buffer, tag.encode())
+            else:
+                _put_varint(buffer, tag_id)
+
+        if len(buffer) >= _READ_SIZE:
+            self._flush()
+
+    def close(self) -> None:
+        """Write the end mark and flush all the pending data."""
+        self._buffer.append(0)
+        self._flush()
+        if self._file is not self._raw_file:
+            self._file.close()
+
+    def _flush(self) -> None:
+        self._file.write(self._buffer)
+        self._buffer.clear()
+
+
+class BinaryManifestDecoder:
+    """Decode the manifest entries of a binary file object."""
+
+    def __init__(self, infile, root: str, path: str):
+        """
+        :param infile: The binary file object to read from, positioned just
+            after the magic bytes.
+        :param root: The node path, the entries are resolved from it.
+        :param path: The path of the file, to report errors.
+        :raise: CorruptedManifestFileError, if the header is corrupted.
+        """
+        self._path = path
+        self._root = root
+        header = infile.read(2)
+        if len(header) != 2 or header[0] != VERSION:
+            raise CorruptedManifestFileError(path, reason="unknown binary version")
+        try:
+            self._reader = _ByteReader(_decompressor(infile, header[1]))
+            self.machine = self._reader.read_bytes().decode()
+        except (EOFError, OSError, ValueError):  # Also decoding errors
+            raise CorruptedManifestFileError(path, reason="bad binary header")
+
+    def __iter__(self) -> Iterator[tuple]:
+        """Iterate the '(path, tags)' of the entries.
+
+        :raise: CorruptedManifestFileError, if the file is corrupted.
+        """
+        reader = self._reader
+        tags_table = []
+        last_path = b""
+        entry_no = 1
+        try:
+            while reader.read_varint():
+                shared = reader.read_varint()
+                if shared > len(last_path):
+                    raise ValueError
+                path = last_path[:shared] + reader.read_bytes()
+                if path < last_path:
+                    raise ValueError
+                last_path = path
+
+                tags = []
+                for _ in range(reader.read_varint()):
+                    tag_id = reader.read_varint()
+                    if tag_id == len(tags_table):
+                        tags_table.append(reader.read_bytes().decode())
+                    tags.append(tags_table[tag_id])
+                yield absolute_path(path.decode(), self._root), tags
+                entry_no += 1
+        except EOFError:
+            raise CorruptedManifestFileError(self._path, reason="truncated file")
+        except (IndexError, OSError, ValueError):
+            raise CorruptedManifestFileError(
+                self._path, reason=f"bad binary entry {entry_no}"
+            )
+
+
+class _ByteReader:
+    """Buffered reader of varints and strings."""
+
+    def __init__(self, infile):
+        self._file = infile
+        self._buffer = b""
+        self._pos = 0
+
+    def read_varint(self) -> int:
+        res = 0
+        shift = 0
+        while True:
+            if self._pos >= len(self._buffer):
+                self._fill(1)
+            byte = self._buffer[self._pos]
+            self._pos += 1
+            res |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return res
+            shift += 7
+
+    def read_bytes(self) -> bytes:
+        size = self.read_varint()
+        if self._pos + size > len(self._buffer):
+            self._fill(size)
+        res = self._buffer[self._pos : self._pos + size]
+        self._pos += size
+        return res
+
+    def _fill(self, size: int) -> None:
+        """Make at least 'size' bytes available after the current position."""
+        chunks = [self._buffer[self._pos :]]
+        available = len(chunks[0])
+        while available < size:
+            try:
+                chunk = self._file.read(max(_READ_SIZE, size - available))
+            except Exception:  # Decompression errors have their own types
+                raise ValueError("Unreadable manifest data")
+            if not chunk:
+                raise EOFError
+            chunks.append(chunk)
+            available += len(chunk)
+        self._buffer = b"".join(chunks)
+        self._pos = 0
+
+
+def _put_varint(buffer: bytearray, value: int) -> None:
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _put_bytes(buffer: bytearray, value: bytes) -> None:
+    _put_varint(buffer, len(value))
+    buffer += value
+
+
+def _shared_prefix_len(a: bytes, b: bytes) -> int:
+    size = min(len(a), len(b))
+    i = 0
+    while i < size and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _compressor(outfile, compression: Union[str, None]):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=outfile, mode="wb", mtime=0)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor().stream_writer(outfile, closefd=False)
+    return outfile
+
+
+def _decompressor(infile, compression: int):
+    if compression == COMPRESSION_GZIP:
+        return gzip.GzipFile(fileobj=infile, mode="rb")
+    if compression == COMPRESSION_ZSTD:
+        return _zstandard().ZstdDecompressor().stream_reader(infile)
+    if compression == COMPRESSION_NONE:
+        return infile
+    raise ValueError(f"Unknown manifest compression '{compression}'")
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The 'zstd' compression needs the 'zstandard' package")
+    return zstandard
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Merge mode.
+
+A dump applies a manifest over the node, so with three or more machines the
+tags written on one of them can be lost when another one saves. A merge
+combines instead the tags of the node, the incoming manifest and the base,
+the result of the last merge of the node on the machine, kept in the local
+state directory. For every path:
+
+- If only one side has changed since the base, its tags win.
+- If both sides have changed, it is a conflict, resolved merging the tag
+  sets: the tags added by any side are kept and the ones removed by any side
+  are removed.
+
+Without a base, the tags of both sides are joined. The paths that are not in
+the node, maybe not synchronized yet, keep the tags of the manifest. But the
+ones of the base have been deleted from the node since the last merge, so
+their entries are dropped.
+
+The result is applied to the node and written as the new manifest, with a
+sidecar file that keeps the machine and the logical clock of the last change
+of every entry. The clock of a merge is one more than the greatest one of the
+manifest, so the changes are ordered across all the machines. The node and
+the manifest are both sorted by path, so they are merged in a single linear
+pass.
+"""
+
+import json
+import os
+import platform
+from typing import Dict, List, Tuple, Union
+
+from finder_tags_butler import logic_stats, properties
+from finder_tags_butler.logic_cache import StatCache, stat_cache_path
+from finder_tags_butler.logic_files import node_lock
+from finder_tags_butler.logic_ignore import WalkRules
+from finder_tags_butler.logic_journal import node_state_path
+from finder_tags_butler.logic_manifest import (
+    Manifest,
+    ManifestContent,
+    ManifestWriter,
+    load_manifest,
+)
+from finder_tags_butler.logic_paths import absolute_path, relative_path
+from finder_tags_butler.logic_reconcile import plan_changes
+from finder_tags_butler.logic_retry import failed_paths
+from finder_tags_butler.logic_shards import (
+    AppliedShards,
+    applied_shards_path,
+    remove_shards,
+)
+from finder_tags_butler.logic_tags import apply_finder_tag_changes
+from finder_tags_butler.logic_walk import (
+    get_tags,
+    iter_batches,
+    iter_children_of_path,
+    merge_entries,
+)
+from finder_tags_butler.logic_workers import WorkerPool, stat_paths
+
+CLOCKS_VERSION = 1
+BASE_VERSION = 1
+
+
+class EntryClocks:
+    """Abstraction of the clocks of the entries of a manifest."""
+
+    def __init__(self, root: str, entries: Dict[str, list] = None):
+        """
+        :param root: The node path. The paths are stored relative to it.
+        :param entries: A dict with the '[machine, clock]' of the last change
+            of every entry.
+        """
+        self.root = root
+        self.entries = entries if entries is not None else {}
+
+    @classmethod
+    def load(cls, path: str, root: str) -> "EntryClocks":
+        """Read a clocks file.
+
+        A missing or broken file returns no clocks, so all the entries are
+        handled as changed by the machine of the manifest at the clock zero.
+
+        :param path: The path of the clocks file.
+        :param root: The node path.
+        :return: The loaded clocks.
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as infile:
+                data = json.load(infile)
+            if data["version"] != CLOCKS_VERSION:
+                return cls(root)
+            entries = {
+                absolute_path(p, root): [str(m), int(c)]
+                for p, (m, c) in data["entries"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return cls(root)
+        return cls(root, entries)
+
+    def save(self, path: str) -> None:
+        """Write the clocks to a file.
+
+        :param path: The path of the clocks file.
+        """
+        data = {
+            "version": CLOCKS_VERSION,
+            "entries": {
+                relative_path(p, self.root): e for p, e in sorted(self.entries.items())
+            },
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(data, outfile, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def max_clock(self) -> int:
+        """Return the greatest clock of the entries, or zero."""
+        return max((c for _, c in self.entries.values()), default=0)
+
+
+class MergeBase:
+    """Abstraction of the result of the last merge of a node on the machine."""
+
+    def __init__(self, root: str, manifest_path: str, state_dir: str = None):
+        """
+        :param root: The node path.
+        :param manifest_path: The path of the merged manifest.
+        :param state_dir: The directory of the local state, see
+            'logic_journal'.
+        """
+        self.machine = platform.node()
+        self.root = root
+        self.entries = None  # Relative path -> tags, or 'None' without base
+        self.path = node_state_path(root, manifest_path, state_dir) + ".base"
+
+    @classmethod
+    def load(cls, root: str, manifest_path: str, state_dir: str = None) -> "MergeBase":
+        """Read the base of a node.
+
+        A missing, broken or foreign base is handled as no base at all.
+
+        :param root: The node path.
+        :param manifest_path: The path of the merged manifest.
+        :param state_dir: The directory of the local state.
+        :return: The loaded base.
+        """
+        base = cls(root, manifest_path, state_dir)
+        try:
+            with open(base.path, "r", encoding="utf-8") as infile:
+                data = json.load(infile)
+            if (
+                data["version"] == BASE_VERSION
+                and data["machine"] == base.machine
+                and data["root"] == root
+            ):
+                base.entries = dict(data["entries"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return base
+
+    def get(self, path: str) -> Union[List[str], None]:
+        """Return the base tags of a path, or 'None' without base."""
+        if self.entries is None:
+            return None
+        return self.entries.get(relative_path(path, self.root), [])
+
+    def save(self, entries: Dict[str, List[str]]) -> None:
+        """Write a new base.
+
+        :param entries: A dict with the tags of every tagged path.
+        """
+        self.entries = {relative_path(p, self.root): t for p, t in entries.items()}
+        data = {
+            "version": BASE_VERSION,
+            "machine": self.machine,
+            "root": self.root,
+            "entries": self.entries,
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(data, outfile, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+
+class MergeConflict:
+    """Abstraction of a path changed both in the node and in the manifest."""
+
+    def __init__(
+        self,
+        path: str,
+        local: List[str],
+        remote: List[str],
+        machine: str,
+        merged: List[str],
+    ):
+        self.path = path
+        self.local = local
+        self.remote = remote
+        self.machine = machine  # Of the last change in the manifest
+        self.merged = merged
+
+    def __str__(self):
+        return (
+            f"'{self.path}' has been changed here {self.local} and in "
+            f"'{self.machine}' {self.remote}, merged as {self.merged}"
+        )
+
+
+class MergeReport:
+    """Abstraction of the result of a merge."""
+
+    def __init__(self):
+        self.changes = []  # Only planned in a dry run
+        self.errors = []
+        self.conflicts = []
+
+
+def merge_tags(
+    base: Union[List[str], None], local: List[str], remote: List[str]
+) -> Tuple[List[str], bool]:
+    """Merge the tags of a path.
+
+    :param base: The tags of the last merge, or 'None' if unknown.
+    :param local: The tags of the node.
+    :param remote: The tags of the manifest.
+    :return: A tuple with the merged tags and if the sides were in conflict.
+    """
+    if local == remote:
+        return local, False
+    if base is not None:
+        if local == base:
+            return remote, False
+        if remote == base:
+            return local, False
+        base_tags = set(base)
+    else:
+        if not local or not remote:  # Only one side has tags, take them
+            return local or remote, False
+        base_tags = set()
+
+    # Keep the tags added by any side and the base ones kept by both
+    local_tags = set(local)
+    remote_tags = set(remote)
+    merged = [t for t in local if t not in base_tags or t in remote_tags]
+    merged.extend(t for t in remote if t not in local_tags and t not in base_tags)
+    return list(dict.fromkeys(merged)), True
+
+
+def merge_manifest(
+    manifest_path: str,
+    path: str,
+    use_cache: bool = True,
+    dry_run: bool = False,
+    workers: WorkerPool = None,
+    manifest_format: str = None,
+    compression: str = None,
+    shards: int = None,
+    max_depth: int = None,
+    follow_symlinks: bool = False,
+) -> MergeReport:
+    """Merge the tags of the node's 'path' location and its 'manifest_path''s
+    manifest, applying the result to both.
+
+    A missing manifest is handled as an empty one.
+
+    Warning: the paths should be checked before call this function.
+
+    :param manifest_path: The path of the manifest.
+    :param path: The path of the node.
+    :param use_cache: See 'save_manifest'.
+    :param dry_run: Passing this param as 'True', the changes to apply to the
+        node are planned, but neither the node nor the manifest are changed.
+    :param workers: A pool to walk the tree and read the tags concurrently. By
+        default, all is done sequentially.
+    :param manifest_format: See 'save_manifest'.
+    :param compression: See 'save_manifest'.
+    :param shards: See 'save_manifest'.
+    :param max_depth: See 'save_manifest'. The entries of the manifest out of
+        the walk are kept as they are.
+    :param follow_symlinks: See 'save_manifest'.
+    :return: The report of the merge.
+    :raise: CorruptedManifestFileError, if the manifest file is corrupted.
+    """
+    # Assert the paths are correct and absolutely
+    manifest_path = os.path.abspath(os.path.expanduser(manifest_path))
+    path = os.path.abspath(os.path.expanduser(path))
+    manifest_dir = os.path.dirname(manifest_path)
+
+    with node_lock(path, manifest_path):
+        with logic_stats.phase("load_manifest"):
+            if os.path.isfile(manifest_path):
+                remote = load_manifest(manifest_path, root=path)
+            else:
+                remote = Manifest(root=path)
+        clocks_path = os.path.join(manifest_dir, properties.ENTRY_CLOCKS_FILE_NAME)
+        clocks = EntryClocks.load(clocks_path, path)
+        base = MergeBase.load(path, manifest_path)
+        cache_path = stat_cache_path(path, manifest_path)
+        cache = StatCache.load(cache_path) if use_cache else StatCache()
+
+        rules = WalkRules.load(path, max_depth, follow_symlinks)
+        machine = platform.node()
+        clock = clocks.max_clock() + 1
+        report = MergeReport()
+        result = ManifestContent(path)
+        result_clocks = {}
+        applied = {}  # Path -> tags actually in the node, for the next base
+        cache_entries = {}
+
+        children = logic_stats.timed_iter(
+            "walk", iter_children_of_path(path, workers, rules=rules)
+        )
+        for batch in iter_batches(merge_entries(children, remote.content), workers):
+            # Read the tags of the children, reusing the cached ones
+            in_tree = [c for c, _, t in batch if t]
+            if workers is None:
+                stats = stat_paths(in_tree)
+            else:
+                stats = workers.stat_many(in_tree)
+            current = {}
+            for child, st in stats.items():
+                tags = cache.lookup(child, st)
+                if tags is not None:
+                    current[child] = tags
+            current.update(get_tags([c for c in in_tree if c not in current], workers))
+
+            with logic_stats.phase("plan"):
+                desired = {}
+                for child, remote_tags, is_child in batch:
+                    if not is_child:
+                        if base.get(child) and not os.path.lexists(child):
+                            continue  # Deleted in the node since the last merge
+                        merged = remote_tags  # Maybe not synchronized yet
+                    else:
+                        merged, conflict = merge_tags(
+                            base.get(child), current[child], remote_tags
+                        )
+                        desired[child] = merged
+                        if conflict:
+                            remote_machine = clocks.entries.get(
+                                child, [remote.machine]
+                            )[0]
+                            report.conflicts.append(
+                                MergeConflict(
+                                    child,
+                                    current[child],
+                                    remote_tags,
+                                    remote_machine,
+                                    merged,
+                                )
+                            )
+                    if merged:
+                        result.append(child, merged)
+                        applied[child] = merged
+                        if merged == remote_tags:
+                            result_clocks[child] = clocks.entries.get(
+                                child, [remote.machine, 0]
+                            )
+                        else:
+                            result_clocks[child] = [machine, clock]
+                changes = plan_changes(desired, current, overwrite=True)
+
+            # Apply the changes. The failed paths keep their tags in the base, so
+            # the next merge tries them again
+            if dry_run:
+                report.changes.extend(changes)
+                continue
+            if changes:
+                with logic_stats.phase("apply_tags"):
+                    errors = apply_finder_tag_changes(changes)
+                report.errors.extend(errors)
+                for child in failed_paths(errors, [c.path for c in changes]):
+                    if current.get(child):
+                        applied[child] = current[child]
+                    else:
+                        applied.pop(child, None)
+            changed = {c.path for c in changes}
+            cache_entries.update(
+                (c, (st, current[c])) for c, st in stats.items() if c not in changed
+            )
+        logic_stats.count("merge_conflicts", len(report.conflicts))
+        if dry_run:
+            return report
+
+        # Write the merged manifest, its clocks and the new base
+        with logic_stats.phase("write_manifest"):
+            with ManifestWriter(
+                manifest_path,
+                manifest_format=manifest_format,
+                root=path,
+                compression=compression,
+                shards=shards,
+            ) as writer:
+                for entry in result:
+                    writer.write(entry)
+        EntryClocks(path, result_clocks).save(clocks_path)
+        base.save(applied)
+        if shards is not None:
+            AppliedShards(path, shards, writer.checksums, rules=rules.key).save(
+                applied_shards_path(path, manifest_path)
+            )
+        else:
+            remove_shards(path, manifest_path)
+        index_path = os.path.join(manifest_dir, properties.IDENTITY_INDEX_FILE_NAME)
+        if os.path.lexists(index_path):  # It does not match the new manifest
+            os.remove(index_path)
+        if use_cache:
+            cache.update(cache_entries)
+            cache.save(cache_path)
+        return report
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Node-relative paths.
+
+The manifests and the local state store the paths relative to the node, so
+they are valid wherever the node is mounted. The paths out of the node are
+kept absolute.
+"""
+
+import os
+from typing import Union
+
+
+def relative_path(path: str, root: Union[str, None]) -> str:
+    """Return 'path' relative to 'root', or absolute if it is out of it."""
+    if root is None:
+        return path
+    if path == root:
+        return ""
+    if path.startswith(root + os.sep):
+        return path[len(root) + 1 :]
+    return path
+
+
+def absolute_path(path: str, root: Union[str, None]) -> str:
+    """Inverse of 'relative_path'."""
+    if root is None:
+        return path
+    if not path:
+        return root
+    if os.path.isabs(path):
+        return path
+    return os.path.join(root, path)
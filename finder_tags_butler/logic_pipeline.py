@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Staged pipelines.
+
+A dump reads the manifest, checks the existence of its entries, reads their
+current tags and writes the changed ones. Every step waits on a different
+file system call, so they can be run as the stages of a pipeline, each one
+by its own threads and connected to the next one by a bounded queue. While
+a batch is written, the next ones are already checked and read, and a slow
+stage stops the previous ones once its queue is full, instead of buffering
+the whole manifest.
+
+Every call of a stage can have a timeout. A call that times out is left
+running in a background thread, its result is discarded and its item is
+handed to the 'on_timeout' function of the stage, so a hung file system
+does not stall the whole dump. The function can flag the item so the call
+stops before its next operation, but a call blocked in the file system can
+not be interrupted, so a timed out write may still complete later.
+"""
+
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List
+
+from finder_tags_butler import logic_stats, properties
+
+
+class PipelineOptions:
+    """Abstraction of the configuration of a pipeline."""
+
+    def __init__(
+        self,
+        check_jobs: int = 1,
+        read_jobs: int = 1,
+        write_jobs: int = 1,
+        queue_size: int = properties.PIPELINE_QUEUE_SIZE,
+        timeout: float = None,
+    ):
+        """
+        :param check_jobs: The threads that check the existence of the
+            entries.
+        :param read_jobs: The threads that read the current tags and compare
+            them with the manifest ones.
+        :param write_jobs: The threads that write the changed tags.
+        :param queue_size: The batches waiting between two stages, at most.
+        :param timeout: The seconds that every call of a stage can last, or
+            'None' to wait for ever.
+        """
+        self.check_jobs = check_jobs
+        self.read_jobs = read_jobs
+        self.write_jobs = write_jobs
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+
+class Stage:
+    """Abstraction of a step of a pipeline."""
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable,
+        jobs: int = 1,
+        timeout: float = None,
+        on_timeout: Callable = None,
+    ):
+        """
+        :param name: The name of the stage, for the instrumentation.
+        :param function: The function that turns an item into the item for
+            the next stage. It should return a new item instead of changing
+            the given one, which could be handed to 'on_timeout' meanwhile.
+        :param jobs: The threads that run the stage.
+        :param timeout: The seconds that every call of 'function' can last,
+            or 'None' to wait for ever.
+        :param on_timeout: The function that turns the item of a call that
+            has timed out into the item for the next stage. By default, a
+            'TimeoutError' stops the pipeline.
+        """
+        self.name = name
+        self.function = function
+        self.jobs = jobs
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+
+
+def run_pipeline(
+    source: Iterable,
+    stages: List[Stage],
+    queue_size: int = properties.PIPELINE_QUEUE_SIZE,
+) -> Iterator:
+    """Run the items of 'source' through the stages.
+
+    The source is iterated in its own thread and every stage is run by its
+    own threads. The first error of any of them stops the pipeline and is
+    raised here, as does closing the iterator early.
+
+    :param source: The items to process.
+    :param stages: The stages, in order.
+    :param queue_size: The items waiting between two stages, at most.
+    :return: An iterator of the items returned by the last stage, in the
+        order they are completed, which is not the source one if a stage has
+        several jobs.
+    """
+    pipeline = _Pipeline(len(stages), queue_size)
+    pipeline.start(_feed, (pipeline, source))
+    for index, stage in enumerate(stages):
+        remaining = [stage.jobs]
+        for _ in range(stage.jobs):
+            pipeline.start(_work, (pipeline, stage, index, remaining))
+    try:
+        while True:
+            item = pipeline.get(len(stages))
+            if item is _END:
+                break
+            yield item
+    finally:
+        pipeline.stop()
+    if pipeline.error is not None:
+        raise pipeline.error
+
+
+def run_inline(source: Iterable, stages: List[Stage]) -> Iterator:
+    """Run the items of 'source' through the stages, one after another in
+    the calling thread. The timeouts of the stages are applied too.
+
+    See 'run_pipeline' for the meaning of the params.
+    """
+    for item in source:
+        for stage in stages:
+            item = call_stage(stage, item)
+        yield item
+
+
+def call_stage(stage: Stage, item):
+    """Call the function of a stage over an item, within its timeout.
+
+    :param stage: The stage.
+    :param item: The item to process. If the call times out, it keeps
+        running in the background with this item, which is handed to the
+        'on_timeout' function of the stage.
+    :raise TimeoutError: If the call times out and the stage has no
+        'on_timeout' function.
+    :return: The item for the next stage.
+    """
+    if stage.timeout is None:
+        return stage.function(item)
+
+    # A daemon thread, so a hung call neither blocks the exit of the program
+    # nor keeps busy a worker of the stage
+    outcome = []
+    thread = threading.Thread(
+        target=_call_into, args=(stage.function, item, outcome), daemon=True
+    )
+    thread.start()
+    thread.join(stage.timeout)
+    if not outcome:
+        logic_stats.count("stage_timeouts")
+        if stage.on_timeout is None:
+            raise TimeoutError(
+                f"the '{stage.name}' stage has not ended in {stage.timeout} seconds"
+            )
+        return stage.on_timeout(item)
+    result, error = outcome[0]
+    if error is not None:
+        raise error
+    return result
+
+
+def _call_into(function: Callable, item, outcome: list) -> None:
+    """Call a function, appending to 'outcome' its result and error."""
+    try:
+        outcome.append((function(item), None))
+    except BaseException as e:
+        outcome.append((None, e))
+
+
+_END = object()  # Sent after the last item of a queue
+
+
+class _Pipeline:
+    """The queues and threads of a running pipeline."""
+
+    def __init__(self, stages: int, queue_size: int):
+        self.queues = [queue.Queue(queue_size) for _ in range(stages + 1)]
+        self.error = None
+        self._stopped = threading.Event()
+        self.lock = threading.Lock()
+        self._threads = []
+
+    def start(self, target: Callable, args: tuple) -> None:
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def get(self, index: int):
+        """Take the next item of a queue, or '_END' once stopped."""
+        while not self._stopped.is_set():
+            try:
+                return self.queues[index].get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _END
+
+    def put(self, index: int, item) -> bool:
+        """Append an item to a queue, unless stopped meanwhile."""
+        while not self._stopped.is_set():
+            try:
+                self.queues[index].put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fail(self, error: BaseException) -> None:
+        """Stop the pipeline because of an error, keeping the first one."""
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self._stopped.set()
+
+    def stop(self) -> None:
+        """Stop the pipeline and wait for its threads, but the hung calls."""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+
+_POLL_INTERVAL = 0.05  # Seconds between the checks of a stopped pipeline
+
+
+def _feed(pipeline: _Pipeline, source: Iterable) -> None:
+    """Put the items of the source in the first queue."""
+    try:
+        for item in source:
+            if not pipeline.put(0, item):
+                return
+        pipeline.put(0, _END)
+    except BaseException as e:
+        pipeline.fail(e)
+
+
+def _work(pipeline: _Pipeline, stage: Stage, index: int, remaining: list) -> None:
+    """Run a stage over the items of its queue, until its end.
+
+    The end is put back for the other jobs of the stage, and the last one
+    to see it passes it to the next stage.
+    """
+    try:
+        while True:
+            item = pipeline.get(index)
+            if item is _END:
+                break
+            if not pipeline.put(index + 1, call_stage(stage, item)):
+                return
+        with pipeline.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        pipeline.put(index + 1 if last else index, _END)
+    except BaseException as e:
+        pipeline.fail(e)
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Tag queries.
+
+The tagged paths of a saved manifest can be searched with boolean queries
+over their tags, like:
+
+    Red AND (Work OR Proj*) AND NOT "Old stuff"
+
+- 'NOT' binds tighter than 'AND', and 'AND' tighter than 'OR'. Two terms
+  without an operator between them are joined with 'AND'.
+- A term ending with '*' matches all the tags starting with it.
+- The tags with spaces, quotes or parentheses, or named like an operator,
+  are written between double quotes, escaping the inner ones with '\\'.
+
+The queries are answered with an inverted index of the manifest. Its entries
+get consecutive ids in path order, and every tag is mapped to the sorted ids
+of its paths or to a bitmap of them, the smallest of both. The queries are
+evaluated over bitmaps held as Python integers, so they take microseconds
+even over hundreds of thousands of entries, once their tags are decoded.
+
+The index of a node is cached in the local state directory, see
+'logic_journal', and it is only rebuilt when the checksum of the manifest
+file changes.
+"""
+
+import json
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Tuple, Union
+
+from finder_tags_butler import logic_stats, properties
+from finder_tags_butler.errors import InvalidTagQueryError
+from finder_tags_butler.logic_files import AtomicFile
+from finder_tags_butler.logic_journal import file_checksum, node_state_path
+from finder_tags_butler.logic_manifest import ManifestReader
+from finder_tags_butler.logic_paths import absolute_path, relative_path
+
+_OPERATORS = ("AND", "OR", "NOT")
+_TOKEN = re.compile(r'\s*(?P<token>([()])|"((?:[^"\\]|\\.)*)"(\*?)|([^\s()"]+))')
+
+
+class TagIndex:
+    """Inverted index of the tags of a manifest."""
+
+    def __init__(
+        self,
+        root: str,
+        paths: List[str],
+        postings: Dict[str, Tuple[str, bytes]],
+        manifest: dict = None,
+    ):
+        """To index a manifest file, see 'build'.
+
+        :param root: The node path.
+        :param paths: The paths of the entries relative to the node, in order.
+        :param postings: The encoded paths of every tag: a tuple with 'ids'
+            and their sorted ids as 32 bits little-endian integers, or with
+            'bitmap' and a little-endian bitmap of the ids.
+        :param manifest: The checksum, 'size' and 'mtime_ns' of the indexed
+            manifest file, if any.
+        """
+        self.root = root
+        self.entries = len(paths)
+        self.manifest = manifest
+        self.tags = sorted(postings)
+        self._paths = paths
+        self._postings = postings
+        self._bitmaps = {}  # Tag -> decoded bitmap
+
+    @classmethod
+    def build(cls, manifest_path: str, root: str = None) -> "TagIndex":
+        """Index a manifest file.
+
+        :param manifest_path: The path of the manifest file.
+        :param root: The node path. By default, the directory of the manifest.
+        :raise: CorruptedManifestFileError, if the manifest file is corrupted.
+        :return: The index, without the data of the manifest file.
+        """
+        paths = []
+        ids_by_tag = {}
+        with ManifestReader(manifest_path, root) as reader:
+            root = reader.root
+            for entry in reader:
+                for tag in entry.tags:
+                    ids = ids_by_tag.get(tag)
+                    if ids is None:
+                        ids = ids_by_tag[tag] = array("I")
+                    ids.append(len(paths))
+                paths.append(relative_path(entry.path, root))
+
+        bitmap_size = (len(paths) + 7) // 8
+        postings = {}
+        for tag, ids in ids_by_tag.items():
+            if len(ids) * ids.itemsize <= bitmap_size:
+                if sys.byteorder == "big":
+                    ids.byteswap()
+                postings[tag] = ("ids", ids.tobytes())
+            else:
+                postings[tag] = ("bitmap", _to_bitmap(ids, bitmap_size))
+        return cls(root, paths, postings)
+
+    @classmethod
+    def load(cls, path: str) -> "TagIndex":
+        """Read an index file.
+
+        :param path: The path of the index file.
+        :raise ValueError: If the file is not a valid index.
+        :raise OSError: If the file can not be read.
+        """
+        with open(path, "rb") as infile:
+            try:
+                header = json.loads(infile.readline().decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                raise ValueError(f"not a tag index: {e}")
+            if (
+                not isinstance(header, dict)
+                or header.get("format") != properties.TAG_INDEX_FORMAT
+                or header.get("version") != properties.TAG_INDEX_VERSION
+            ):
+                raise ValueError("not a tag index of this version")
+            data = infile.read()
+
+        try:
+            offset = header["paths_size"]
+            paths = data[:offset].decode("utf-8", "surrogateescape").split("\0")
+            if header["entries"] == 0:
+                paths = []
+            postings = {}
+            for tag, kind, size in header["tags"]:
+                postings[tag] = (kind, data[offset : offset + size])
+                offset += size
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"broken tag index: {e}")
+        if len(paths) != header["entries"] or offset != len(data):
+            raise ValueError("broken tag index: truncated file")
+        return cls(header["root"], paths, postings, header.get("manifest"))
+
+    def save(self, path: str) -> None:
+        """Write the index to a file, atomically.
+
+        :param path: The path of the index file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        header = {
+            "format": properties.TAG_INDEX_FORMAT,
+            "version": properties.TAG_INDEX_VERSION,
+            "root": self.root,
+            "manifest": self.manifest,
+            "entries": self.entries,
+        }
+        paths = "\0".join(self._paths).encode("utf-8", "surrogateescape")
+        header["paths_size"] = len(paths)
+        header["tags"] = [
+            [tag, self._postings[tag][0], len(self._postings[tag][1])]
+            for tag in self.tags
+        ]
+        with AtomicFile(path, replace_unchanged=True) as outfile:
+            outfile.write(json.dumps(header).encode() + b"\n")
+            outfile.write(paths)
+            for tag in self.tags:
+                outfile.write(self._postings[tag][1])
+
+    def count(self, tag: str) -> int:
+        """Return the number of paths with a tag."""
+        return bin(self._bitmap(tag)).count("1")
+
+    def query(self, expression: Union[str, tuple]) -> List[str]:
+        """Return the paths that match a query.
+
+        :param expression: The query, or its parsed tree, see 'parse_query'.
+        :raise InvalidTagQueryError: If the query is not valid.
+        :return: The absolute paths, sorted.
+        """
+        if isinstance(expression, str):
+            expression = parse_query(expression)
+        matches = self._evaluate(expression)
+        return [absolute_path(self._paths[i], self.root) for i in _iter_bits(matches)]
+
+    def _evaluate(self, node: tuple) -> int:
+        """Return the bitmap of the entries that match a parsed query."""
+        kind = node[0]
+        if kind == "tag":
+            return self._bitmap(node[1])
+        if kind == "prefix":
+            matches = 0
+            start = bisect_left(self.tags, node[1])
+            for tag in self.tags[start:]:
+                if not tag.startswith(node[1]):
+                    break
+                matches |= self._bitmap(tag)
+            return matches
+        if kind == "not":
+            return ((1 << self.entries) - 1) & ~self._evaluate(node[1])
+        left = self._evaluate(node[1])
+        if kind == "and":
+            return left & self._evaluate(node[2]) if left else 0
+        return left | self._evaluate(node[2])
+
+    def _bitmap(self, tag: str) -> int:
+        """Return the bitmap of the entries of a tag, decoding it once."""
+        bitmap = self._bitmaps.get(tag)
+        if bitmap is None:
+            posting = self._postings.get(tag)
+            if posting is None:
+                return 0
+            kind, data = posting
+            if kind == "ids":
+                ids = array("I")
+                ids.frombytes(data)
+                if sys.byteorder == "big":
+                    ids.byteswap()
+                data = _to_bitmap(ids, (self.entries + 7) // 8)
+            bitmap = self._bitmaps[tag] = int.from_bytes(data, "little")
+        return bitmap
+
+
+def open_tag_index(
+    manifest_path: str, root: str = None, state_dir: str = None
+) -> TagIndex:
+    """Return the index of a manifest, reading the cached one if the manifest
+    has not changed since it was built.
+
+    The size and modification time of the manifest file are checked first,
+    and only if they differ its checksum is computed.
+
+    :param manifest_path: The path of the manifest file.
+    :param root: The node path. By default, the directory of the manifest.
+    :param state_dir: The directory of the local state. By default, see
+        'default_state_dir'.
+    :raise: CorruptedManifestFileError, if the manifest file is corrupted.
+    :return: The index.
+    """
+    manifest_path = os.path.abspath(os.path.expanduser(manifest_path))
+    if root is None:
+        root = os.path.dirname(manifest_path)
+    root = os.path.abspath(os.path.expanduser(root))
+    index_path = node_state_path(root, manifest_path, state_dir) + ".index"
+
+    st = os.stat(manifest_path)
+    stat = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    with logic_stats.phase("load_index"):
+        try:
+            index = TagIndex.load(index_path)
+        except (OSError, ValueError):
+            index = None
+    if index is not None and index.root != root:
+        index = None
+    if index is not None and _matches(index.manifest, stat):
+        return index
+
+    checksum = file_checksum(manifest_path)
+    if index is not None and _matches(index.manifest, {"checksum": checksum}):
+        index.manifest = dict(stat, checksum=checksum)  # Only touched
+        index.save(index_path)
+        return index
+
+    with logic_stats.phase("build_index"):
+        index = TagIndex.build(manifest_path, root)
+        index.manifest = dict(stat, checksum=checksum)
+        index.save(index_path)
+    logic_stats.count("index_rebuilds")
+    return index
+
+
+def query_manifest(
+    manifest_path: str, path: str, expression: str, state_dir: str = None
+) -> List[str]:
+    """Return the paths of a node with the tags asked for by a query,
+    according to its manifest.
+
+    Warning: the paths should be checked before call this function.
+
+    :param manifest_path: The path of the manifest file.
+    :param path: The path of the node.
+    :param expression: The query, see the module docs.
+    :param state_dir: The directory of the local state, where the index is
+        cached.
+    :raise InvalidTagQueryError: If the query is not valid.
+    :raise: CorruptedManifestFileError, if the manifest file is corrupted.
+    :return: The absolute paths that match, sorted.
+    """
+    tree = parse_query(expression)  # Before indexing, to fail early
+    index = open_tag_index(manifest_path, path, state_dir)
+    with logic_stats.phase("query"):
+        return index.query(tree)
+
+
+def parse_query(expression: str) -> tuple:
+    """Parse a tag query.
+
+    :param expression: The query, see the module docs.
+    :raise InvalidTagQueryError: If the query is not valid.
+    :return: The tree of the query, made of tuples: '("tag", name)',
+        '("prefix", start)', '("not", node)', '("and", left, right)' and
+        '("or", left, right)'.
+    """
+    tokens = list(_tokenize(expression))
+    position = 0
+
+    def fail(reason: str):
+        column = tokens[position][2] if position < len(tokens) else None
+        if column is None:
+            column = len(expression) + 1
+        raise InvalidTagQueryError(expression, reason=reason, column=column)
+
+    def peek() -> Union[str, None]:
+        return tokens[position][0] if position < len(tokens) else None
+
+    def parse_or() -> tuple:
+        nonlocal position
+        node = parse_and()
+        while peek() == "OR":
+            position += 1
+            node = ("or", node, parse_and())
+        return node
+
+    def parse_and() -> tuple:
+        nonlocal position
+        node = parse_not()
+        while peek() not in (None, "OR", ")"):
+            if peek() == "AND":
+                position += 1
+            node = ("and", node, parse_not())
+        return node
+
+    def parse_not() -> tuple:
+        nonlocal position
+        if peek() == "NOT":
+            position += 1
+            return ("not", parse_not())
+        if peek() == "(":
+            position += 1
+            node = parse_or()
+            if peek() != ")":
+                fail("a ')' is missing")
+            position += 1
+            return node
+        if peek() in ("term", "prefix"):
+            kind, value, _ = tokens[position]
+            position += 1
+            return ("tag" if kind == "term" else "prefix", value)
+        fail("a tag is missing" if peek() is None else f"unexpected '{peek()}'")
+
+    if not tokens:
+        fail("the query is empty")
+    tree = parse_or()
+    if position < len(tokens):
+        fail(f"unexpected '{peek()}'")
+    return tree
+
+
+def _tokenize(expression: str) -> Iterator[Tuple[str, Union[str, None], int]]:
+    """Split a query in tuples with the kind of every token, its value and
+    its column."""
+    position = 0
+    while True:
+        match = _TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            if expression[position:].strip():
+                column = len(expression) - len(expression[position:].lstrip()) + 1
+                raise InvalidTagQueryError(
+                    expression, reason="unclosed quotes", column=column
+                )
+            return
+        column = match.start("token") + 1
+        paren, quoted, star, word = match.groups()[1:]
+        if paren is not None:
+            yield paren, None, column
+        elif quoted is not None:
+            tag = re.sub(r"\\(.)", r"\1", quoted)
+            yield ("prefix" if star else "term"), tag, column
+        elif word in _OPERATORS:
+            yield word, None, column
+        elif word.endswith("*"):
+            yield "prefix", word[:-1], column
+        else:
+            yield "term", word, column
+        position = match.end()
+
+
+def _to_bitmap(ids: array, size: int) -> bytes:
+    """Encode sorted ids in a little-endian bitmap of 'size' bytes."""
+    bitmap = bytearray(size)
+    for i in ids:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    return bytes(bitmap)
+
+
+def _iter_bits(bitmap: int) -> Iterator[int]:
+    """Iterate the positions of the set bits of a bitmap, in order."""
+    bits = bin(bitmap)[:1:-1]  # The lowest bit first
+    position = bits.find("1")
+    while position >= 0:
+        yield position
+        position = bits.find("1", position + 1)
+
+
+def _matches(manifest: Union[dict, None], values: dict) -> bool:
+    """Tell if the data of an indexed manifest file has the given values."""
+    return isinstance(manifest, dict) and all(
+        manifest.get(key) == value for key, value in values.items()
+    )
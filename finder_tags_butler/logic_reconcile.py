@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Reconcile engine.
+
+Compute the minimal tag changes that bring the current tags of a node to the
+ones described by a manifest, so the paths whose tags are already right are
+not touched at all.
+"""
+
+from typing import Dict, List
+
+from finder_tags_butler.logic_backends import TagChange
+
+
+def plan_changes(
+    desired: Dict[str, List[str]], current: Dict[str, List[str]], overwrite: bool
+) -> [TagChange]:
+    """Compute the changes to apply to reach the desired tags.
+
+    :param desired: A dict with the tags of every path of the manifest.
+    :param current: A dict with the current tags of every reachable path of
+        the node.
+    :param overwrite: Passing this param as 'True', the current tags that are
+        not desired are removed. Passing as 'False', they are kept.
+    :return: The list of changes, sorted by path. Only the paths whose tags
+        differ appear.
+    """
+    changes = []
+    paths = set(current) if overwrite else set(desired).intersection(current)
+    for path in sorted(paths):
+        current_tags = current[path]
+        desired_tags = desired.get(path, [])
+        present = set(current_tags)
+        add = [t for t in dict.fromkeys(desired_tags) if t not in present]
+        remove = []
+        if overwrite:
+            wanted = set(desired_tags)
+            remove = [t for t in current_tags if t not in wanted]
+        if add or remove:
+            changes.append(TagChange(path, add=add, remove=remove))
+    return changes
+
+
+def count_changes(changes: [TagChange]) -> (int, int, int):
+    """Count the work of a list of changes.
+
+    :param changes: The list of changes.
+    :return: A tuple with the number of paths changed, tags to add and tags to
+        remove.
+    """
+    added = sum(len(c.add) for c in changes)
+    removed = sum(len(c.remove) for c in changes)
+    return len(changes), added, removed
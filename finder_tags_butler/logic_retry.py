@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Retries of the tag operations and failure reports.
+
+The file providers of the cloud clients fail the reads and writes of their
+placeholders now and then, with a busy file or an I/O error that is gone a
+moment later. The tag operations of a dump are run by a
+'TagOperationExecutor', which classifies their errors, retries the
+transient ones with an exponential backoff and, if a call over several
+paths still fails, retries them one by one, so a single bad path does not
+stop the rest. A rate limit keeps the dump from hammering the provider.
+
+The paths that still fail are kept in a failure report of the node, in the
+local state directory, so a later dump can apply only them again.
+"""
+
+import errno
+import json
+import os
+import platform
+import random
+import threading
+import time
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Union
+
+from finder_tags_butler import logic_stats, properties
+from finder_tags_butler.errors import TagOperationError, TagOperationTimeoutError
+from finder_tags_butler.logic_backends import TagChange, get_backend
+from finder_tags_butler.logic_files import AtomicFile
+from finder_tags_butler.logic_journal import node_state_path
+from finder_tags_butler.logic_paths import absolute_path, relative_path
+from finder_tags_butler.logic_workers import WorkerPool
+
+# Classes of errors, see 'classify_error'
+TRANSIENT = "transient"  # Worth retrying
+PERMANENT = "permanent"  # The same call fails again
+MISSING = "missing"  # The path does not exist
+TIMEOUT = "timeout"  # The call has not ended in time, see 'logic_pipeline'
+
+_TRANSIENT_ERRNOS = frozenset(
+    (
+        errno.EAGAIN,
+        errno.EBUSY,
+        errno.EDEADLK,
+        errno.EINTR,
+        errno.EIO,
+        errno.ENOLCK,
+        errno.ETIMEDOUT,
+        errno.ETXTBSY,
+    )
+)
+
+
+def classify_error(error: BaseException) -> str:
+    """Return the class of the error of a tag operation.
+
+    :param error: The error.
+    :return: 'TRANSIENT', 'PERMANENT', 'MISSING' or 'TIMEOUT'.
+    """
+    if isinstance(error, TagOperationError):
+        if error.kind is None and error.cause is not None:
+            return classify_error(error.cause)
+        return error.kind or PERMANENT
+    if isinstance(error, TagOperationTimeoutError):
+        return TIMEOUT
+    if isinstance(error, (FileNotFoundError, NotADirectoryError)):
+        return MISSING
+    if isinstance(error, OSError) and error.errno in _TRANSIENT_ERRNOS:
+        return TRANSIENT
+    if isinstance(error, (TimeoutError, InterruptedError, BlockingIOError)):
+        return TRANSIENT
+    return PERMANENT
+
+
+class RateLimiter:
+    """A token bucket that limits the operations per second.
+
+    It is thread safe, so the workers of a dump can share it.
+    """
+
+    def __init__(self, rate: float, burst: float = None, sleep: Callable = None):
+        """
+        :param rate: The operations per second.
+        :param burst: The operations that can be done at once after a pause.
+            By default, the ones of a second.
+        :param sleep: The function to wait. By default, 'time.sleep'.
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self._sleep = sleep or time.sleep
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, operations: int = 1) -> None:
+        """Wait until several operations can be done.
+
+        More operations than the burst are allowed at once, but the next
+        ones wait for them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= operations
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            logic_stats.count("rate_limited")
+            self._sleep(wait)
+
+
+class TagOperationExecutor:
+    """Abstraction of the way the tag operations of a dump are run."""
+
+    def __init__(
+        self,
+        retries: int = properties.TAG_RETRIES,
+        backoff: float = properties.TAG_RETRY_BACKOFF,
+        max_backoff: float = properties.TAG_RETRY_MAX_BACKOFF,
+        limiter: RateLimiter = None,
+        sleep: Callable = None,
+    ):
+        """
+        :param retries: The retries of an operation failed by a transient
+            error.
+        :param backoff: The seconds before the first retry. They are doubled
+            before every next one, with a random jitter.
+        :param max_backoff: The maximum seconds between two retries.
+        :param limiter: The limit of the paths read or written per second.
+            By default, there is no limit.
+        :param sleep: The function to wait. By default, 'time.sleep'.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+        self._sleep = sleep or time.sleep
+
+    def get_many(
+        self, paths: List[str], workers: WorkerPool = None
+    ) -> (Dict[str, List[str]], List[Exception]):
+        """Read the tags of several paths.
+
+        :param paths: The paths of the files or folders to examine.
+        :param workers: A pool to read the tags concurrently.
+        :return: A tuple with a dict with the list of tag names of every read
+            path and a list of errors of the ones that can not be read.
+        """
+        backend = get_backend()
+        if workers is not None:
+            read = partial(workers.get_many, backend)
+        else:
+            read = partial(logic_stats.timed_call, "backend.get_many", backend.get_many)
+        try:
+            return self._call(read, paths, self.retries), []
+        except Exception as e:
+            if not paths:
+                raise
+            if len(paths) == 1:
+                return {}, [_operation_error(paths[0], "reading", e)]
+
+        # Isolate the paths that fail, without retrying them again
+        tags = {}
+        errors = []
+        for path in paths:
+            try:
+                tags.update(self._call(read, [path], 0))
+            except Exception as e:
+                errors.append(_operation_error(path, "reading", e))
+        return tags, errors
+
+    def apply_many(
+        self, changes: List[TagChange], cancelled: threading.Event = None
+    ) -> List[Exception]:
+        """Apply several tag changes.
+
+        :param changes: The 'TagChange' list to apply.
+        :param cancelled: An event set when the result is not awaited any
+            more, e.g. after a timeout. No other write, retry included, is
+            started once it is set, but the one in progress may still
+            complete.
+        :return: A list of errors of the changes that have not been applied.
+        """
+        backend = get_backend()
+        apply = partial(
+            logic_stats.timed_call, "backend.apply_many", backend.apply_many
+        )
+        try:
+            return self._call(apply, changes, self.retries, cancelled)
+        except _Cancelled:
+            return _cancelled_errors(changes)
+        except Exception as e:
+            if not changes:
+                raise
+            if len(changes) == 1:
+                return [_operation_error(changes[0].path, "writing", e)]
+
+        # Isolate the changes that fail, without retrying them again. The
+        # ones already applied are applied again, which does nothing
+        errors = []
+        for i, change in enumerate(changes):
+            try:
+                errors.extend(self._call(apply, [change], 0, cancelled))
+            except _Cancelled:
+                return errors + _cancelled_errors(changes[i:])
+            except Exception as e:
+                errors.append(_operation_error(change.path, "writing", e))
+        return errors
+
+    def _call(
+        self,
+        function: Callable,
+        items: list,
+        retries: int,
+        cancelled: threading.Event = None,
+    ):
+        """Call a function over some paths, retrying it up to 'retries' times
+        after the transient errors, unless 'cancelled' is set meanwhile."""
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(len(items))
+            if cancelled is not None and cancelled.is_set():
+                raise _Cancelled()
+            try:
+                return function(items)
+            except Exception as e:
+                if attempt >= retries or classify_error(e) != TRANSIENT:
+                    raise
+            logic_stats.count("tag_retries")
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            self._sleep(delay * random.uniform(0.5, 1.0))
+            attempt += 1
+
+
+class _Cancelled(Exception):
+    """Raised instead of starting an operation that is not awaited any more."""
+
+
+def _cancelled_errors(changes: List[TagChange]) -> List[Exception]:
+    """Return a timeout error for every change left unapplied by a cancel."""
+    return [TagOperationTimeoutError(c.path, operation="writing") for c in changes]
+
+
+def _operation_error(path: str, operation: str, error: Exception) -> Exception:
+    """Wrap the error of an operation over a path, with its class."""
+    if isinstance(error, TagOperationError) and error.path is None and error.cause:
+        error = error.cause  # Of several paths, now narrowed down to this one
+    kind = classify_error(error)
+    if kind == MISSING:
+        return FileNotFoundError(path)
+    return TagOperationError(path, operation=operation, kind=kind, cause=error)
+
+
+def failed_paths(errors: [Exception], paths: Iterable[str]) -> set:
+    """Return the paths of the tagging errors. An error without a path could
+    be of any of the given 'paths'."""
+    failed = set()
+    for error in errors:
+        if not error.args or not isinstance(error.args[0], str):
+            return set(paths)
+        failed.add(error.args[0])
+    return failed
+
+
+class FailureReport:
+    """Abstraction of the paths of a node that the last dump could not
+    apply.
+
+    The report is bound to the machine and the node path, and stored as a
+    JSON file in the local state directory:
+    '{"format": "ftb-failures", "version": 1, "machine": machine,
+    "root": root, "manifest": manifest_path, "failures": [{"path": path,
+    "kind": kind, "error": error}]}', with the paths relative to the node,
+    or 'null' for the errors without a path.
+    """
+
+    def __init__(self, root: str, manifest_path: str, state_dir: str = None):
+        """
+        :param root: The node path.
+        :param manifest_path: The path of the manifest dumped to the node.
+        :param state_dir: The directory of the local state. By default, see
+            'default_state_dir'.
+        """
+        self.machine = platform.node()
+        self.root = root
+        self.manifest_path = manifest_path
+        self.failures = []  # Dicts with the 'path', 'kind' and 'error'
+        self.path = node_state_path(root, manifest_path, state_dir) + ".failures"
+
+    @classmethod
+    def load(
+        cls, root: str, manifest_path: str, state_dir: str = None
+    ) -> "FailureReport":
+        """Read the failure report of a node.
+
+        A missing, broken or foreign report is handled as an empty one.
+
+        :param root: The node path.
+        :param manifest_path: The path of the manifest dumped to the node.
+        :param state_dir: The directory of the local state.
+        :return: The loaded report.
+        """
+        report = cls(root, manifest_path, state_dir)
+        try:
+            with open(report.path, "r", encoding="utf-8") as infile:
+                data = json.load(infile)
+            if (
+                data["format"] == properties.FAILURE_REPORT_FORMAT
+                and data["version"] == properties.FAILURE_REPORT_VERSION
+                and data["machine"] == report.machine
+                and data["root"] == root
+            ):
+                report.failures = [
+                    {"path": f["path"], "kind": f["kind"], "error": f["error"]}
+                    for f in data["failures"]
+                ]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return report
+
+    def add(self, errors: List[Exception]) -> None:
+        """Add the errors of a dump.
+
+        :param errors: The errors. Their paths are the first argument, as
+            in 'FileNotFoundError' and 'TagOperationError'.
+        """
+        for error in errors:
+            path = None
+            if error.args and isinstance(error.args[0], str):
+                path = relative_path(error.args[0], self.root)
+            self.failures.append(
+                {"path": path, "kind": classify_error(error), "error": str(error)}
+            )
+
+    @property
+    def paths(self) -> Union[List[str], None]:
+        """The absolute paths of the failures, sorted, or 'None' if some
+        failure has no path, so the whole node should be applied again."""
+        paths = set()
+        for failure in self.failures:
+            if failure["path"] is None:
+                return None
+            paths.add(absolute_path(failure["path"], self.root))
+        return sorted(paths)
+
+    def to_dict(self) -> dict:
+        return {
+            "format": properties.FAILURE_REPORT_FORMAT,
+            "version": properties.FAILURE_REPORT_VERSION,
+            "machine": self.machine,
+            "root": self.root,
+            "manifest": self.manifest_path,
+            "failures": self.failures,
+        }
+
+    def save(self, path: str = None) -> None:
+        """Write the report, or remove it if there are no failures.
+
+        :param path: The path of the file. By default, the one of the node
+            in the local state directory.
+        """
+        path = path or self.path
+        if not self.failures and path == self.path:
+            if os.path.lexists(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        data = json.dumps(self.to_dict(), ensure_ascii=False, indent=1)
+        with AtomicFile(path) as outfile:
+            outfile.write(data.encode("utf-8", "surrogateescape") + b"\n")
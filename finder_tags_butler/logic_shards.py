@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Manifest shards.
+
+The manifest of a very large node can be split in shards, so a tag change
+only rewrites the shard of its path, and a dump only reads the shards that
+have changed since the last time they were applied on the machine.
+
+Every entry goes to a shard chosen by a hash of the top level name of its
+path inside the node, so all the entries of a top level subdirectory are in
+the same shard. The shards are regular manifest files in a directory next to
+the manifest file, which is then a small root index with a checksum of the
+entries of every shard. See 'ManifestWriter' and 'ManifestReader'.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import shutil
+from typing import Dict, List
+
+from finder_tags_butler import properties
+from finder_tags_butler.logic_journal import HARD_DUMP, node_state_path
+from finder_tags_butler.logic_paths import relative_path
+
+APPLIED_VERSION = 1
+
+
+class ShardChecksum:
+    """Checksum of the entries of a shard, independent of its file format."""
+
+    def __init__(self):
+        self._digest = hashlib.blake2b(digest_size=16)
+        self.entries = 0
+
+    def update(self, path: str, tags: List[str]) -> None:
+        """Add an entry, with its path relative to the node."""
+        self._digest.update(json.dumps([path, tags], ensure_ascii=False).encode())
+        self._digest.update(b"\n")
+        self.entries += 1
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+class AppliedShards:
+    """Abstraction of the checksums of the shards last applied on a node.
+
+    They are bound to the machine and the node path, since the tags of the
+    node only match them there. The mode of the dump that applied every shard
+    is kept too, as a shard is only skipped by a dump that is not stronger,
+    see 'logic_journal.dump_mode', and the key of the walk rules of the last
+    one, as the paths out of a limited walk were never applied.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        shards: int = None,
+        checksums: Dict = None,
+        mode: int = HARD_DUMP,
+        rules: str = None,
+    ):
+        """
+        :param root: The node path.
+        :param shards: The number of shards of the manifest.
+        :param checksums: A dict with the checksum of every applied shard.
+        :param mode: The mode of the dump that applied them. By default, the
+            strongest one, as after a save the node matches the manifest.
+        :param rules: The key of the walk rules that applied them, see
+            'WalkRules.key'.
+        """
+        self.machine = platform.node()
+        self.root = root
+        self.shards = shards
+        self.checksums = checksums if checksums is not None else {}
+        self.modes = {s: mode for s in self.checksums}  # Shard -> mode
+        self.rules = rules
+
+    @classmethod
+    def load(cls, path: str, root: str) -> "AppliedShards":
+        """Read a file of applied shards.
+
+        A missing, broken or foreign file returns no applied shards, so all of
+        them are applied again.
+
+        :param path: The path of the file.
+        :param root: The node path.
+        :return: The loaded applied shards.
+        """
+        applied = cls(root)
+        try:
+            with open(path, "r", encoding="utf-8") as infile:
+                data = json.load(infile)
+            if (
+                data["version"] != APPLIED_VERSION
+                or data["machine"] != applied.machine
+                or data["root"] != root
+            ):
+                return applied
+            applied.shards = data["shards"]
+            applied.rules = data["rules"]
+            applied.checksums = {int(s): c for s, c in data["checksums"].items()}
+            applied.modes = {int(s): m for s, m in data["modes"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        return applied
+
+    def save(self, path: str) -> None:
+        """Write the applied shards to a file.
+
+        :param path: The path of the file.
+        """
+        data = {
+            "version": APPLIED_VERSION,
+            "machine": self.machine,
+            "root": self.root,
+            "shards": self.shards,
+            "rules": self.rules,
+            "checksums": {str(s): c for s, c in sorted(self.checksums.items())},
+            "modes": {str(s): m for s, m in sorted(self.modes.items())},
+        }
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump(data, outfile, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def pending(
+        self, checksums: Dict[int, str], shards: int, mode: int, rules: str = None
+    ) -> set:
+        """Return the shards to apply to bring the node to a manifest.
+
+        :param checksums: The checksums of the shards of the manifest.
+        :param shards: The number of shards of the manifest.
+        :param mode: The mode of the dump.
+        :param rules: The key of the walk rules of the dump. With other ones
+            than the last time, all the shards are pending.
+        :return: The set of the shards of the manifest that have changed
+            since they were applied, or were applied by a weaker dump, and
+            the ones that were applied but have been emptied since.
+        """
+        if shards != self.shards or rules != self.rules:
+            return set(range(shards))
+        changed = {
+            s
+            for s, c in checksums.items()
+            if self.checksums.get(s) != c or self.modes.get(s, -1) < mode
+        }
+        return changed | set(self.checksums).difference(checksums)
+
+    def update(
+        self, checksums: Dict[int, str], shards: int, mode: int, rules: str = None
+    ) -> None:
+        """Set the shards of a manifest as applied.
+
+        :param checksums: The checksums of the shards of the manifest.
+        :param shards: The number of shards of the manifest.
+        :param mode: The mode of the dump. The shards left unchanged keep the
+            mode they were applied with, which is at least as strong.
+        :param rules: The key of the walk rules of the dump.
+        """
+        if shards != self.shards or rules != self.rules:
+            self.checksums = {}
+        self.modes = {
+            s: (
+                max(self.modes.get(s, mode), mode)
+                if self.checksums.get(s) == c
+                else mode
+            )
+            for s, c in checksums.items()
+        }
+        self.shards = shards
+        self.rules = rules
+        self.checksums = dict(checksums)
+
+
+def shard_of(path: str, root: str, shards: int) -> int:
+    """Return the shard of a path.
+
+    :param path: The absolute path.
+    :param root: The node path.
+    :param shards: The number of shards.
+    :return: The shard number, between 0 and 'shards' - 1.
+    """
+    top = relative_path(path, root).split(os.sep, 1)[0]
+    digest = hashlib.blake2b(top.encode("utf-8", "surrogateescape"), digest_size=8)
+    return int.from_bytes(digest.digest(), "big") % shards
+
+
+def applied_shards_path(root: str, manifest_path: str, state_dir: str = None) -> str:
+    """Return the path of the file of applied shards of a node, in the local
+    state directory, as every machine has its own.
+
+    :param root: The node path.
+    :param manifest_path: The path of the manifest of the node.
+    :param state_dir: The directory of the local state. By default, see
+        'logic_journal.default_state_dir'.
+    """
+    return node_state_path(root, manifest_path, state_dir) + ".applied"
+
+
+def remove_shards(root: str, manifest_path: str) -> None:
+    """Remove the shards of a previous save of a manifest, if any."""
+    shards_dir = os.path.join(
+        os.path.dirname(manifest_path), properties.MANIFEST_SHARDS_DIR_NAME
+    )
+    if os.path.isdir(shards_dir):
+        shutil.rmtree(shards_dir)
+    applied_path = applied_shards_path(root, manifest_path)
+    if os.path.lexists(applied_path):
+        os.remove(applied_path)
+
+
+def shard_file_path(manifest_path: str, shard: int) -> str:
+    """Return the path of the file of a shard of a manifest."""
+    return os.path.join(
+        os.path.dirname(manifest_path),
+        properties.MANIFEST_SHARDS_DIR_NAME,
+        f"{shard:04x}",
+    )
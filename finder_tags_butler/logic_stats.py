@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Instrumentation.
+
+A 'Stats' collector gathers the wall time of every phase of a save or a dump,
+counters of the paths and tags processed, latency histograms of the backend
+calls and the bytes of the manifest read and written. Hooks receive the same
+data as structured events, e.g. to feed a monitoring collector.
+
+The collector in use is selected with 'set_stats'. By default there is no
+one, and the module functions 'phase', 'count' and 'observe' do nothing, so
+the instrumentation costs nothing when it is not asked for.
+"""
+
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Union
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Stats:
+    """Collector of the instrumentation data of a run.
+
+    It is thread safe, so the workers can report to it.
+    """
+
+    def __init__(self):
+        self.phases = {}  # Name -> seconds
+        self.counters = {}  # Name -> value
+        self.histograms = {}  # Name -> counts by bucket, the last is overflow
+        self.hooks = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Callable[[dict], None]) -> None:
+        """Register a function to receive every event.
+
+        The events are dicts with an 'event' key: 'phase' events have the
+        'name' and 'seconds' of a finished phase, 'call' events have the
+        'name' and 'seconds' of a backend call and the 'summary' event, sent
+        by 'summary', has all the collected data.
+
+        :param hook: The function to call with every event.
+        """
+        self.hooks.append(hook)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Measure the wall time of a block as a phase.
+
+        A phase measured several times accumulates its time.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Add the wall time of a phase measured elsewhere."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self._emit({"event": "phase", "name": name, "seconds": seconds})
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Increase a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Add the latency of a call to its histogram."""
+        milliseconds = seconds * 1000
+        bucket = 0
+        while (
+            bucket < len(HISTOGRAM_BOUNDS_MS)
+            and milliseconds > HISTOGRAM_BOUNDS_MS[bucket]
+        ):
+            bucket += 1
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+            histogram[bucket] += 1
+        self._emit({"event": "call", "name": name, "seconds": seconds})
+
+    def summary(self) -> dict:
+        """Return all the collected data, also sending it to the hooks.
+
+        :return: A dict with the total 'seconds', the 'phases' seconds, the
+            'counters', the 'histograms' with the counts by bucket upper bound
+            in milliseconds and the 'peak_memory_kb' of the process.
+        """
+        bounds = [str(b) for b in HISTOGRAM_BOUNDS_MS] + ["inf"]
+        with self._lock:
+            data = {
+                "seconds": time.perf_counter() - self._started,
+                "phases": dict(self.phases),
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: dict(zip(bounds, counts))
+                    for name, counts in self.histograms.items()
+                },
+                "peak_memory_kb": _peak_memory_kb(),
+            }
+        self._emit(dict(data, event="summary"))
+        return data
+
+    def _emit(self, event: dict) -> None:
+        for hook in self.hooks:
+            hook(event)
+
+
+_stats = None  # The collector in use, see 'set_stats'
+
+
+def get_stats() -> Union[Stats, None]:
+    """Return the collector in use, or 'None' if there is no one."""
+    return _stats
+
+
+def set_stats(stats: Union[Stats, None]) -> Union[Stats, None]:
+    """Select the collector to use.
+
+    :param stats: A 'Stats' instance, or 'None' to disable the
+        instrumentation.
+    :return: The selected collector.
+    """
+    global _stats
+    _stats = stats
+    return _stats
+
+
+def phase(name: str):
+    """Measure the wall time of a block, if there is a collector in use."""
+    if _stats is None:
+        return _NULL_PHASE
+    return _stats.phase(name)
+
+
+def count(name: str, value: int = 1) -> None:
+    """Increase a counter, if there is a collector in use."""
+    if _stats is not None:
+        _stats.count(name, value)
+
+
+def observe(name: str, seconds: float) -> None:
+    """Add the latency of a call, if there is a collector in use."""
+    if _stats is not None:
+        _stats.observe(name, seconds)
+
+
+def timed_call(name: str, function: Callable, *args):
+    """Call a function, observing its latency if there is a collector in use."""
+    if _stats is None:
+        return function(*args)
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        _stats.observe(name, time.perf_counter() - start)
+
+
+def timed_iter(name: str, iterable) -> Iterator:
+    """Iterate, accumulating the time spent producing the items as a phase.
+
+    Useful for the lazy steps, like the tree walk, which are interleaved with
+    the rest of the work.
+    """
+    if _stats is None:
+        yield from iterable
+        return
+    stats = _stats
+    iterator = iter(iterable)
+    seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, _END)
+            seconds += time.perf_counter() - start
+            if item is _END:
+                return
+            yield item
+    finally:
+        stats.add_time(name, seconds)
+
+
+def format_summary(data: dict) -> [str]:
+    """Return the readable lines of a 'Stats.summary'."""
+    lines = [f"Total: {data['seconds']:.3f} s"]
+    for name, seconds in sorted(data["phases"].items()):
+        lines.append(f"Phase {name}: {seconds:.3f} s")
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f"{name}: {value}")
+    for name, histogram in sorted(data["histograms"].items()):
+        buckets = ", ".join(f"<={b} ms: {n}" for b, n in histogram.items() if n)
+        lines.append(f"{name} latency: {buckets}")
+    if data["peak_memory_kb"] is not None:
+        lines.append(f"Peak memory: {data['peak_memory_kb']} KB")
+    return lines
+
+
+_END = object()  # End mark of 'timed_iter'
+
+
+class _NullPhase:
+    """Context manager that does nothing, see 'phase'."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def _peak_memory_kb() -> Union[int, None]:
+    """Return the peak resident memory of the process, if available."""
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # Bytes on Mac OS
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Subpath filters.
+
+A dump can be limited to some subtrees of the node, given by patterns
+relative to it, like 'Projects/ftb' or 'Projects/*/docs'. Every component of
+a pattern is matched with shell wildcards against a component of the path,
+and a path matches if it or one of its parents matches a whole pattern.
+
+The components of a pattern before its first wildcard are its literal
+prefix. The manifest entries are sorted by path, so the entries that can
+match a pattern are all together, just after its prefix: they are found by
+a binary search in the file, and the rest of the file is never read. In the
+same way, only the subtrees of the prefixes are walked, and their
+directories that can not hold a match are skipped.
+"""
+
+import os
+from fnmatch import fnmatchcase
+from typing import Iterable, List
+
+from finder_tags_butler.logic_paths import absolute_path, relative_path
+
+_WILDCARDS = set("*?[")
+
+
+class SubpathFilter:
+    """Abstraction of the subtrees of a node selected by several patterns."""
+
+    def __init__(self, root: str, patterns: Iterable[str]):
+        """
+        :param root: The node path.
+        :param patterns: The patterns of the subtrees, relative to the node.
+        :raise ValueError: If a pattern is not valid, see 'check_pattern'.
+        """
+        self.root = root
+        self.patterns = []  # Components of every pattern
+        for pattern in patterns:
+            check_pattern(pattern)
+            self.patterns.append(_components(pattern))
+
+    @property
+    def prefixes(self) -> List[str]:
+        """The literal prefixes of the patterns, relative to the node and
+        sorted, without the ones already covered by a shorter one. Every path
+        that can match starts with one of them."""
+        prefixes = set()
+        for components in self.patterns:
+            literal = _literal(components)
+            if len(literal) < len(components):  # Add the start of the next one
+                wildcard = components[len(literal)]
+                start = min(wildcard.find(c) for c in _WILDCARDS if c in wildcard)
+                literal = literal + [wildcard[:start]]
+            prefixes.add(os.sep.join(literal))
+        kept = []
+        for prefix in sorted(prefixes):
+            if not kept or not prefix.startswith(kept[-1]):
+                kept.append(prefix)
+        return kept
+
+    @property
+    def subtrees(self) -> List[str]:
+        """The absolute paths of the deepest directories, or files, that hold
+        all the matches of every pattern, sorted and without the ones inside
+        another."""
+        subtrees = sorted({os.sep.join(_literal(p)) for p in self.patterns})
+        kept = []
+        for subtree in subtrees:
+            if not any(k == "" or subtree.startswith(k + os.sep) for k in kept):
+                kept.append(subtree)
+        return [absolute_path(s, self.root) for s in kept]
+
+    def matches(self, path: str) -> bool:
+        """Tell if a path is in one of the selected subtrees.
+
+        :param path: The absolute path.
+        """
+        path = relative_path(path, self.root)
+        if os.path.isabs(path):  # Out of the node
+            return False
+        components = _components(path)
+        return any(
+            len(components) >= len(p) and _match(components, p) for p in self.patterns
+        )
+
+    def may_contain(self, path: str) -> bool:
+        """Tell if a directory is in one of the selected subtrees or can
+        contain one of them.
+
+        :param path: The absolute path of the directory.
+        """
+        path = relative_path(path, self.root)
+        if os.path.isabs(path):
+            return False
+        components = _components(path)
+        return any(_match(components, p) for p in self.patterns)
+
+
+def check_pattern(pattern: str) -> None:
+    """Check that a subpath pattern is relative to the node and inside it.
+
+    :raise ValueError: If the pattern is not valid.
+    """
+    if not pattern or os.path.isabs(pattern):
+        raise ValueError(f"the subpath '{pattern}' must be relative to the node")
+    if os.pardir in pattern.split(os.sep):
+        raise ValueError(f"the subpath '{pattern}' must be inside the node")
+
+
+def _components(path: str) -> List[str]:
+    """Split a relative path in its components, ignoring the empty and '.'
+    ones."""
+    return [c for c in path.split(os.sep) if c and c != os.curdir]
+
+
+def _literal(components: List[str]) -> List[str]:
+    """Return the components of a pattern before the first wildcard."""
+    literal = []
+    for component in components:
+        if _WILDCARDS.intersection(component):
+            break
+        literal.append(component)
+    return literal
+
+
+def _match(components: List[str], pattern: List[str]) -> bool:
+    """Tell if the components match the first ones of a pattern."""
+    return all(fnmatchcase(c, p) for c, p in zip(components, pattern))
@@ -12,29 +12,36 @@
 
 """Tags functions.
 
-This file simply closures some functions to manage Finder tags.
+This file simply closures some functions to manage Finder tags. All of them
+delegate to the tag backend in use, see 'logic_backends'.
 """
 
-import mac_tag
+from typing import Dict, Iterable, List
 
+from finder_tags_butler import logic_stats
+from finder_tags_butler.logic_backends import get_backend, TagChange, ALL_TAGS
 
-def get_finder_tags_for_path(path: str) -> [dict]:
+
+def get_finder_tags_for_path(path: str) -> [str]:
     """Returns the Finder tags for a given file or folder.
 
     :param path: The path of the file of folder to examine.
     :raise FileNotFoundError: If the path does not points to anything reachable.
-    :return: A list of tags as a dict with their titles and colors names.
+    :return: A list of tag names.
+    """
+    return get_backend().get_many([path])[path]
+
+
+def get_finder_tags_for_paths(paths: Iterable[str]) -> Dict[str, List[str]]:
+    """Returns the Finder tags for several files or folders.
+
+    :param paths: The paths of the files or folders to examine.
+    :raise FileNotFoundError: If some path does not points to anything
+        reachable.
+    :return: A dict with the list of tag names of every path.
     """
-    try:
-        tags_dict = mac_tag.get(path)
-        tags = []
-        """Access in a unnatural way due to some conflicts with complicated 
-        paths... It is known that the dict will only contain one value"""
-        for e in tags_dict:
-            tags.extend(tags_dict[e])
-        return tags
-    except FileNotFoundError:
-        raise FileNotFoundError(path)
+    backend = get_backend()
+    return logic_stats.timed_call("backend.get_many", backend.get_many, paths)
 
 
 def add_finder_tag_for_path(path: str, tag: str) -> None:
@@ -44,7 +51,7 @@ def add_finder_tag_for_path(path: str, tag: str) -> None:
     :param tag: The tag name to set.
     """
     if tag:
-        mac_tag.add(tag, path)
+        _apply_or_raise([TagChange(path, add=[tag])])
     else:
         raise ValueError("Null tags are not valid")
 
@@ -55,7 +62,7 @@ def rm_finder_tag_for_path(path: str, tag: str) -> None:
     :param path: The path of the file of folder to edit.
     :param tag: The tag name to remove.
     """
-    mac_tag.remove(tag, path)
+    _apply_or_raise([TagChange(path, remove=[tag])])
 
 
 def rm_all_finder_tags_for_path(path: str) -> None:
@@ -63,6 +70,21 @@ def rm_all_finder_tags_for_path(path: str) -> None:
 
     :param path: The path of the file of folder to edit.
     """
-    tags = get_finder_tags_for_path(path)
-    for tag in tags:
-        mac_tag.remove(tag, path)
+    _apply_or_raise([TagChange(path, remove=ALL_TAGS)])
+
+
+def apply_finder_tag_changes(changes: Iterable[TagChange]) -> [Exception]:
+    """Apply several tag changes at once.
+
+    :param changes: The 'TagChange' list to apply.
+    :return: A list of errors of the changes that have not been applied.
+    """
+    backend = get_backend()
+    return logic_stats.timed_call("backend.apply_many", backend.apply_many, changes)
+
+
+def _apply_or_raise(changes: [TagChange]) -> None:
+    """Apply the changes raising the first error, if any."""
+    errors = get_backend().apply_many(changes)
+    if errors:
+        raise errors[0]
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Walks of the nodes.
+
+The saves, dumps, merges and watches walk the children of a node sorted by
+path, the same order as the manifest entries, so both can be merged in a
+single pass. The children are then processed by batches, reading their tags
+at once. See 'iter_children_of_path' and 'merge_entries'.
+"""
+
+import heapq
+import os
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from finder_tags_butler import logic_stats, properties
+from finder_tags_butler.logic_backends import get_backend
+from finder_tags_butler.logic_ignore import DEFAULT_RULES, WalkRules
+from finder_tags_butler.logic_manifest import TagAssociation
+from finder_tags_butler.logic_subpaths import SubpathFilter
+from finder_tags_butler.logic_tags import get_finder_tags_for_paths
+from finder_tags_butler.logic_workers import WorkerPool, scan_dir
+
+
+def get_children_of_path(
+    path: str, workers: WorkerPool = None, rules: WalkRules = DEFAULT_RULES
+) -> [str]:
+    """Return all the children files and folders recursively.
+
+    Discard hidden files and folders, and the ones excluded by the rules.
+
+    :param path: The path of the node directory to explore.
+    :param workers: A pool to walk the subdirectories concurrently. By
+        default, the tree is walked sequentially.
+    :param rules: The rules of the paths to walk, see 'logic_ignore'. By
+        default, all the visible ones.
+    :return: A sorted list with the children files and folders paths.
+    """
+    if workers is not None:
+        return sorted(workers.scan_tree(path, rules))
+    return list(iter_children_of_path(path, rules=rules))
+
+
+def iter_children_of_path(
+    path: str,
+    workers: WorkerPool = None,
+    keep: Callable[[str], bool] = None,
+    rules: WalkRules = DEFAULT_RULES,
+) -> Iterator[str]:
+    """Iterate all the children files and folders recursively, sorted by path.
+
+    Discard hidden files and folders, and the ones excluded by the rules.
+    Without workers, the tree is walked lazily, while the children are
+    consumed.
+
+    :param path: The path of the node directory to explore.
+    :param workers: A pool to walk the subdirectories concurrently. By
+        default, the tree is walked sequentially.
+    :param keep: A function that tells if the path itself and every one of
+        its direct children, with all its subtree, must be walked. By
+        default, all of them.
+    :param rules: The rules of the paths to walk, see 'logic_ignore'. By
+        default, all the visible ones.
+    :return: An iterator of the path and its children paths.
+    """
+    if keep is not None:
+        if keep(path):
+            yield path
+        yield from _iter_sorted_subtree(path, workers, keep, rules)
+        return
+    if workers is not None:
+        yield from get_children_of_path(path, workers, rules)
+        return
+
+    yield path
+    yield from _iter_sorted_subtree(path, rules=rules)
+
+
+def _iter_sorted_subtree(
+    path: str,
+    workers: WorkerPool = None,
+    keep: Callable[[str], bool] = None,
+    rules: WalkRules = DEFAULT_RULES,
+) -> Iterator[str]:
+    """Iterate the children of a directory in the order of their paths.
+
+    A directory path sorts before other names with it as prefix, but its
+    children sort as its name followed by a separator. So every directory
+    is sorted twice: by its name to yield itself and by its name and a
+    separator to yield its children.
+
+    The 'keep' function filters the direct children, see
+    'iter_children_of_path'. The subtrees are walked by the workers, if any.
+    """
+    entries, subdirs = scan_dir(path, rules)
+    subdirs = set(subdirs)
+    keys = []
+    for entry in entries:
+        if keep is not None and not keep(entry):
+            continue
+        name = os.path.basename(entry)
+        keys.append((name, entry, False))
+        if entry in subdirs:
+            keys.append((name + os.sep, entry, True))
+    keys.sort()
+
+    for _, entry, is_subtree in keys:
+        if not is_subtree:
+            yield entry
+        elif workers is not None:
+            yield from get_children_of_path(entry, workers, rules)[1:]
+        else:
+            yield from _iter_sorted_subtree(entry, rules=rules)
+
+
+def iter_children_of_subtrees(
+    only: SubpathFilter, workers: WorkerPool = None, rules: WalkRules = DEFAULT_RULES
+) -> Iterator[str]:
+    """Iterate the paths of the selected subtrees of a node, sorted by path.
+
+    Only the directories that can hold a match are listed, see
+    '_iter_matching_children'.
+
+    :param only: The selected subtrees.
+    :param workers: A pool to walk the matching subtrees concurrently. By
+        default, they are walked sequentially.
+    :param rules: The rules of the paths to walk, see 'logic_ignore'.
+    :return: An iterator of the matching paths.
+    """
+    iterators = []
+    for subtree in only.subtrees:
+        if rules.excludes(subtree):
+            continue
+        if only.matches(subtree):
+            if os.path.isdir(subtree):
+                iterators.append(iter_children_of_path(subtree, workers, rules=rules))
+            elif os.path.lexists(subtree):
+                iterators.append(iter([subtree]))
+        elif os.path.isdir(subtree):
+            iterators.append(_iter_matching_children(subtree, only, workers, rules))
+    return heapq.merge(*iterators)
+
+
+def _iter_matching_children(
+    path: str,
+    only: SubpathFilter,
+    workers: WorkerPool = None,
+    rules: WalkRules = DEFAULT_RULES,
+) -> Iterator[str]:
+    """Iterate the matching children of a directory that does not match, in
+    the order of their paths, see '_iter_sorted_subtree'.
+
+    The subdirectories that can not hold a match are skipped, the ones that
+    can are listed in the same way and the matching ones are fully walked.
+    """
+    entries, subdirs = scan_dir(path, rules)
+    subdirs = set(subdirs)
+    keys = []
+    for entry in entries:
+        name = os.path.basename(entry)
+        if only.matches(entry):
+            keys.append((name, entry, None))
+            if entry in subdirs:
+                keys.append((name + os.sep, entry, True))
+        elif entry in subdirs and only.may_contain(entry):
+            keys.append((name + os.sep, entry, False))
+    keys.sort()
+
+    for _, entry, full in keys:
+        if full is None:
+            yield entry
+        elif not full:
+            yield from _iter_matching_children(entry, only, workers, rules)
+        elif workers is not None:
+            yield from get_children_of_path(entry, workers, rules)[1:]
+        else:
+            yield from _iter_sorted_subtree(entry, rules=rules)
+
+
+def merge_entries(
+    children: Iterator[str], entries: Iterable[TagAssociation]
+) -> Iterator[Tuple[str, List[str], bool]]:
+    """Merge the sorted children of a node with the sorted manifest entries.
+
+    :param children: The sorted children paths.
+    :param entries: The sorted manifest entries.
+    :return: An iterator of tuples with every path, its tags in the manifest
+        and if it is a child of the node.
+    """
+    entries = _coalesce_entries(entries)
+    child = next(children, None)
+    entry = next(entries, None)
+    while child is not None or entry is not None:
+        if entry is None or (child is not None and child < entry.path):
+            yield child, [], True
+            child = next(children, None)
+        elif child is None or entry.path < child:
+            yield entry.path, entry.tags, False
+            entry = next(entries, None)
+        else:
+            yield child, entry.tags, True
+            child = next(children, None)
+            entry = next(entries, None)
+
+
+def _coalesce_entries(entries: Iterable[TagAssociation]) -> Iterator[TagAssociation]:
+    """Join the tags of the consecutive entries of the same path."""
+    last = None
+    for entry in entries:
+        if last is not None and last.path == entry.path:
+            last = TagAssociation(last.path, last.tags + entry.tags)
+            continue
+        if last is not None:
+            yield last
+        last = entry
+    if last is not None:
+        yield last
+
+
+def iter_batches(items: Iterable, workers: WorkerPool = None) -> Iterator[list]:
+    """Split an iterable into lists, big enough to feed all the workers."""
+    size = properties.TAG_BACKEND_CHUNK_SIZE
+    if workers is not None:
+        size *= workers.jobs
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_tags(paths: Iterable[str], workers: WorkerPool = None) -> dict:
+    """Read the tags of several paths, concurrently if there are workers."""
+    with logic_stats.phase("read_tags"):
+        if workers is None:
+            tags = get_finder_tags_for_paths(paths)
+        else:
+            tags = workers.get_many(get_backend(), paths)
+    if logic_stats.get_stats() is not None:
+        logic_stats.count("paths_read", len(tags))
+        logic_stats.count("tags_read", sum(len(t) for t in tags.values()))
+    return tags
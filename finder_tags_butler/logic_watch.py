@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Watch mode.
+
+Instead of walking the whole node every time, the watcher keeps the manifest
+entries in memory and subscribes to the file system change notifications of
+the node. Bursts of events are debounced, then only the affected paths are
+read again, and the manifest is written to disk at a regular interval if it
+has changed.
+
+The events come from an event source:
+    - 'InotifyEventSource': Linux inotify, without external packages.
+    - 'PollingEventSource': walks and stats the node at a regular interval, as
+        a fallback for the rest of platforms.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from typing import Dict, Iterable, List
+
+from finder_tags_butler import properties
+from finder_tags_butler.logic_files import node_lock
+from finder_tags_butler.logic_identity import (
+    FingerprintCache,
+    build_identity_index,
+    fingerprint_cache_path,
+)
+from finder_tags_butler.logic_ignore import DEFAULT_RULES, WalkRules
+from finder_tags_butler.logic_layer import save_manifest
+from finder_tags_butler.logic_manifest import (
+    ManifestWriter,
+    TagAssociation,
+    load_manifest,
+)
+from finder_tags_butler.logic_shards import AppliedShards, applied_shards_path
+from finder_tags_butler.logic_walk import get_tags, iter_children_of_path
+from finder_tags_butler.logic_workers import WorkerPool, scan_dir, stat_paths
+
+# Inotify constants, see 'inotify(7)'
+_IN_ATTRIB = 0x00000004
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_WATCH_MASK = (
+    _IN_ATTRIB
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_MOVE_SELF
+    | _IN_ONLYDIR
+)
+_IN_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+_IN_READ_SIZE = 64 * 1024
+
+
+class EventSource:
+    """Base class of the file system event sources."""
+
+    def read(self, timeout: float) -> Dict[str, bool]:
+        """Wait for events.
+
+        :param timeout: The maximum seconds to wait.
+        :return: A dict with the changed paths of the node, telling for every
+            one if all its subtree has to be read again. It is empty if there
+            are no events.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release the resources of the source."""
+
+
+class InotifyEventSource(EventSource):
+    """Event source over Linux inotify.
+
+    inotify is not recursive, so every walked directory of the node is
+    watched and the new directories are watched as they appear.
+    """
+
+    def __init__(self, path: str, rules: WalkRules = DEFAULT_RULES):
+        """
+        :param path: The path of the node.
+        :param rules: The rules of the paths to watch, see 'logic_ignore'. By
+            default, all the visible ones.
+        :raise OSError: If inotify is not available or the node can not be
+            watched.
+        """
+        self.path = path
+        self.rules = rules
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise _errno_error("inotify_init1")
+        self._dirs = {}  # Watch descriptor -> directory path
+        try:
+            self._watch_tree(path)
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, timeout: float) -> Dict[str, bool]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return {}
+        try:
+            data = os.read(self._fd, _IN_READ_SIZE)
+        except BlockingIOError:
+            return {}
+
+        changed = {}
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = data[offset : offset + size].rstrip(b"\0")
+            offset += size
+
+            if mask & _IN_Q_OVERFLOW:  # Events lost, read all the node again
+                changed[self.path] = True
+                continue
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            if not name:  # Event of the watched directory itself
+                changed.setdefault(directory, False)
+                continue
+
+            child = os.path.join(directory, os.fsdecode(name))
+            if not self.rules.keep(child, bool(mask & _IN_ISDIR)):
+                continue
+            new_dir = mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO)
+            if new_dir and self.rules.descend(child):
+                try:
+                    self._watch_tree(child)
+                except OSError:  # Already removed
+                    pass
+            changed[child] = bool(changed.get(child) or new_dir)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _watch_tree(self, path: str) -> None:
+        """Watch a directory and all its walked subdirectories."""
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(directory), _IN_WATCH_MASK
+            )
+            if wd < 0:
+                error = _errno_error("inotify_add_watch", directory)
+                if directory == path:
+                    raise error
+                continue  # Removed while walking
+            self._dirs[wd] = directory
+            pending.extend(scan_dir(directory, self.rules)[1])
+
+
+class PollingEventSource(EventSource):
+    """Event source that compares the stat data of the node paths at a regular
+    interval.
+
+    Changing the tags of a file updates its status change time, so they are
+    detected like any other change.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        interval: float = properties.WATCH_POLL_INTERVAL,
+        workers: WorkerPool = None,
+        rules: WalkRules = DEFAULT_RULES,
+    ):
+        """
+        :param path: The path of the node.
+        :param interval: The seconds between two walks of the node.
+        :param workers: A pool to walk the node concurrently.
+        :param rules: The rules of the paths to walk, see 'logic_ignore'.
+        """
+        self.path = path
+        self.interval = interval
+        self.workers = workers
+        self.rules = rules
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def read(self, timeout: float) -> Dict[str, bool]:
+        wait = self._next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return {}
+        if wait > 0:
+            time.sleep(wait)
+        self._next_scan = time.monotonic() + self.interval
+
+        snapshot = self._scan()
+        changed = {p: False for p in self._snapshot if p not in snapshot}
+        changed.update(
+            (p, False) for p, st in snapshot.items() if self._snapshot.get(p) != st
+        )
+        self._snapshot = snapshot
+        return changed
+
+    def _scan(self) -> Dict[str, tuple]:
+        children = list(
+            iter_children_of_path(self.path, self.workers, rules=self.rules)
+        )
+        if self.workers is None:
+            stats = stat_paths(children)
+        else:
+            stats = self.workers.stat_many(children)
+        return {
+            p: (st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size)
+            for p, st in stats.items()
+        }
+
+
+class ManifestWatcher:
+    """Keep the manifest of a node up to date from its file system events."""
+
+    def __init__(
+        self,
+        path: str,
+        manifest_path: str,
+        events: EventSource = None,
+        debounce: float = properties.WATCH_DEBOUNCE,
+        flush_interval: float = properties.WATCH_FLUSH_INTERVAL,
+        use_cache: bool = True,
+        workers: WorkerPool = None,
+        manifest_format: str = None,
+        compression: str = None,
+        identity: bool = False,
+        shards: int = None,
+        max_depth: int = None,
+        follow_symlinks: bool = False,
+    ):
+        """
+        :param path: The path of the node.
+        :param manifest_path: The path of the manifest to keep.
+        :param events: The event source. By default, see 'open_event_source'.
+        :param debounce: The seconds without events to wait before reading the
+            changed paths.
+        :param flush_interval: The minimum seconds between two writes of the
+            manifest.
+        :param use_cache: Use the stat cache for the initial save, see
+            'save_manifest'.
+        :param workers: A pool to walk the tree and read the tags concurrently.
+        :param manifest_format: The format of the manifest, see
+            'save_manifest'.
+        :param compression: The compression of the manifest, see
+            'save_manifest'.
+        :param identity: Keep also the identity index of the manifest, see
+            'save_manifest'. It is built again with every write.
+        :param shards: The number of shards of the manifest, see
+            'save_manifest'.
+        :param max_depth: See 'save_manifest'.
+        :param follow_symlinks: See 'save_manifest'. The ignore file of the
+            node is read once, when the watcher is created.
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.manifest_path = os.path.abspath(os.path.expanduser(manifest_path))
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self.use_cache = use_cache
+        self.workers = workers
+        self.manifest_format = manifest_format
+        self.compression = compression
+        self.identity = identity
+        self.shards = shards
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.rules = WalkRules.load(self.path, max_depth, follow_symlinks)
+        self.entries = {}  # Path -> tags of the tagged paths
+        self.dirty = False
+        self._fingerprints = FingerprintCache()
+
+        # Subscribe before the initial save, so no change is lost
+        if events is None:
+            events = open_event_source(self.path, workers, rules=self.rules)
+        self.events = events
+        self._pending = {}
+        self._first_event = None
+        self._last_event = None
+        self._last_flush = time.monotonic()
+
+    def start(self) -> None:
+        """Save the manifest of all the node and load its entries."""
+        save_manifest(
+            self.path,
+            self.manifest_path,
+            use_cache=self.use_cache,
+            workers=self.workers,
+            manifest_format=self.manifest_format,
+            compression=self.compression,
+            identity=self.identity,
+            shards=self.shards,
+            max_depth=self.max_depth,
+            follow_symlinks=self.follow_symlinks,
+        )
+        if self.identity and self.use_cache:
+            self._fingerprints = FingerprintCache.load(
+                fingerprint_cache_path(self.path, self.manifest_path)
+            )
+        manifest = load_manifest(self.manifest_path, root=self.path)
+        self.entries = {e.path: e.tags for e in manifest.content}
+        self._last_flush = time.monotonic()
+
+    def run(self) -> None:
+        """Process events until interrupted, writing the pending changes on
+        exit."""
+        self.start()
+        try:
+            while True:
+                self.process(self._timeout())
+        finally:
+            self.close()
+
+    def process(self, timeout: float) -> None:
+        """Wait for events once, applying and writing them if it is time.
+
+        :param timeout: The maximum seconds to wait for events.
+        """
+        changed = self.events.read(timeout)
+        now = time.monotonic()
+        if changed:
+            for child, subtree in changed.items():
+                self._pending[child] = self._pending.get(child, False) or subtree
+            self._last_event = now
+            if self._first_event is None:
+                self._first_event = now
+
+        # Wait for the end of the burst, but not forever
+        if self._pending and (
+            now - self._last_event >= self.debounce
+            or now - self._first_event >= self.flush_interval
+        ):
+            pending = self._pending
+            self._pending = {}
+            self._first_event = None
+            self.update(pending)
+
+        if self.dirty and now - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def update(self, changed: Dict[str, bool]) -> None:
+        """Read again the entries of the changed paths.
+
+        :param changed: A dict with the changed paths, telling for every one if
+            all its subtree has to be read again.
+        """
+        removed = set()
+        rescanned = set()
+        to_read = []
+        for child, subtree in changed.items():
+            if not self._in_node(child):
+                continue
+            if not os.path.lexists(child):
+                removed.add(child)
+            elif subtree and os.path.isdir(child):
+                rescanned.add(child)
+                to_read.extend(
+                    iter_children_of_path(child, self.workers, rules=self.rules)
+                )
+            else:
+                to_read.append(child)
+
+        # Also all the children of the removed directories, and the paths of
+        # the read subtrees that are gone, e.g. removed while events were lost
+        if removed or rescanned:
+            walked = set(to_read)
+            stale = [
+                p
+                for p in self.entries
+                if _is_under(p, removed)
+                or (p not in walked and _is_under(p, rescanned))
+            ]
+            for entry_path in stale:
+                del self.entries[entry_path]
+            if stale:
+                self.dirty = True
+
+        for child, tags in self._read_tags(to_read).items():
+            if tags != self.entries.get(child, []):
+                self.dirty = True
+                if tags:
+                    self.entries[child] = tags
+                else:
+                    del self.entries[child]
+
+    def flush(self) -> None:
+        """Write the manifest with the current entries."""
+        with node_lock(self.path, self.manifest_path):
+            with ManifestWriter(
+                self.manifest_path,
+                manifest_format=self.manifest_format,
+                root=self.path,
+                compression=self.compression,
+                shards=self.shards,
+            ) as writer:
+                for entry_path in sorted(self.entries):
+                    entry = TagAssociation(entry_path, self.entries[entry_path])
+                    writer.write(entry)
+            if self.shards is not None:  # The node matches the written shards
+                AppliedShards(
+                    self.path, self.shards, writer.checksums, rules=self.rules.key
+                ).save(applied_shards_path(self.path, self.manifest_path))
+            if self.identity:
+                self._save_identity_index()
+        self.dirty = False
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """Apply and write the pending changes and stop watching."""
+        if self._pending:
+            pending = self._pending
+            self._pending = {}
+            self.update(pending)
+        if self.dirty:
+            self.flush()
+        self.events.close()
+
+    def _timeout(self) -> float:
+        """Return the seconds to wait for events before the next deadline."""
+        now = time.monotonic()
+        deadlines = []
+        if self._pending:
+            deadlines.append(self._last_event + self.debounce)
+        if self.dirty:
+            deadlines.append(self._last_flush + self.flush_interval)
+        if not deadlines:
+            return self.flush_interval
+        return max(0.0, min(deadlines) - now)
+
+    def _in_node(self, child: str) -> bool:
+        """Tell if a path is a walked path of the node."""
+        if child == self.path:
+            return True
+        if not child.startswith(self.path + os.sep):
+            return False
+        relative = child[len(self.path) + 1 :]
+        if any(name.startswith(".") for name in relative.split(os.sep)):
+            return False
+        return not self.rules.excludes(child)
+
+    def _save_identity_index(self) -> None:
+        """Fingerprint the tagged files and save the identity index."""
+        if self.workers is None:
+            stats = stat_paths(sorted(self.entries))
+        else:
+            stats = self.workers.stat_many(sorted(self.entries))
+        index_path = os.path.join(
+            os.path.dirname(self.manifest_path), properties.IDENTITY_INDEX_FILE_NAME
+        )
+        build_identity_index(self.path, stats, self._fingerprints).save(index_path)
+        if self.use_cache:
+            self._fingerprints.save(
+                fingerprint_cache_path(self.path, self.manifest_path)
+            )
+
+    def _read_tags(self, paths: List[str]) -> Dict[str, List[str]]:
+        """Read the tags of the paths, skipping the ones removed meanwhile."""
+        try:
+            return get_tags(paths, self.workers)
+        except FileNotFoundError:
+            tags = {}
+            for child in paths:
+                try:
+                    tags.update(get_tags([child]))
+                except FileNotFoundError:
+                    tags[child] = []
+            return tags
+
+
+def open_event_source(
+    path: str,
+    workers: WorkerPool = None,
+    polling: bool = False,
+    rules: WalkRules = DEFAULT_RULES,
+) -> EventSource:
+    """Return the best event source available for a node.
+
+    :param path: The path of the node.
+    :param workers: A pool to walk the node concurrently, if polling.
+    :param polling: Passing this param as 'True', polling is always used.
+    :param rules: The rules of the paths to watch, see 'logic_ignore'.
+    :return: An inotify event source on Linux, if possible, or a polling one.
+    """
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyEventSource(path, rules)
+        except (OSError, AttributeError):  # E.g. the watches limit is reached
+            pass
+    return PollingEventSource(path, workers=workers, rules=rules)
+
+
+def _is_under(child: str, paths: Iterable[str]) -> bool:
+    """Tell if a path is one of 'paths' or a descendant of one of them."""
+    while True:
+        if child in paths:
+            return True
+        parent = os.path.dirname(child)
+        if parent == child:
+            return False
+        child = parent
+
+
+_libc_instance = None  # See '_libc'
+
+
+def _libc():
+    """Return the C library, with the inotify functions."""
+    global _libc_instance
+    if _libc_instance is None:
+        _libc_instance = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc_instance.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+    return _libc_instance
+
+
+def _errno_error(function: str, path: str = None) -> OSError:
+    """Return the 'OSError' of the last failed C library call."""
+    errno = ctypes.get_errno()
+    return OSError(errno, f"{function}: {os.strerror(errno)}", path)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Worker pools.
+
+Walking a tree and reading tags are bound by I/O latency on network and cloud
+placeholder file systems, so a pool of workers can overlap a lot of them.
+"""
+
+import os
+from functools import partial
+from itertools import repeat
+from typing import Dict, Iterable, List
+
+from finder_tags_butler import logic_stats, properties
+from finder_tags_butler.logic_backends import (
+    BACKENDS,
+    MacTagBackend,
+    TagBackend,
+    _chunks,
+)
+from finder_tags_butler.logic_ignore import DEFAULT_RULES, WalkRules
+
+
+class WorkerPool:
+    """Abstraction of the workers used to walk trees and to read tags.
+
+    The tree walk always uses threads. The tags are read with threads too, or
+    with processes if asked for and the backend is the 'tag' one, which
+    already runs in external processes and can be rebuilt in every worker.
+    """
+
+    def __init__(self, jobs: int, processes: bool = False):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.jobs = jobs
+        self.threads = ThreadPoolExecutor(jobs)
+        self.processes = None
+        if processes:
+            # Imported apart, as it loads the whole 'multiprocessing'
+            from concurrent.futures import ProcessPoolExecutor
+
+            self.processes = ProcessPoolExecutor(jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        """Stop all the workers."""
+        self.threads.shutdown()
+        if self.processes is not None:
+            self.processes.shutdown()
+
+    def scan_tree(self, path: str, rules: WalkRules = DEFAULT_RULES) -> [str]:
+        """Return all the children files and folders of a directory, walking
+        its subdirectories concurrently.
+
+        :param path: The path of the directory to explore.
+        :param rules: The rules of the paths to walk, see 'scan_dir'.
+        :return: A list with the path and its children paths.
+        """
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        children = [path]
+        pending = {self.threads.submit(scan_dir, path, rules)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                children.extend(entries)
+                for subdir in subdirs:
+                    pending.add(self.threads.submit(scan_dir, subdir, rules))
+        return children
+
+    def get_many(
+        self, backend: TagBackend, paths: Iterable[str]
+    ) -> Dict[str, List[str]]:
+        """Read the tags of several paths concurrently, by chunks.
+
+        :param backend: The tag backend to use.
+        :param paths: The paths of the files or folders to examine.
+        :raise FileNotFoundError: If some path does not point to anything
+            reachable.
+        :return: A dict with the list of tag names of every path.
+        """
+        chunks = _chunks(list(paths), properties.TAG_BACKEND_CHUNK_SIZE)
+        if self.processes is not None and isinstance(backend, MacTagBackend):
+            results = self.processes.map(
+                _get_many_in_process, repeat(backend.name), chunks
+            )
+        else:
+            results = self.threads.map(
+                partial(logic_stats.timed_call, "backend.get_many", backend.get_many),
+                chunks,
+            )
+
+        tags = {}
+        for res in results:
+            tags.update(res)
+        return tags
+
+    def stat_many(self, paths: [str]) -> Dict[str, os.stat_result]:
+        """Stat several paths concurrently, by chunks.
+
+        :param paths: The paths to stat.
+        :return: A dict with the stat data of every reachable path.
+        """
+        chunks = _chunks(paths, properties.TAG_BACKEND_CHUNK_SIZE)
+        stats = {}
+        for res in self.threads.map(stat_paths, chunks):
+            stats.update(res)
+        return stats
+
+
+def stat_paths(paths: [str]) -> Dict[str, os.stat_result]:
+    """Return the stat data of every reachable path of 'paths'.
+
+    The symbolic links are not followed, as their tags are the ones of the
+    links themselves.
+    """
+    stats = {}
+    for path in paths:
+        try:
+            stats[path] = os.lstat(path)
+        except OSError:
+            continue
+    return stats
+
+
+def scan_dir(path: str, rules: WalkRules = DEFAULT_RULES) -> ([str], [str]):
+    """Return the entries of a single directory.
+
+    Unreadable directories are handled as empty ones, as 'os.walk' does.
+
+    :param path: The path of the directory to explore.
+    :param rules: The rules that tell the entries to keep and the
+        directories to explore. By default, all the visible ones, without
+        following the symbolic links.
+    :return: A tuple with the list of kept entry paths and the list of the
+        ones that are directories to explore.
+    """
+    entries = []
+    subdirs = []
+    follow_symlinks = rules.follow_symlinks
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                entry_path = os.path.join(path, entry.name)
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+                    is_symlink = follow_symlinks and is_dir and entry.is_symlink()
+                except OSError:
+                    is_dir = is_symlink = False
+                if not rules.keep(entry_path, is_dir):
+                    continue
+                entries.append(entry_path)
+                if is_dir and rules.descend(entry_path, is_symlink):
+                    subdirs.append(entry_path)
+    except OSError:
+        pass
+    return entries, subdirs
+
+
+_process_backend = None  # Backend of a worker process, see below
+
+
+def _get_many_in_process(backend_name: str, paths: [str]) -> Dict[str, List[str]]:
+    """Read tags from a worker process, building its backend once."""
+    global _process_backend
+    if _process_backend is None:
+        _process_backend = BACKENDS[backend_name]()
+    return _process_backend.get_many(paths)
@@ -21,3 +21,56 @@ MANIFEST_HEAD_COMMENT = (
     "# DO NOT EDIT THIS FILE BY HAND. COULD BE CORRUPTED!\n"
     "##############################################################\n\n"
 )
+
+# Tag backends
+TAG_BACKEND_ENV_VAR = "FTB_TAG_BACKEND"
+TAG_BACKEND_CHUNK_SIZE = 256  # Paths per 'tag' command line tool call
+TAGS_XATTR_NAME = "com.apple.metadata:_kMDItemUserTags"
+
+# Identity index, stored next to the manifest, see 'logic_identity'
+IDENTITY_INDEX_FILE_NAME = ".ftb.ids"
+IDENTITY_BLOCK_SIZE = 64 * 1024  # Bytes hashed at the start and end of a file
+
+# Local state of the machine, out of the nodes, see 'logic_journal'
+STATE_DIR_ENV_VAR = "FTB_STATE_DIR"
+STATE_DIR = "~/.local/state/finder-tags-butler"  # Unless set in the variable
+
+# Patterns of the paths not walked, stored in the root of the node, see
+# 'logic_ignore'
+IGNORE_FILE_NAME = ".ftbignore"
+
+# Clocks of the entries of a merged manifest, stored next to the manifest
+ENTRY_CLOCKS_FILE_NAME = ".ftb.clocks"
+
+# Manifest formats, see 'logic_manifest'
+MANIFEST_STREAM_FORMAT = "ftb-stream"
+MANIFEST_STREAM_VERSION = 1
+MANIFEST_FORMATS = ("stream", "binary")  # The first one is the default
+MANIFEST_COMPRESSIONS = ("gzip", "zstd")
+
+# Sharded manifests, see 'logic_shards'
+MANIFEST_SHARDS_FORMAT = "ftb-shards"
+MANIFEST_SHARDS_VERSION = 1
+MANIFEST_SHARDS_DIR_NAME = ".ftb.shards"  # Stored next to the manifest
+
+# Tag query indexes, stored in the local state directory, see 'logic_query'
+TAG_INDEX_FORMAT = "ftb-tag-index"
+TAG_INDEX_VERSION = 1
+
+# Retries of the tag operations and failure reports, see 'logic_retry'
+TAG_RETRIES = 3  # Retries of an operation failed by a transient error
+TAG_RETRY_BACKOFF = 0.5  # Seconds before the first retry, doubled every time
+TAG_RETRY_MAX_BACKOFF = 8.0  # Maximum seconds between two retries
+FAILURE_REPORT_FORMAT = "ftb-failures"
+FAILURE_REPORT_VERSION = 1
+
+# Dump pipeline, see 'logic_pipeline'
+PIPELINE_QUEUE_SIZE = 4  # Batches waiting between two stages, at most
+
+# Watch mode, see 'logic_watch'
+WATCH_DEBOUNCE = 1.0  # Seconds without events before reading the changes
+WATCH_FLUSH_INTERVAL = 30.0  # Minimum seconds between manifest writes
+WATCH_POLL_INTERVAL = 5.0  # Seconds between node walks, if polling
+
+# Batch mode, see 'logic_batch'
+BATCH_PARALLEL_NODES = 4  # Nodes processed at the same time, by default
@@ -25,6 +25,10 @@ setup(
     entry_points={"console_scripts": ["ftbutler=finder_tags_butler.__main__:main",],},
     python_requires=">=3.8.5",
     install_requires=["pyyaml==5.3.1", "mac-tag==0.0.0"],
+    extras_require={
+        "zstd": ["zstandard"],
+        "xattr": ['xattr; sys_platform == "darwin"'],
+    },
     data_files=[("", ["requirements.txt"]), ("", ["README.md"]), ("", ["LICENSE"]),],
     url="https://github.com/bglezseoane/finder-tags-butler",
     download_url=f"https://github.com/bglezseoane/finder-tags-butler/archive/{version}.tar.gz",
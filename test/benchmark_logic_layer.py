@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler benchmark suite for the logic layer.
+
+Generates a synthetic node and measures saving, dumping and reading and
+writing manifests against an in-process fake tag backend, so it runs on any
+platform. Every case runs in a fresh process, so its peak memory is its own.
+
+Run it from the repository root with:
+
+    python -m test.benchmark_logic_layer [--depth N] [--fanout N] ...
+
+The results are compared with the stored baselines and the regressions are
+flagged, returning a non-zero status. Use '--save-baseline' to store the
+current results as the new baselines.
+"""
+
+import argparse
+import builtins
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.logic_backends import MemoryBackend
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_manifest import load_manifest
+from finder_tags_butler.logic_query import open_tag_index
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baselines.json")
+CASES = (
+    "save",
+    "dump",
+    "soft_dump",
+    "hard_dump",
+    "manifest_round_trip",
+    "query",
+)
+TAGS_POOL_SIZE = 20
+DEFAULT_TOLERANCE = 0.5  # Allowed relative degradation, timings are noisy
+
+
+class LatencyBackend(MemoryBackend):
+    """Fake in-memory backend that waits a fixed time in every call, as the
+    real backends do, and counts the calls."""
+
+    name = "latency"
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+
+    def get_many(self, paths):
+        self._wait()
+        return super().get_many(paths)
+
+    def apply_many(self, changes):
+        self._wait()
+        return super().apply_many(changes)
+
+    def _wait(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class TreeShape:
+    """Abstraction of the shape of a synthetic node."""
+
+    def __init__(
+        self,
+        depth: int = 3,
+        fanout: int = 4,
+        files: int = 10,
+        tagged: float = 0.3,
+        tags_per_file: int = 2,
+    ):
+        """
+        :param depth: The levels of directories under the node.
+        :param fanout: The subdirectories of every directory.
+        :param files: The files of every directory.
+        :param tagged: The fraction of tagged paths.
+        :param tags_per_file: The tags of every tagged path.
+        """
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.tagged = tagged
+        self.tags_per_file = tags_per_file
+
+    def key(self) -> str:
+        """Return a name of the shape, to match the baselines."""
+        return (
+            f"d{self.depth}-f{self.fanout}-n{self.files}"
+            f"-t{self.tagged:g}-k{self.tags_per_file}"
+        )
+
+
+def generate_tree(root: str, shape: TreeShape) -> int:
+    """Create the directories and files of a synthetic node.
+
+    :param root: The path of the node, an existing directory.
+    :param shape: The shape of the node.
+    :return: The number of paths of the node, itself included.
+    """
+    count = 1
+    level = [root]
+    for depth in range(shape.depth + 1):
+        next_level = []
+        for directory in level:
+            for i in range(shape.files):
+                open(os.path.join(directory, f"file{i}.txt"), "a").close()
+                count += 1
+            if depth == shape.depth:
+                continue
+            for i in range(shape.fanout):
+                subdir = os.path.join(directory, f"dir{i}")
+                os.mkdir(subdir)
+                next_level.append(subdir)
+                count += 1
+        level = next_level
+    return count
+
+
+def synthetic_tags(root: str, path: str, shape: TreeShape) -> [str]:
+    """Return the tags of a path of a synthetic node.
+
+    The tags only depend on the path relative to the node, so every process
+    computes the same ones.
+    """
+    key = zlib.crc32(os.path.relpath(path, root).encode())
+    if key % 1000 >= shape.tagged * 1000:
+        return []
+    return [f"Tag {(key + i) % TAGS_POOL_SIZE}" for i in range(shape.tags_per_file)]
+
+
+def run_case(
+    case: str, root: str, shape: TreeShape, latency: float, paths: int
+) -> dict:
+    """Run a benchmark case in the current process.
+
+    :param case: One of 'CASES'.
+    :param root: The path of a node generated with 'generate_tree'.
+    :param shape: The shape of the node.
+    :param latency: The seconds that every backend call takes.
+    :param paths: The number of paths of the node.
+    :return: A dict with the measures.
+    """
+    backend = LatencyBackend(latency)
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for path in [directory] + [os.path.join(directory, f) for f in files]:
+            tags = synthetic_tags(root, path, shape)
+            if tags and not os.path.basename(path).startswith("."):
+                backend.tags[path] = tags
+    logic_backends.set_backend(backend)
+    os.environ[STATE_DIR_ENV_VAR] = os.path.join(root, ".state")  # Hidden
+    if case in ("manifest_round_trip", "query"):
+        paths = len(backend.tags)  # Only the tagged paths are in the manifest
+
+    manifest_path = os.path.join(root, MANIFEST_FILE_NAME)
+    if case != "save":
+        save_manifest(root, manifest_path, use_cache=False)
+    if case in ("dump", "soft_dump", "hard_dump"):
+        backend.tags = {}  # All the tags have to be dumped again
+    if case == "query":
+        open_tag_index(manifest_path, root)  # Only the cached index is timed
+    backend.calls = 0
+
+    syscalls = _SyscallCounter()
+    syscalls.start()
+    start = time.perf_counter()
+    if case == "save":
+        save_manifest(root, manifest_path, use_cache=False)
+    elif case == "dump":
+        dump_manifest(manifest_path, root, force_overwriting=None)
+    elif case == "soft_dump":
+        dump_manifest(manifest_path, root, force_overwriting=False)
+    elif case == "hard_dump":
+        dump_manifest(manifest_path, root, force_overwriting=True)
+    elif case == "manifest_round_trip":
+        load_manifest(manifest_path, root=root).save(f"{manifest_path}.copy")
+    elif case == "query":
+        open_tag_index(manifest_path, root).query("Tag 1 OR Tag 2 AND NOT Tag 3")
+    else:
+        raise ValueError(f"Unknown benchmark case '{case}'")
+    elapsed = time.perf_counter() - start
+    syscalls.stop()
+
+    return {
+        "paths_per_sec": paths / elapsed if elapsed else float("inf"),
+        "peak_rss_kb": _peak_rss_kb(),
+        "syscalls": syscalls.count,
+        "backend_calls": backend.calls,
+    }
+
+
+def run_benchmarks(
+    shape: TreeShape, latency: float, cases=CASES, repeat: int = 3
+) -> dict:
+    """Run the benchmark cases, every one in a fresh process and node.
+
+    Every case runs 'repeat' times and the best measures are kept, to reduce
+    the noise.
+
+    :return: A dict with the measures of every case.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for case in cases:
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as root:
+                paths = generate_tree(root, shape)
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    res = executor.submit(
+                        run_case, case, root, shape, latency, paths
+                    ).result()
+            best = results.setdefault(case, res)
+            best["paths_per_sec"] = max(best["paths_per_sec"], res["paths_per_sec"])
+            for measure in ("peak_rss_kb", "syscalls", "backend_calls"):
+                best[measure] = min(best[measure], res[measure])
+    return results
+
+
+def find_regressions(results: dict, baselines: dict, tolerance: float) -> [str]:
+    """Compare the results with the baselines of the same shape.
+
+    :return: A list with the description of every regression.
+    """
+    regressions = []
+    for case, measures in results.items():
+        baseline = baselines.get(case)
+        if baseline is None:
+            continue
+        if measures["paths_per_sec"] < baseline["paths_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{case}: {measures['paths_per_sec']:.0f} paths/sec, "
+                f"baseline {baseline['paths_per_sec']:.0f}"
+            )
+        for measure in ("peak_rss_kb", "syscalls", "backend_calls"):
+            if baseline.get(measure) is None:
+                continue
+            if measures[measure] > baseline[measure] * (1 + tolerance):
+                regressions.append(
+                    f"{case}: {measures[measure]} {measure}, "
+                    f"baseline {baseline[measure]}"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Finder Tags Butler benchmarks")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--tagged", type=float, default=0.3)
+    parser.add_argument("--tags-per-file", type=int, default=2)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.001,
+        help="Seconds that every backend call takes.",
+    )
+    parser.add_argument("--case", dest="cases", action="append", choices=CASES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    shape = TreeShape(
+        args.depth, args.fanout, args.files, args.tagged, args.tags_per_file
+    )
+    key = f"{shape.key()}-l{args.latency:g}"
+    results = run_benchmarks(shape, args.latency, args.cases or CASES, args.repeat)
+
+    print(f"{'case':<20} {'paths/sec':>12} {'peak RSS KB':>12} {'syscalls':>10}")
+    for case, measures in results.items():
+        print(
+            f"{case:<20} {measures['paths_per_sec']:>12.0f} "
+            f"{measures['peak_rss_kb']:>12} {measures['syscalls']:>10}"
+        )
+
+    try:
+        with open(args.baselines, "r") as infile:
+            baselines = json.load(infile)
+    except FileNotFoundError:
+        baselines = {}
+
+    if args.save_baseline:
+        baselines.setdefault(key, {}).update(results)
+        with open(args.baselines, "w") as outfile:
+            json.dump(baselines, outfile, indent=2, sort_keys=True)
+            outfile.write("\n")
+        print(f"Baselines saved for '{key}'.")
+        return 0
+
+    if key not in baselines:
+        print(f"No baselines for '{key}'.")
+        return 0
+    regressions = find_regressions(results, baselines[key], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+def _peak_rss_kb() -> int:
+    """Return the peak resident memory of the process, in KB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # Bytes on Mac OS
+
+
+class _SyscallCounter:
+    """Count the file system calls done through the 'os' module and 'open'.
+
+    Tracing the real system calls needs external tools, but all the file
+    system access of the package goes through these functions.
+    """
+
+    FUNCTIONS = ("stat", "lstat", "scandir", "listdir", "open", "replace", "rename")
+
+    def __init__(self):
+        self.count = 0
+        self._originals = {}
+
+    def start(self) -> None:
+        for name in self.FUNCTIONS:
+            self._originals[name] = getattr(os, name)
+            setattr(os, name, self._counting(self._originals[name]))
+        self._originals["builtins.open"] = builtins.open
+        builtins.open = self._counting(builtins.open)
+
+    def stop(self) -> None:
+        builtins.open = self._originals.pop("builtins.open")
+        for name, function in self._originals.items():
+            setattr(os, name, function)
+        self._originals = {}
+
+    def _counting(self, function):
+        def counting(*args, **kwargs):
+            self.count += 1
+            return function(*args, **kwargs)
+
+        return counting
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,25 +19,34 @@ import socket
 import string
 import tempfile
 import unittest
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import yaml
 
 from finder_tags_butler.logic_layer import (
-    _get_children_of_path,
     save_manifest,
     dump_manifest,
+    plan_dump,
     _validate_mainifest_file,
 )
+from finder_tags_butler.logic_manifest import Manifest
 from finder_tags_butler.logic_tags import (
     add_finder_tag_for_path,
     get_finder_tags_for_path,
     rm_all_finder_tags_for_path,
 )
-from finder_tags_butler.properties import MANIFEST_FILE_NAME
+from finder_tags_butler.logic_walk import get_children_of_path
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
 
 
 class IntegrationTestSuiteLogicLayer(TestCase):
+    def setUp(self):
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        patcher = mock.patch.dict(os.environ, {STATE_DIR_ENV_VAR: state_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_save_and_dump_manifest(self):
         """Test the full process to save and dump a manifest."""
         with tempfile.TemporaryDirectory() as sample_node:
@@ -45,7 +54,7 @@ class IntegrationTestSuiteLogicLayer(TestCase):
             _generate_random_folders_tree(sample_node)
 
             # Select some random files and folders
-            children = _get_children_of_path(sample_node)
+            children = get_children_of_path(sample_node)
             tagged_children = children[: (len(children) // 3)]  # Children subset
 
             # Create a list with a random tag name to each tagged child
@@ -76,8 +85,8 @@ class IntegrationTestSuiteLogicLayer(TestCase):
             dump_manifest(manifest_path, sample_node)
 
             # Check that the machine name is correctly stored
-            with open(manifest_path, "r") as infile:
-                file_manifest = yaml.load(infile, Loader=yaml.FullLoader)
+            file_manifest = Manifest()
+            file_manifest.load(manifest_path)
             self.assertEqual(file_manifest.machine, socket.gethostname())
 
             # Get current state and check against the previous one
@@ -97,13 +106,42 @@ class IntegrationTestSuiteLogicLayer(TestCase):
                     res_tags.remove(tags[i])
                     self.assertFalse(res_tags)
 
+    def test_hard_dump_manifest(self):
+        """Test that a hard dump removes the tags not in the manifest."""
+        with tempfile.TemporaryDirectory() as sample_node:
+            _generate_random_folders_tree(sample_node)
+            children = get_children_of_path(sample_node)
+            tagged_children = children[1 : (len(children) // 2)]
+
+            for child in tagged_children:
+                add_finder_tag_for_path(child, "Saved tag")
+            manifest_path = os.path.join(sample_node, MANIFEST_FILE_NAME)
+            save_manifest(sample_node, manifest_path)
+
+            # Change the tags after saving the manifest
+            add_finder_tag_for_path(children[-1], "Untracked tag")
+            rm_all_finder_tags_for_path(tagged_children[0])
+
+            changes, errors = plan_dump(
+                manifest_path, sample_node, force_overwriting=True
+            )
+            self.assertEqual(errors, [])
+            self.assertEqual(
+                {c.path for c in changes}, {children[-1], tagged_children[0]}
+            )
+
+            dump_manifest(manifest_path, sample_node, force_overwriting=True)
+            for child in children:
+                expected = ["Saved tag"] if child in tagged_children else []
+                self.assertEqual(get_finder_tags_for_path(child), expected)
+
     def test_manifest_files_validation(self):
         with tempfile.TemporaryDirectory() as sample_node:
             # Generate random stuff
             _generate_random_folders_tree(sample_node)
 
             # Select some random files and folders
-            children = _get_children_of_path(sample_node)
+            children = get_children_of_path(sample_node)
             tagged_children = children[: (len(children) // 3)]  # Children subset
 
             # Create a list with a random tag name to each tagged child
@@ -153,7 +191,7 @@ class IntegrationTestSuiteLogicLayer(TestCase):
             # Change name of component
             with open(manifest_path_copy3, "r") as f:
                 filedata = f.read()
-            filedata = filedata.replace("content", "wine")
+            filedata = filedata.replace('"tags"', '"wine"')
             with open(manifest_path_copy3, "w") as f:
                 f.write(filedata)
 
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the benchmark suite"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from test.benchmark_logic_layer import (
+    CASES,
+    TreeShape,
+    find_regressions,
+    generate_tree,
+    run_case,
+)
+
+
+class UnitTestSuiteBenchmarkLogicLayer(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        patcher = mock.patch.dict(os.environ)  # The cases set the state dir
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_generate_tree(self):
+        """Test that the generated node has the asked shape."""
+        with tempfile.TemporaryDirectory() as root:
+            paths = generate_tree(root, TreeShape(depth=2, fanout=2, files=3))
+            walked = sum(len(d) + len(f) for _, d, f in os.walk(root))
+            self.assertEqual(paths, walked + 1)
+            self.assertEqual(paths, 1 + 6 + (1 + 2 + 4) * 3)
+
+    def test_all_cases_run(self):
+        """Test that every case runs and reports its measures."""
+        shape = TreeShape(depth=1, fanout=2, files=2)
+        for case in CASES:
+            with tempfile.TemporaryDirectory() as root:
+                paths = generate_tree(root, shape)
+                res = run_case(case, root, shape, 0, paths)
+                self.assertGreater(res["paths_per_sec"], 0, case)
+                self.assertGreater(res["syscalls"], 0, case)
+                self.assertGreater(res["peak_rss_kb"], 0, case)
+
+    def test_regressions_are_flagged(self):
+        """Test the comparison of the results with the baselines."""
+        baselines = {
+            "save": {
+                "paths_per_sec": 1000,
+                "peak_rss_kb": 100,
+                "syscalls": 10,
+                "backend_calls": 1,
+            }
+        }
+        results = {
+            "save": {
+                "paths_per_sec": 500,
+                "peak_rss_kb": 110,
+                "syscalls": 20,
+                "backend_calls": 1,
+            }
+        }
+        regressions = find_regressions(results, baselines, 0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(find_regressions(results, {}, 0.25), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
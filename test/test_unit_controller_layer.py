@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the startup of the command
+line tool"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import TestCase
+
+from finder_tags_butler.properties import STATE_DIR_ENV_VAR, TAG_BACKEND_ENV_VAR
+
+# Modules that only some options need
+_HEAVY_MODULES = (
+    "concurrent.futures",
+    "finder_tags_butler.logic_layer",
+    "mac_tag",
+    "multiprocessing",
+    "platform",
+    "plistlib",
+    "yaml",
+)
+
+# Run the tool and print the loaded modules, even if it exits
+_RUN_SCRIPT = """
+import sys
+from finder_tags_butler import __main__
+sys.argv = ["ftbutler"] + sys.argv[1:]
+try:
+    __main__.main()
+except SystemExit:
+    pass
+print(" ".join(sys.modules), file=sys.stderr)
+"""
+
+
+class UnitTestSuiteControllerLayer(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.env = dict(
+            os.environ,
+            **{
+                STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state"),
+                TAG_BACKEND_ENV_VAR: "memory",
+            },
+        )
+
+    def _loaded_modules(self, *args: str) -> set:
+        """Run the tool in a fresh interpreter and return its loaded modules."""
+        process = subprocess.run(
+            [sys.executable, "-c", _RUN_SCRIPT, *args],
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+        return set(process.stderr.splitlines()[-1].split())
+
+    def _assert_not_loaded(self, modules: set, *names: str) -> None:
+        for name in names:
+            self.assertNotIn(name, modules)
+
+    def test_help_loads_no_logic(self):
+        """Test that the help and the invalid input do not load the heavy
+        modules."""
+        for args in (["-h"], ["-d"], ["-s", "-d", self.tmp_dir.name]):
+            self._assert_not_loaded(self._loaded_modules(*args), *_HEAVY_MODULES)
+
+    def test_runs_load_what_they_need(self):
+        """Test that the options only load the modules they use."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(node)
+        open(os.path.join(node, "file.txt"), "a").close()
+
+        modules = self._loaded_modules("-s", node)
+        self.assertIn("finder_tags_butler.logic_layer", modules)
+        self._assert_not_loaded(modules, "concurrent.futures", "yaml", "plistlib")
+        modules = self._loaded_modules("-d", node)
+        self._assert_not_loaded(modules, "concurrent.futures", "yaml", "plistlib")
+
+        # The queries do not load the tag operations
+        modules = self._loaded_modules("-q", "Red", node)
+        self.assertIn("finder_tags_butler.logic_query", modules)
+        self._assert_not_loaded(
+            modules, "finder_tags_butler.logic_layer", "finder_tags_butler.logic_retry"
+        )
+
+        # The concurrent workers and the batches need the pools
+        modules = self._loaded_modules("-d", "-j", "2", node)
+        self.assertIn("concurrent.futures", modules)
+        self._assert_not_loaded(modules, "multiprocessing", "yaml")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for tag backends"""
+
+import errno
+import os
+import plistlib
+import sys
+import tempfile
+import types
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.errors import TagOperationError
+from finder_tags_butler.logic_backends import (
+    ALL_TAGS,
+    MacTagBackend,
+    MemoryBackend,
+    TagChange,
+    XattrBackend,
+)
+from finder_tags_butler.logic_retry import TagOperationExecutor
+
+
+def _fake_mac_tag(key=None, failing=()):
+    """Return an in-memory stand-in of the 'mac_tag' module.
+
+    :param key: The function that turns a passed path into the key of the
+        results. By default, the path itself.
+    :param failing: The paths whose changes fail.
+    """
+    tags = {}
+    key = key or (lambda p: p)
+
+    def get(paths):
+        paths = [paths] if isinstance(paths, str) else paths
+        for path in paths:
+            if not os.path.lexists(path):
+                raise FileNotFoundError(path)
+        return {key(p): list(tags.get(p, [])) for p in reversed(paths)}
+
+    def change(tag, paths, add):
+        if set(paths) & set(failing):
+            raise OSError(errno.EIO, "I/O error")
+        for path in paths:
+            current = [t for t in tags.get(path, []) if t != tag]
+            tags[path] = current + [tag] if add else current
+
+    return types.SimpleNamespace(
+        tags=tags,
+        get=get,
+        add=lambda tag, paths: change(tag, paths, True),
+        remove=lambda tag, paths: change(tag, paths, False),
+    )
+
+
+class UnitTestSuiteLogicBackends(TestCase):
+    def _check_bulk_operations(self, backend):
+        with tempfile.TemporaryDirectory() as sample_folder:
+            paths = []
+            for i in range(5):
+                paths.append(os.path.join(sample_folder, f"file{i}.txt"))
+                open(paths[-1], "a").close()
+
+            errors = backend.apply_many(
+                [
+                    TagChange(p, add=["Sample tag 1", f"Tag {i}"])
+                    for i, p in enumerate(paths)
+                ]
+            )
+            self.assertEqual(errors, [])
+
+            res = backend.get_many(paths)
+            for i, path in enumerate(paths):
+                self.assertEqual(res[path], ["Sample tag 1", f"Tag {i}"])
+
+            # Remove one tag, add other and remove all in a single call
+            missing_path = os.path.join(sample_folder, "missing")
+            errors = backend.apply_many(
+                [
+                    TagChange(paths[0], remove=["Sample tag 1"]),
+                    TagChange(paths[1], add=["Sample tag 2"]),
+                    TagChange(paths[2], remove=ALL_TAGS),
+                    TagChange(paths[3], add=["New"], remove=ALL_TAGS),
+                    TagChange(missing_path, add=["Sample tag 1"]),
+                ]
+            )
+            self.assertEqual(len(errors), 1)
+            self.assertIsInstance(errors[0], FileNotFoundError)
+
+            res = backend.get_many(paths)
+            self.assertEqual(res[paths[0]], ["Tag 0"])
+            self.assertEqual(res[paths[1]], ["Sample tag 1", "Tag 1", "Sample tag 2"])
+            self.assertEqual(res[paths[2]], [])
+            self.assertEqual(res[paths[3]], ["New"])
+            self.assertEqual(res[paths[4]], ["Sample tag 1", "Tag 4"])
+
+            with self.assertRaises(FileNotFoundError):
+                backend.get_many([missing_path])
+
+    def test_memory_backend(self):
+        """Test the bulk operations of the fake in-memory backend."""
+        self._check_bulk_operations(MemoryBackend())
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "Linux only")
+    def test_xattr_backend(self):
+        """Test the bulk operations of the extended attributes backend."""
+        self._check_bulk_operations(XattrBackend())
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "Linux only")
+    def test_xattr_backend_keeps_colors(self):
+        """Test that the colors of the kept tags are preserved."""
+        backend = XattrBackend()
+        with tempfile.NamedTemporaryFile() as f:
+            raw_tags = ["Red\n6", "Work\n0"]
+            os.setxattr(
+                f.name,
+                backend.attribute,
+                plistlib.dumps(raw_tags, fmt=plistlib.FMT_BINARY),
+            )
+            self.assertEqual(backend.get_many([f.name])[f.name], ["Red", "Work"])
+
+            backend.apply_many([TagChange(f.name, add=["Home"], remove=["Work"])])
+            value = plistlib.loads(os.getxattr(f.name, backend.attribute))
+            self.assertEqual(value, ["Red\n6", "Home"])
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "Linux only")
+    def test_xattr_backend_errors(self):
+        """Test that the symbolic links are not followed and that only a
+        missing attribute is read as no tags."""
+        backend = XattrBackend()
+        with tempfile.TemporaryDirectory() as sample_folder:
+            target = os.path.join(sample_folder, "target")
+            open(target, "a").close()
+            backend.apply_many([TagChange(target, add=["Red"])])
+            link = os.path.join(sample_folder, "link")
+            os.symlink(target, link)
+            dangling = os.path.join(sample_folder, "dangling")
+            os.symlink(os.path.join(sample_folder, "missing"), dangling)
+
+            res = backend.get_many([target, link, dangling])
+            self.assertEqual(res, {target: ["Red"], link: [], dangling: []})
+
+            # The rest of errors are not hidden
+            error = OSError(errno.EIO, "I/O error")
+            with mock.patch.object(backend, "_getxattr", side_effect=error):
+                with self.assertRaises(OSError) as e:
+                    backend.get_many([target])
+            self.assertEqual(e.exception.errno, errno.EIO)
+
+    def test_mac_tag_backend_matches_paths(self):
+        """Test that the tags read by chunks are matched by path, and read one
+        by one if the tool returns other keys."""
+        with mock.patch.dict(sys.modules, {"mac_tag": _fake_mac_tag()}):
+            self._check_bulk_operations(MacTagBackend(chunk_size=2))
+
+        with tempfile.TemporaryDirectory() as sample_folder:
+            paths = [os.path.join(sample_folder, n) for n in ("a.txt", "b.txt")]
+            for path in paths:
+                open(path, "a").close()
+            mac_tag = _fake_mac_tag(key=str.upper)
+            mac_tag.tags.update({paths[0]: ["Red"], paths[1]: ["Blue"]})
+            with mock.patch.dict(sys.modules, {"mac_tag": mac_tag}):
+                res = MacTagBackend(chunk_size=2).get_many(paths)
+        self.assertEqual(res, {paths[0]: ["Red"], paths[1]: ["Blue"]})
+
+    def test_mac_tag_backend_chunk_errors(self):
+        """Test that a failed chunk is raised with its paths, so the executor
+        narrows the failure down to the bad path."""
+        with tempfile.TemporaryDirectory() as sample_folder:
+            paths = [os.path.join(sample_folder, f"file{i}.txt") for i in range(4)]
+            for path in paths:
+                open(path, "a").close()
+            mac_tag = _fake_mac_tag(failing=[paths[2]])
+            changes = [TagChange(p, add=["Red"]) for p in paths]
+            with mock.patch.dict(sys.modules, {"mac_tag": mac_tag}):
+                backend = MacTagBackend(chunk_size=2)
+                with self.assertRaises(TagOperationError) as e:
+                    backend.apply_many(changes)
+                self.assertEqual(e.exception.paths, paths[2:])
+
+                self.addCleanup(
+                    logic_backends.set_backend, logic_backends.get_backend()
+                )
+                logic_backends.set_backend(backend)
+                errors = TagOperationExecutor(retries=0).apply_many(changes)
+
+        self.assertEqual([e.path for e in errors], [paths[2]])
+        self.assertIsInstance(errors[0].cause, OSError)
+        self.assertEqual(
+            sorted(p for p, t in mac_tag.tags.items() if t == ["Red"]),
+            [paths[0], paths[1], paths[3]],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the batch mode"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.errors import InvalidBatchConfigFileError
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_batch import NodeTask, load_batch_config, run_batch
+from finder_tags_butler.logic_manifest import load_manifest
+from finder_tags_butler.logic_workers import WorkerPool
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+_DEFAULTS = {
+    "option": "save_opt",
+    "use_cache": True,
+    "dry_run": False,
+    "manifest_format": None,
+    "compression": None,
+    "identity": False,
+    "shards": None,
+    "only": None,
+    "max_depth": None,
+    "follow_symlinks": False,
+    "retry_failed": False,
+}
+
+
+class UnitTestSuiteLogicBatch(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config_path = os.path.join(self.tmp_dir.name, "config.yaml")
+
+    def _write_config(self, text: str) -> None:
+        with open(self.config_path, "w") as f:
+            f.write(text)
+
+    def test_config_file(self):
+        """Test that the nodes of a config file get their own options."""
+        self._write_config(
+            "parallel: 2\n"
+            "nodes:\n"
+            "  - /node/a\n"
+            "  - path: /node/b\n"
+            "    option: hard-dump\n"
+            "    format: binary\n"
+            "    compression: gzip\n"
+            "    cache: false\n"
+        )
+        tasks, parallel = load_batch_config(self.config_path, _DEFAULTS)
+
+        self.assertEqual(parallel, 2)
+        self.assertEqual([t.path for t in tasks], ["/node/a", "/node/b"])
+        self.assertEqual([t.option for t in tasks], ["save_opt", "hard_dump_opt"])
+        self.assertEqual(tasks[0].manifest_format, None)
+        self.assertEqual(tasks[1].manifest_format, "binary")
+        self.assertEqual(tasks[1].compression, "gzip")
+        self.assertEqual([t.use_cache for t in tasks], [True, False])
+
+    def test_invalid_config_files(self):
+        """Test that the invalid config files are rejected."""
+        for text in (
+            "- /node/a\n",
+            "nodes:\n  - path: /node/a\n    option: move\n",
+            "nodes:\n  - path: /node/a\n    compression: gzip\n",
+            "nodes:\n  - path: /node/a\n    option: dump\n    only: [/a]\n",
+            "nodes:\n  - path: /node/a\n    max-depth: 0\n",
+            "nodes:\n  - path: /node/a\n    retry-failed: true\n",
+            "nodes:\n  - path: /node/a\n    option: save\n    dry-run: true\n",
+            "nodes:\n  - /node/a\n  - /node/a/\n",
+            "parallel: 0\nnodes: []\n",
+            "nodes: [\n",
+        ):
+            self._write_config(text)
+            with self.assertRaises(InvalidBatchConfigFileError, msg=text):
+                load_batch_config(self.config_path, _DEFAULTS)
+
+    def test_run_batch(self):
+        """Test that every node is processed and the errors do not stop the
+        rest."""
+        nodes = []
+        for name in ("a", "b"):
+            nodes.append(os.path.join(self.tmp_dir.name, name))
+            os.mkdir(nodes[-1])
+            open(os.path.join(nodes[-1], "file.txt"), "a").close()
+            self.backend.apply_many(
+                [TagChange(os.path.join(nodes[-1], "file.txt"), add=[name])]
+            )
+        missing = os.path.join(self.tmp_dir.name, "missing")
+        tasks = [NodeTask(n, "save_opt") for n in nodes + [missing]]
+
+        with WorkerPool(2) as workers:
+            results = run_batch(tasks, workers, parallel=2)
+
+        self.assertEqual([r.task for r in results], tasks)
+        self.assertEqual([r.ok for r in results], [True, True, False])
+        self.assertIsInstance(results[2].error, NotADirectoryError)
+        for node, name in zip(nodes, ("a", "b")):
+            manifest = load_manifest(os.path.join(node, MANIFEST_FILE_NAME))
+            self.assertEqual([e.tags for e in manifest.content], [[name]])
+
+        # A dry run only plans the changes
+        self.backend.tags = {}
+        tasks = [NodeTask(n, "dump_opt", dry_run=True) for n in nodes]
+        results = run_batch(tasks)
+        self.assertEqual([len(r.changes) for r in results], [1, 1])
+        self.assertEqual(self.backend.tags, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
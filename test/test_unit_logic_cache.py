@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the stat cache"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends, logic_cache
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_layer import save_manifest
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+
+class _CountingBackend(MemoryBackend):
+    """Memory backend that remembers the paths read."""
+
+    def __init__(self):
+        super().__init__()
+        self.read_paths = []
+
+    def get_many(self, paths):
+        paths = list(paths)
+        self.read_paths.extend(paths)
+        return super().get_many(paths)
+
+
+class UnitTestSuiteLogicCache(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = _CountingBackend()
+        logic_backends.set_backend(self.backend)
+        patcher = mock.patch.object(logic_cache, "RACY_WINDOW_NS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.state_dir.cleanup)
+        patcher = mock.patch.dict(os.environ, {STATE_DIR_ENV_VAR: self.state_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_changed_paths_are_read(self):
+        """Test that a second save only reads the changed paths."""
+        with tempfile.TemporaryDirectory() as sample_node:
+            paths = []
+            for i in range(10):
+                paths.append(os.path.join(sample_node, f"file{i}.txt"))
+                open(paths[-1], "a").close()
+            self.backend.apply_many([TagChange(paths[0], add=["Sample tag"])])
+
+            manifest_path = os.path.join(sample_node, MANIFEST_FILE_NAME)
+            save_manifest(sample_node, manifest_path)
+            cache_path = logic_cache.stat_cache_path(sample_node, manifest_path)
+            self.assertTrue(cache_path.startswith(self.state_dir.name))
+            self.assertTrue(os.path.isfile(cache_path))
+            self.assertEqual(len(self.backend.read_paths), 11)  # Node included
+
+            # Nothing changed, but the node, since the manifest has been written
+            self.backend.read_paths = []
+            save_manifest(sample_node, manifest_path)
+            self.assertEqual(self.backend.read_paths, [sample_node])
+
+            # Change a file
+            with open(paths[3], "w") as f:
+                f.write("Changed")
+            self.backend.read_paths = []
+            save_manifest(sample_node, manifest_path)
+            self.assertEqual(self.backend.read_paths, [sample_node, paths[3]])
+
+            # Ignore the cache
+            self.backend.read_paths = []
+            save_manifest(sample_node, manifest_path, use_cache=False)
+            self.assertEqual(len(self.backend.read_paths), 11)
+
+    def test_rename_is_detected_by_inode(self):
+        """Test that a renamed path with unchanged stat data reuses its entry."""
+        with tempfile.TemporaryDirectory() as sample_node:
+            old_path = os.path.join(sample_node, "file.txt")
+            new_path = os.path.join(sample_node, "renamed.txt")
+            open(old_path, "a").close()
+            st = os.stat(old_path)
+            cache = logic_cache.StatCache()
+            cache.update({old_path: (st, ["Sample tag"])})
+
+            # The previous path still exists, so it is not a rename
+            self.assertIsNone(cache.lookup(new_path, st))
+
+            os.rename(old_path, new_path)
+            self.assertEqual(cache.lookup(new_path, st), ["Sample tag"])
+
+    def test_broken_cache_is_ignored(self):
+        """Test that a broken cache file is handled as an empty cache."""
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("fñv´´zñvsfvlausvbsvs")
+            f.flush()
+            self.assertEqual(logic_cache.StatCache.load(f.name).entries, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the crash-safe writes and
+the node locks"""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler.logic_files import AtomicFile, node_lock
+from finder_tags_butler.logic_journal import node_state_path
+from finder_tags_butler.logic_manifest import (
+    ManifestWriter,
+    TagAssociation,
+    load_manifest,
+)
+from finder_tags_butler.properties import STATE_DIR_ENV_VAR
+
+
+class UnitTestSuiteLogicFiles(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manifest_path = os.path.join(self.tmp_dir.name, "manifest")
+
+    def _write_manifest(self, tags: list) -> ManifestWriter:
+        with ManifestWriter(self.manifest_path, "computer", root="/node") as writer:
+            writer.write(TagAssociation("/node/a", tags))
+        return writer
+
+    def test_failed_write_keeps_the_old_file(self):
+        """Test that an interrupted write neither truncates the manifest nor
+        leaves a temporary file."""
+        self._write_manifest(["Red"])
+
+        with self.assertRaises(KeyboardInterrupt):
+            with ManifestWriter(self.manifest_path, "computer", root="/node") as w:
+                w.write(TagAssociation("/node/a", ["Blue"]))
+                raise KeyboardInterrupt
+
+        manifest = load_manifest(self.manifest_path, root="/node")
+        self.assertEqual([e.tags for e in manifest.content], [["Red"]])
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["manifest"])
+
+    def test_unchanged_file_is_not_replaced(self):
+        """Test that the same content is not written again."""
+        self.assertTrue(self._write_manifest(["Red"]).changed)
+        inode = os.stat(self.manifest_path).st_ino
+
+        self.assertFalse(self._write_manifest(["Red"]).changed)
+        self.assertEqual(os.stat(self.manifest_path).st_ino, inode)
+        self.assertTrue(self._write_manifest(["Blue"]).changed)
+        self.assertNotEqual(os.stat(self.manifest_path).st_ino, inode)
+
+        with AtomicFile(self.manifest_path, replace_unchanged=True) as outfile:
+            with open(self.manifest_path, "rb") as infile:
+                outfile.write(infile.read())
+        self.assertTrue(outfile.changed)
+
+    def test_node_lock(self):
+        """Test that the lock is reentrant, serializes the runs and is seen
+        by the other processes."""
+        order = []
+
+        def run():
+            with node_lock("/node", "/node/manifest"):
+                order.append("other")
+
+        with node_lock("/node", "/node/manifest"):
+            with node_lock("/node", "/node/manifest"):  # Reentrant
+                thread = threading.Thread(target=run)
+                thread.start()
+                time.sleep(0.05)
+                order.append("first")
+
+            # Another process can not take it
+            lock_path = node_state_path("/node", "/node/manifest") + ".lock"
+            with open(lock_path, "a") as lock_file:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        thread.join()
+
+        self.assertEqual(order, ["first", "other"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the identity index"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends, logic_identity
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_identity import FingerprintCache, fingerprint_cache_path
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.properties import (
+    IDENTITY_BLOCK_SIZE,
+    IDENTITY_INDEX_FILE_NAME,
+    MANIFEST_FILE_NAME,
+    STATE_DIR_ENV_VAR,
+)
+
+
+class UnitTestSuiteLogicIdentity(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node = self.tmp_dir.name
+        self.manifest_path = os.path.join(self.node, MANIFEST_FILE_NAME)
+        os.mkdir(os.path.join(self.node, "dir"))
+
+    def _file(self, name: str, content: bytes, tags: [str] = None) -> str:
+        path = os.path.join(self.node, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        if tags:
+            self.backend.apply_many([TagChange(path, add=tags)])
+        return path
+
+    def _move(self, path: str, name: str) -> str:
+        new_path = os.path.join(self.node, name)
+        os.rename(path, new_path)
+        self.backend.tags.pop(path, None)
+        return new_path
+
+    def test_moved_files_keep_their_tags(self):
+        """Test that the entries of the moved files follow them."""
+        moved = self._file("a.txt", b"moved content", ["Red"])
+        kept = self._file("b.txt", b"kept content", ["Blue"])
+        save_manifest(self.node, self.manifest_path, identity=True)
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.node, IDENTITY_INDEX_FILE_NAME))
+        )
+
+        moved = self._move(moved, os.path.join("dir", "c.txt"))
+        errors = dump_manifest(self.manifest_path, self.node)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.backend.tags, {moved: ["Red"], kept: ["Blue"]})
+
+    def test_collisions_use_the_full_content(self):
+        """Test that the files with the same first and last blocks are told
+        apart by their full content."""
+        start = b"s" * IDENTITY_BLOCK_SIZE
+        end = b"e" * IDENTITY_BLOCK_SIZE
+        a = self._file("a.bin", start + b"a" + end, ["Red"])
+        b = self._file("b.bin", start + b"b" + end, ["Blue"])
+        save_manifest(self.node, self.manifest_path, identity=True)
+
+        a = self._move(a, os.path.join("dir", "x.bin"))
+        b = self._move(b, os.path.join("dir", "y.bin"))
+        errors = dump_manifest(self.manifest_path, self.node)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.backend.tags, {a: ["Red"], b: ["Blue"]})
+
+    def test_ambiguous_moves_are_reported(self):
+        """Test that an entry is not moved to one of several equal files."""
+        path = self._file("a.txt", b"content", ["Red"])
+        save_manifest(self.node, self.manifest_path, identity=True)
+
+        self._move(path, os.path.join("dir", "x.txt"))
+        self._file(os.path.join("dir", "y.txt"), b"content")
+        errors = dump_manifest(self.manifest_path, self.node)
+
+        self.assertEqual([type(e) for e in errors], [FileNotFoundError])
+        self.assertEqual(self.backend.tags, {})
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        """Test that the fingerprints are cached."""
+        path = self._file("a.txt", b"content", ["Red"])
+        with mock.patch.object(
+            logic_identity, "quick_hash", wraps=logic_identity.quick_hash
+        ) as quick_hash:
+            save_manifest(self.node, self.manifest_path, identity=True)
+            save_manifest(self.node, self.manifest_path, identity=True)
+            self.assertEqual(quick_hash.call_count, 1)
+
+            # Kept out of the node, in the local state directory
+            cache_path = fingerprint_cache_path(self.node, self.manifest_path)
+            self.assertTrue(os.path.isfile(cache_path))
+            self.assertTrue(cache_path.startswith(os.environ[STATE_DIR_ENV_VAR]))
+
+            with open(path, "ab") as f:
+                f.write(b" changed")
+            save_manifest(self.node, self.manifest_path, identity=True)
+            self.assertEqual(quick_hash.call_count, 2)
+
+    def test_fingerprint_includes_the_size(self):
+        """Test the fingerprint of a file."""
+        path = self._file("a.txt", b"content")
+        cache = FingerprintCache()
+        quick = cache.fingerprint(path, os.stat(path))
+        full = cache.fingerprint(path, os.stat(path), full=True)
+
+        self.assertTrue(quick.startswith("7:"))
+        self.assertTrue(full.startswith(quick + ":"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the walk rules"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_ignore import IgnoreMatcher, WalkRules
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_manifest import load_manifest
+from finder_tags_butler.properties import (
+    IGNORE_FILE_NAME,
+    MANIFEST_FILE_NAME,
+    STATE_DIR_ENV_VAR,
+)
+
+
+class UnitTestSuiteLogicIgnore(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node = os.path.join(self.tmp_dir.name, "node")
+        self.manifest_path = os.path.join(self.node, MANIFEST_FILE_NAME)
+        self.paths = {}
+
+    def _make_tree(self, *names: str) -> None:
+        """Create and tag some files of the node."""
+        for name in names:
+            self.paths[name] = os.path.join(self.node, name)
+            os.makedirs(os.path.dirname(self.paths[name]), exist_ok=True)
+            open(self.paths[name], "a").close()
+            self.backend.apply_many([TagChange(self.paths[name], add=["Red"])])
+
+    def _write_ignore_file(self, text: str) -> None:
+        with open(os.path.join(self.node, IGNORE_FILE_NAME), "w") as outfile:
+            outfile.write(text)
+
+    def _saved_paths(self) -> list:
+        manifest = load_manifest(self.manifest_path)
+        return [os.path.relpath(e.path, self.node) for e in manifest.content]
+
+    def test_matcher(self):
+        """Test the gitignore semantics of the patterns."""
+        for lines in (
+            ["# A comment", "", "build", "/dist/", "a/**/z", "*.tmp"],
+            ["build", "/dist/", "a/**/z", "*.tmp", "!keep.tmp", "x.tmp"],
+        ):
+            matcher = IgnoreMatcher(lines)
+            negated = "!keep.tmp" in lines
+            for path, is_dir, expected in (
+                ("build", True, True),
+                ("src/build", False, True),
+                ("src/builds", False, False),
+                ("dist", True, True),
+                ("dist", False, False),
+                ("src/dist", True, False),
+                ("a/z", True, True),
+                ("a/b/c/z", False, True),
+                ("b/a/z", False, False),
+                ("src/x.tmp", False, True),
+                ("src/keep.tmp", False, not negated),
+            ):
+                self.assertEqual(
+                    matcher.match(path, is_dir), expected, f"{lines}: {path}"
+                )
+
+    def test_ignored_subtrees_are_not_walked(self):
+        """Test that a save neither keeps nor lists the ignored paths."""
+        self._make_tree(
+            "a.txt", "a.tmp", "src/b.txt", "src/node_modules/c/d.txt", "build/e.txt"
+        )
+        self._write_ignore_file("node_modules/\n/build\n*.tmp\n")
+
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            save_manifest(self.node, self.manifest_path)
+
+        self.assertEqual(self._saved_paths(), ["a.txt", "src/b.txt"])
+        scanned = {c.args[0] for c in scandir.call_args_list}
+        self.assertNotIn(os.path.join(self.node, "build"), scanned)
+        self.assertNotIn(os.path.join(self.node, "src", "node_modules"), scanned)
+
+    def test_dump_skips_excluded_entries(self):
+        """Test that a dump neither applies nor removes the tags of the
+        ignored paths."""
+        self._make_tree("a.txt", "tmp/b.txt")
+        save_manifest(self.node, self.manifest_path)
+        self.backend.tags = {self.paths["tmp/b.txt"]: ["Blue"]}
+        self._write_ignore_file("tmp/\n")
+
+        errors = dump_manifest(self.manifest_path, self.node, force_overwriting=True)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            self.backend.tags,
+            {self.paths["a.txt"]: ["Red"], self.paths["tmp/b.txt"]: ["Blue"]},
+        )
+
+    def test_max_depth(self):
+        """Test that the paths below the maximum depth are not walked."""
+        self._make_tree("a.txt", "x/b.txt", "x/y/c.txt")
+
+        save_manifest(self.node, self.manifest_path, max_depth=2)
+
+        self.assertEqual(self._saved_paths(), ["a.txt", "x/b.txt"])
+        rules = WalkRules(self.node, max_depth=2)
+        self.assertTrue(rules.excludes(self.paths["x/y/c.txt"]))
+        self.assertFalse(rules.excludes(self.paths["x/b.txt"]))
+
+    def test_symlinks(self):
+        """Test that the links to directories are only walked if asked for,
+        and never when they make a loop."""
+        self._make_tree("real/a.txt")
+        os.symlink(os.path.join(self.node, "real"), os.path.join(self.node, "link"))
+        os.symlink(self.node, os.path.join(self.node, "real", "loop"))
+        link = os.path.join(self.node, "link", "a.txt")
+        self.backend.apply_many([TagChange(link, add=["Red"])])
+
+        save_manifest(self.node, self.manifest_path)
+        self.assertEqual(self._saved_paths(), ["real/a.txt"])
+
+        save_manifest(self.node, self.manifest_path, follow_symlinks=True)
+        self.assertEqual(self._saved_paths(), ["link/a.txt", "real/a.txt"])
+
+    def test_symlinks_pointing_to_each_other(self):
+        """Test that the links of two directories to each other are walked
+        only once."""
+        self._make_tree("a/a.txt", "b/b.txt")
+        os.symlink(os.path.join("..", "b"), os.path.join(self.node, "a", "l1"))
+        os.symlink(os.path.join("..", "a"), os.path.join(self.node, "b", "l2"))
+        links = ("a/l1/b.txt", "b/l2/a.txt", "a/l1/l2/a.txt", "b/l2/l1/b.txt")
+        paths = [os.path.join(self.node, p) for p in links]
+        self.backend.apply_many([TagChange(p, add=["Red"]) for p in paths])
+
+        save_manifest(self.node, self.manifest_path, follow_symlinks=True)
+        self.assertEqual(
+            self._saved_paths(),
+            ["a/a.txt", "a/l1/b.txt", "b/b.txt", "b/l2/a.txt"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the applied-state journal"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends, properties
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_journal import DumpJournal
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.properties import (
+    IGNORE_FILE_NAME,
+    MANIFEST_FILE_NAME,
+    STATE_DIR_ENV_VAR,
+)
+
+
+class UnitTestSuiteLogicJournal(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.state_dir = os.path.join(self.tmp_dir.name, "state")
+        patcher = mock.patch.dict(os.environ, {STATE_DIR_ENV_VAR: self.state_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(self.node)
+        self.manifest_path = os.path.join(self.node, MANIFEST_FILE_NAME)
+        self.paths = [os.path.join(self.node, f"file{i}.txt") for i in range(3)]
+        for path in self.paths:
+            open(path, "a").close()
+        self.backend.apply_many([TagChange(p, add=["Red"]) for p in self.paths])
+        save_manifest(self.node, self.manifest_path, use_cache=False)
+        self.backend.tags = {}
+
+    def _read_paths(self) -> mock.MagicMock:
+        """Record the paths whose tags are read."""
+        get_many = mock.patch.object(
+            self.backend, "get_many", wraps=self.backend.get_many
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+        return get_many
+
+    def test_same_manifest_is_not_dumped_again(self):
+        """Test that a dump of the last applied manifest does nothing."""
+        self.assertEqual(dump_manifest(self.manifest_path, self.node), [])
+        self.assertEqual(len(self.backend.tags), 3)
+
+        self.backend.tags = {}
+        get_many = self._read_paths()
+        self.assertEqual(dump_manifest(self.manifest_path, self.node), [])
+        self.assertEqual(self.backend.tags, {})
+        get_many.assert_not_called()
+
+        # Unless the node is fully overwritten
+        dump_manifest(self.manifest_path, self.node, force_overwriting=True)
+        self.assertEqual(len(self.backend.tags), 3)
+
+    def test_only_changed_entries_are_dumped(self):
+        """Test that the entries applied by the last dump are skipped."""
+        dump_manifest(self.manifest_path, self.node)
+        self.backend.apply_many([TagChange(self.paths[1], add=["Blue"])])
+        save_manifest(self.node, self.manifest_path, use_cache=False)
+
+        get_many = self._read_paths()
+        dump_manifest(self.manifest_path, self.node)
+        read = [p for c in get_many.call_args_list for p in c.args[0]]
+        self.assertEqual(read, [self.paths[1]])
+
+    def test_stronger_dump_is_not_skipped(self):
+        """Test that a dump is not skipped after a weaker one of the same
+        manifest."""
+        self.backend.apply_many([TagChange(self.paths[0], add=["Red", "Blue"])])
+        with mock.patch("platform.node", return_value="other-machine"):
+            dump_manifest(self.manifest_path, self.node)
+            self.assertEqual(self.backend.tags[self.paths[0]], ["Red", "Blue"])
+
+            # A normal dump removes the tags of the foreign manifest
+            get_many = self._read_paths()
+            dump_manifest(self.manifest_path, self.node, force_overwriting=None)
+            self.assertEqual(self.backend.tags[self.paths[0]], ["Red"])
+            read = [p for c in get_many.call_args_list for p in c.args[0]]
+            self.assertEqual(sorted(read), [self.node] + self.paths)
+
+            # But a soft one is skipped after it
+            get_many.reset_mock()
+            dump_manifest(self.manifest_path, self.node)
+            get_many.assert_not_called()
+
+    def test_limited_dump_is_not_skipped(self):
+        """Test that a dump is not skipped after one limited by the walk
+        rules."""
+        deep = os.path.join(self.node, "sub", "deep.txt")
+        os.mkdir(os.path.dirname(deep))
+        open(deep, "a").close()
+        self.backend.apply_many([TagChange(deep, add=["Blue"])])
+        save_manifest(self.node, self.manifest_path, use_cache=False)
+        self.backend.tags = {}
+
+        ignore_path = os.path.join(self.node, IGNORE_FILE_NAME)
+        with open(ignore_path, "w", encoding="utf-8") as outfile:
+            outfile.write("sub/\n")
+        dump_manifest(self.manifest_path, self.node)
+        self.assertNotIn(deep, self.backend.tags)
+        os.remove(ignore_path)
+        dump_manifest(self.manifest_path, self.node)
+        self.assertEqual(self.backend.tags[deep], ["Blue"])
+
+        # The same with a maximum depth
+        self.backend.apply_many([TagChange(deep, add=["Green"])])
+        save_manifest(self.node, self.manifest_path, use_cache=False)
+        self.backend.tags = {}
+        dump_manifest(self.manifest_path, self.node, max_depth=1)
+        self.assertNotIn(deep, self.backend.tags)
+        dump_manifest(self.manifest_path, self.node)
+        self.assertEqual(self.backend.tags[deep], ["Blue", "Green"])
+
+    def test_interrupted_dump_is_resumed(self):
+        """Test that a dump resumes after the last applied batch."""
+        apply_many = self.backend.apply_many
+        calls = []
+
+        def crash_on_second_batch(changes):
+            calls.append(changes)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return apply_many(changes)
+
+        with mock.patch.object(properties, "TAG_BACKEND_CHUNK_SIZE", 1):
+            with mock.patch.object(
+                self.backend, "apply_many", side_effect=crash_on_second_batch
+            ):
+                with self.assertRaises(KeyboardInterrupt):
+                    dump_manifest(self.manifest_path, self.node)
+            self.assertEqual(self.backend.tags, {self.paths[0]: ["Red"]})
+            journal = DumpJournal.load(self.node, self.manifest_path)
+            self.assertTrue(os.path.isfile(journal.log_path))
+
+            get_many = self._read_paths()
+            self.assertEqual(dump_manifest(self.manifest_path, self.node), [])
+        read = [p for c in get_many.call_args_list for p in c.args[0]]
+        self.assertEqual(read, self.paths[1:])
+        self.assertEqual(len(self.backend.tags), 3)
+        self.assertFalse(os.path.exists(journal.log_path))
+
+    def test_cut_log_line_is_ignored(self):
+        """Test that a log line cut by a crash is not replayed."""
+        journal = DumpJournal(self.node, self.manifest_path)
+        os.makedirs(self.state_dir, exist_ok=True)  # Created by the locks
+        with open(journal.log_path, "w", encoding="utf-8") as f:
+            f.write('{"entries": {"file0.txt": ["abc", 1]}}\n{"entries": {"file1')
+
+        journal = DumpJournal.load(self.node, self.manifest_path)
+        self.assertEqual(journal.entries, {"file0.txt": ["abc", 1]})
+        self.assertIsNone(journal.manifest)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the logic layer"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends, properties
+from finder_tags_butler.errors import CorruptedManifestFileError
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_manifest import load_manifest
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+
+class UnitTestSuiteLogicLayer(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dump_in_other_mount_point(self):
+        """Test that a manifest is dumped in a copy of the node mounted in other
+        path."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        os.makedirs(os.path.join(node, "dir"))
+        names = ["a.txt", os.path.join("dir", "b.txt"), os.path.join("dir", "c.txt")]
+        for name in names:
+            open(os.path.join(node, name), "a").close()
+        self.backend.apply_many([TagChange(os.path.join(node, names[1]), add=["Red"])])
+        save_manifest(node, os.path.join(node, MANIFEST_FILE_NAME), use_cache=False)
+
+        other_node = os.path.join(self.tmp_dir.name, "other", "node")
+        shutil.copytree(node, other_node)
+        os.remove(os.path.join(other_node, names[2]))
+        self.backend.tags = {}
+        manifest_path = os.path.join(other_node, MANIFEST_FILE_NAME)
+        with mock.patch("os.listdir", wraps=os.listdir) as listdir:
+            errors = dump_manifest(manifest_path, other_node)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            self.backend.tags, {os.path.join(other_node, names[1]): ["Red"]}
+        )
+        # Each directory of the entries is listed once at most
+        listed = [c.args[0] for c in listdir.call_args_list]
+        self.assertTrue(listed)
+        self.assertEqual(len(listed), len(set(listed)))
+
+    def test_save_with_vanished_paths(self):
+        """Test that the paths removed between the walk and the read of their
+        tags are left out of the manifest, instead of stopping the save."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(node)
+        paths = [os.path.join(node, f"file{i}.txt") for i in range(3)]
+        for path in paths:
+            open(path, "a").close()
+        os.symlink(os.path.join(node, "missing"), os.path.join(node, "dangling"))
+        self.backend.apply_many([TagChange(p, add=["Red"]) for p in paths])
+        get_many = self.backend.get_many
+
+        def remove_first(read_paths):
+            if os.path.lexists(paths[0]):
+                os.remove(paths[0])
+            return get_many(read_paths)
+
+        manifest_path = os.path.join(node, MANIFEST_FILE_NAME)
+        with mock.patch.object(self.backend, "get_many", side_effect=remove_first):
+            save_manifest(node, manifest_path, use_cache=False)
+
+        content = load_manifest(manifest_path, root=node).content
+        self.assertEqual([e.path for e in content], paths[1:])
+
+    def test_dump_with_other_name_spellings(self):
+        """Test that the entries are found in the file systems that list their
+        names with another case or Unicode normalization."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(node)
+        path = os.path.join(node, "a.txt")
+        open(path, "a").close()
+        self.backend.apply_many([TagChange(path, add=["Red"])])
+        manifest_path = os.path.join(node, MANIFEST_FILE_NAME)
+        save_manifest(node, manifest_path, use_cache=False)
+        self.backend.tags = {}
+
+        listdir = os.listdir
+        with mock.patch(
+            "os.listdir", side_effect=lambda p: [n.upper() for n in listdir(p)]
+        ):
+            errors = dump_manifest(manifest_path, node)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.backend.tags, {path: ["Red"]})
+
+    def test_dump_stops_at_corrupted_entry(self):
+        """Test that the entries are checked while the manifest is read, and
+        the batch with a bad entry, and the ones after it, are not applied."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(node)
+        names = ["a.txt", "b.txt", "c.txt", "d.txt"]
+        for name in names:
+            open(os.path.join(node, name), "a").close()
+        manifest_path = os.path.join(node, MANIFEST_FILE_NAME)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            f.write(
+                '--- {"format": "ftb-stream", "version": 1, "machine": "pc"}\n'
+                '--- {"path": "a.txt", "tags": ["Red"]}\n'
+                '--- {"path": "b.txt", "tags": ["Red"]}\n'
+                '--- {"path": "c.txt"}\n'
+                '--- {"path": "d.txt", "tags": ["Red"]}\n'
+            )
+
+        with mock.patch.object(properties, "TAG_BACKEND_CHUNK_SIZE", 1):
+            with self.assertRaises(CorruptedManifestFileError):
+                dump_manifest(manifest_path, node)
+
+        self.assertEqual(self.backend.tags.get(os.path.join(node, "a.txt")), ["Red"])
+        for name in names[2:]:
+            self.assertNotIn(os.path.join(node, name), self.backend.tags)
+
+
+if __name__ == "__main__":
+    unittest.main()
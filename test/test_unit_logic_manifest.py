@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for manifest files"""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import TestCase
+
+import yaml
+
+from finder_tags_butler.errors import CorruptedManifestFileError
+from finder_tags_butler.logic_manifest import (
+    Manifest,
+    ManifestContent,
+    ManifestReader,
+    ManifestWriter,
+    TagAssociation,
+    load_manifest,
+)
+
+
+class UnitTestSuiteLogicManifest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.manifest_path = os.path.join(self.tmp_dir.name, "manifest")
+
+    def test_stream_round_trip(self):
+        """Test that the written entries are read back in order."""
+        entries = [
+            TagAssociation("/node/a", ["Sample tag 1"]),
+            TagAssociation("/node/a b/ñ\nline", ["Sample tag 1", "Comprobación"]),
+            TagAssociation("/node/b", ["5w&sfdbdb!$·!!Y&%"]),
+        ]
+        with ManifestWriter(self.manifest_path, "computer") as writer:
+            for entry in entries:
+                writer.write(entry)
+
+        with ManifestReader(self.manifest_path) as reader:
+            self.assertEqual(reader.machine, "computer")
+            res = [(e.path, e.tags) for e in reader]
+        self.assertEqual(res, [(e.path, e.tags) for e in entries])
+
+        # The stream is still a valid YAML document stream
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            docs = list(yaml.safe_load_all(f))
+        self.assertEqual(docs[0]["machine"], "computer")
+        self.assertEqual(docs[2], {"path": entries[1].path, "tags": entries[1].tags})
+
+    def test_stream_stores_node_relative_paths(self):
+        """Test that the paths of the node are stored relative to it."""
+        node = self.tmp_dir.name
+        entries = [
+            TagAssociation(os.path.join(node, "a"), ["Tag"]),
+            TagAssociation(os.path.join(node, "dir", "b"), ["Tag"]),
+        ]
+        with ManifestWriter(self.manifest_path, "computer") as writer:
+            for entry in entries:
+                writer.write(entry)
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            docs = list(yaml.safe_load_all(f))
+        self.assertEqual([d["path"] for d in docs[1:]], ["a", "dir/b"])
+
+        # The same manifest read from other mount point of the node
+        with ManifestReader(self.manifest_path, root="/other/node") as reader:
+            res = [e.path for e in reader]
+        self.assertEqual(res, ["/other/node/a", "/other/node/dir/b"])
+
+    def test_manifest_object_is_saved_sorted(self):
+        """Test that a 'Manifest' object is saved sorted by path."""
+        manifest = Manifest(
+            [TagAssociation("/node/b", ["Tag"]), TagAssociation("/node/a", ["Tag"])]
+        )
+        manifest.save(self.manifest_path)
+
+        res = Manifest()
+        res.load(self.manifest_path)
+        self.assertEqual([e.path for e in res.content], ["/node/a", "/node/b"])
+
+    def test_unsorted_stream_is_corrupted(self):
+        """Test that an unsorted stream is rejected."""
+        with ManifestWriter(self.manifest_path) as writer:
+            writer.write(TagAssociation("/node/b", ["Tag"]))
+            writer.write(TagAssociation("/node/a", ["Tag"]))
+
+        with self.assertRaises(CorruptedManifestFileError):
+            Manifest().load(self.manifest_path)
+
+    def test_first_bad_entry_is_located(self):
+        """Test that the corruption errors point to the first bad entry."""
+        with ManifestWriter(self.manifest_path) as writer:
+            writer.write(TagAssociation("/node/a", ["Tag"]))
+            writer.write(TagAssociation("/node/b", ["Tag"]))
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        bad_line_no = len(lines)
+
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            f.writelines(lines[:-1])
+            f.write('--- {"path": "/node/b", "tags": ["Tag",]}\n')
+        with self.assertRaises(CorruptedManifestFileError) as cm:
+            load_manifest(self.manifest_path)
+        self.assertEqual(cm.exception.line, bad_line_no)
+        self.assertEqual(cm.exception.column, 40)
+        self.assertIn(f"line {bad_line_no}, column 40", str(cm.exception))
+
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            f.writelines(lines[:-1])
+            f.write('--- {"path": "/node/b", "tags": "Tag"}\n')
+        with self.assertRaises(CorruptedManifestFileError) as cm:
+            load_manifest(self.manifest_path)
+        self.assertEqual(cm.exception.line, bad_line_no)
+        self.assertIn("'tags'", cm.exception.reason)
+
+    def test_legacy_manifest(self):
+        """Test reading a manifest written by the first versions."""
+        with open(self.manifest_path, "w") as f:
+            f.write(
+                "# Finder Tags Butler manifest file\n\n"
+                "!!python/object:finder_tags_butler.logic_layer.Manifest\n"
+                "content:\n"
+                "- !!python/object:finder_tags_butler.logic_layer.TagAssociation\n"
+                "  path: /node/b\n"
+                "  tags:\n"
+                "  - Sample tag 1\n"
+                "  - '123'\n"
+                "- !!python/object:finder_tags_butler.logic_layer.TagAssociation\n"
+                "  path: /node/a\n"
+                "  tags:\n"
+                "  - Comprobación\n"
+                "machine: computer\n"
+            )
+        manifest = load_manifest(self.manifest_path)
+        self.assertEqual(manifest.machine, "computer")
+        self.assertEqual(
+            [(e.path, e.tags) for e in manifest.content],
+            [("/node/a", ["Comprobación"]), ("/node/b", ["Sample tag 1", "123"])],
+        )
+
+    def test_legacy_manifest_does_not_construct_objects(self):
+        """Test that arbitrary Python object tags are rejected."""
+        with open(self.manifest_path, "w") as f:
+            f.write(
+                "!!python/object:finder_tags_butler.logic_layer.Manifest\n"
+                "content: !!python/object/apply:os.getcwd []\n"
+                "machine: computer\n"
+            )
+        with self.assertRaises(CorruptedManifestFileError) as cm:
+            load_manifest(self.manifest_path)
+        self.assertEqual(cm.exception.line, 2)
+
+    def test_binary_round_trip(self):
+        """Test the binary format, with and without compression."""
+        root = "/node"
+        entries = [
+            TagAssociation(root, ["Sample tag 1"]),
+            TagAssociation("/node/a", ["Sample tag 1", "Comprobación"]),
+            TagAssociation("/node/a/ñ b", ["Comprobación"]),
+            TagAssociation("/node/ab", []),
+            TagAssociation("/node/b\nline", ["5w&sfdbdb!$·!!Y&%", "Sample tag 1"]),
+        ]
+        for compression in (None, "gzip"):
+            with ManifestWriter(
+                self.manifest_path,
+                "computer",
+                manifest_format="binary",
+                root=root,
+                compression=compression,
+            ) as writer:
+                for entry in entries:
+                    writer.write(entry)
+
+            # Read it from other node location
+            with ManifestReader(self.manifest_path, root="/other/node") as reader:
+                self.assertEqual(reader.machine, "computer")
+                res = [(e.path, e.tags) for e in reader]
+            self.assertEqual(
+                res,
+                [(e.path.replace(root, "/other/node", 1), e.tags) for e in entries],
+            )
+
+    def test_content_interns_tags_and_stores_relative_paths(self):
+        """Test the compact store of the manifest entries."""
+        content = ManifestContent(
+            "/node",
+            [
+                TagAssociation("/node/b", ["Red", "Blue"]),
+                TagAssociation("/node", ["Red"]),
+                TagAssociation("/outside/c", []),
+                TagAssociation("/node/a", ["Blue"]),
+            ],
+        )
+
+        self.assertEqual(content.tags_table, ["Red", "Blue"])
+        self.assertEqual(len(content), 4)
+        self.assertEqual(
+            [(e.path, e.tags) for e in content],
+            [
+                ("/node", ["Red"]),
+                ("/node/a", ["Blue"]),
+                ("/node/b", ["Red", "Blue"]),
+                ("/outside/c", []),
+            ],
+        )
+        self.assertEqual(content[-1].path, "/outside/c")
+        self.assertEqual(content[2].tags, ["Red", "Blue"])
+        with self.assertRaises(ValueError):
+            content.append("/node/0", ["Red"])
+
+    def test_content_is_smaller_than_objects(self):
+        """Test that the compact store is much smaller than the entry objects."""
+        # Parsed entries have their own copies of the tag names
+        entries = [
+            TagAssociation(
+                f"/Users/someone/node/dir{i // 100}/file{i}.txt",
+                [f"{t}" for t in ("Red", "Important", "Project")],
+            )
+            for i in range(10000)
+        ]
+        content = ManifestContent("/Users/someone/node", entries)
+
+        objects_size = sum(
+            sys.getsizeof(e)
+            + sys.getsizeof(e.path)
+            + sys.getsizeof(e.tags)
+            + sum(sys.getsizeof(t) for t in e.tags)
+            for e in entries
+        )
+        self.assertLess(content.nbytes() * 10, objects_size)
+
+    def test_truncated_binary_is_corrupted(self):
+        """Test that a truncated binary manifest is rejected."""
+        with ManifestWriter(self.manifest_path, manifest_format="binary") as writer:
+            writer.write(TagAssociation("/node/a", ["Tag"]))
+        with open(self.manifest_path, "rb") as f:
+            data = f.read()
+        with open(self.manifest_path, "wb") as f:
+            f.write(data[:-1])
+
+        with self.assertRaises(CorruptedManifestFileError):
+            Manifest().load(self.manifest_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
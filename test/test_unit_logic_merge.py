@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the merge mode"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_manifest import load_manifest
+from finder_tags_butler.logic_merge import EntryClocks, merge_manifest, merge_tags
+from finder_tags_butler.properties import (
+    ENTRY_CLOCKS_FILE_NAME,
+    MANIFEST_FILE_NAME,
+    STATE_DIR_ENV_VAR,
+)
+
+
+class UnitTestSuiteLogicMerge(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(self.node)
+        self.manifest_path = os.path.join(self.node, MANIFEST_FILE_NAME)
+        self.clocks_path = os.path.join(self.node, ENTRY_CLOCKS_FILE_NAME)
+        self.paths = {}
+        for name in ("a.txt", "b.txt", "c.txt"):
+            self.paths[name] = os.path.join(self.node, name)
+            open(self.paths[name], "a").close()
+        self.backends = {}
+        self.addCleanup(mock.patch.stopall)
+
+    def _on(self, machine: str) -> MemoryBackend:
+        """Switch to a machine, with its own tags and local state."""
+        if machine not in self.backends:
+            self.backends[machine] = MemoryBackend()
+        state_dir = os.path.join(self.tmp_dir.name, f"{machine}.state")
+        mock.patch.stopall()
+        mock.patch("platform.node", return_value=machine).start()
+        mock.patch.dict(os.environ, {STATE_DIR_ENV_VAR: state_dir}).start()
+        return logic_backends.set_backend(self.backends[machine])
+
+    def _tag(self, backend: MemoryBackend, name: str, add=(), remove=()) -> None:
+        backend.apply_many([TagChange(self.paths[name], list(add), list(remove))])
+
+    def _merge(self, machine: str):
+        self._on(machine)
+        return merge_manifest(self.manifest_path, self.node)
+
+    def test_merge_tags(self):
+        """Test the three-way merge of the tags of a path."""
+        self.assertEqual(merge_tags(["A"], ["A", "B"], ["A"]), (["A", "B"], False))
+        self.assertEqual(merge_tags(["A"], ["A"], ["C"]), (["C"], False))
+        self.assertEqual(merge_tags(["A"], ["B"], ["B"]), (["B"], False))
+        self.assertEqual(
+            merge_tags(["A", "B"], ["A", "C"], ["B", "D"]), (["C", "D"], True)
+        )
+        self.assertEqual(merge_tags(None, ["A"], []), (["A"], False))
+        self.assertEqual(merge_tags(None, ["A"], ["B"]), (["A", "B"], True))
+
+    def test_changes_of_every_machine_are_kept(self):
+        """Test that a tag written on a machine is not lost when another one,
+        which has not seen it yet, saves its own changes."""
+        for machine in ("x", "y", "z"):
+            self._tag(self._on(machine), "a.txt", add=["Red"])
+            self._merge(machine)
+        self.assertEqual(len(load_manifest(self.manifest_path).content), 1)
+
+        # Each machine tags a different file, without seeing the others
+        self._tag(self.backends["x"], "a.txt", add=["Blue"])
+        self._tag(self.backends["y"], "b.txt", add=["Green"])
+        self._tag(self.backends["z"], "a.txt", remove=["Red"])
+        for machine in ("x", "y", "z", "x", "y"):
+            report = self._merge(machine)
+            self.assertEqual(report.errors, [])
+
+        expected = {self.paths["a.txt"]: ["Blue"], self.paths["b.txt"]: ["Green"]}
+        for backend in self.backends.values():
+            self.assertEqual(backend.tags, expected)
+        manifest = load_manifest(self.manifest_path)
+        self.assertEqual({e.path: e.tags for e in manifest.content}, expected)
+
+    def test_conflicts_merge_the_tag_sets(self):
+        """Test that the changes of both sides over the same path are joined."""
+        for machine in ("x", "y"):
+            self._tag(self._on(machine), "a.txt", add=["Red"])
+            self._merge(machine)
+        self._tag(self.backends["x"], "a.txt", add=["Blue"], remove=["Red"])
+        self._tag(self.backends["y"], "a.txt", add=["Green"])
+        self._merge("x")
+        report = self._merge("y")
+
+        self.assertEqual(len(report.conflicts), 1)
+        self.assertEqual(report.conflicts[0].machine, "x")
+        self.assertEqual(report.conflicts[0].merged, ["Green", "Blue"])
+        self.assertEqual(
+            self.backends["y"].tags, {self.paths["a.txt"]: ["Green", "Blue"]}
+        )
+
+    def test_deleted_paths_are_dropped(self):
+        """Test that the entries of the paths deleted from the node since the
+        last merge are dropped, and the unknown ones are kept."""
+        backend = self._on("x")
+        self._tag(backend, "a.txt", add=["Red"])
+        self._tag(backend, "b.txt", add=["Blue"])
+        self._merge("x")
+        os.remove(self.paths["b.txt"])
+
+        # Without a base, the path may not be synchronized yet
+        self._merge("y")
+        manifest = load_manifest(self.manifest_path)
+        self.assertIn(self.paths["b.txt"], [e.path for e in manifest.content])
+
+        self._merge("x")
+        manifest = load_manifest(self.manifest_path)
+        self.assertEqual([e.path for e in manifest.content], [self.paths["a.txt"]])
+
+    def test_clocks(self):
+        """Test that the entries keep the machine and clock of their last
+        change."""
+        self._tag(self._on("x"), "a.txt", add=["Red"])
+        self._merge("x")
+        self._tag(self._on("y"), "b.txt", add=["Blue"])
+        self._merge("y")
+
+        clocks = EntryClocks.load(self.clocks_path, self.node)
+        self.assertEqual(
+            clocks.entries,
+            {self.paths["a.txt"]: ["x", 1], self.paths["b.txt"]: ["y", 2]},
+        )
+
+    def test_dry_run(self):
+        """Test that a dry run only plans the changes."""
+        self._tag(self._on("x"), "a.txt", add=["Red"])
+        self._merge("x")
+        self._on("y")
+        report = merge_manifest(self.manifest_path, self.node, dry_run=True)
+
+        self.assertEqual([c.path for c in report.changes], [self.paths["a.txt"]])
+        self.assertEqual(self.backends["y"].tags, {})
+        clocks = EntryClocks.load(self.clocks_path, self.node)
+        self.assertEqual(clocks.entries, {self.paths["a.txt"]: ["x", 1]})
+
+
+if __name__ == "__main__":
+    unittest.main()
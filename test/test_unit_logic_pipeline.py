@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the staged pipelines"""
+
+import errno
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.errors import TagOperationTimeoutError
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_pipeline import (
+    PipelineOptions,
+    Stage,
+    call_stage,
+    run_pipeline,
+)
+from finder_tags_butler.logic_retry import FailureReport, TagOperationExecutor
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+
+class UnitTestSuiteLogicPipeline(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_node(self, files: int) -> (str, str, list):
+        """Create a node with some tagged files and save its manifest."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(node)
+        paths = [os.path.join(node, f"file{i:04d}.txt") for i in range(files)]
+        for path in paths:
+            open(path, "a").close()
+        self.backend.apply_many(
+            [TagChange(p, add=[f"Tag {i % 3}"]) for i, p in enumerate(paths)]
+        )
+        manifest_path = os.path.join(node, MANIFEST_FILE_NAME)
+        save_manifest(node, manifest_path, use_cache=False)
+        return node, manifest_path, paths
+
+    def test_run_pipeline(self):
+        """Test that every item goes through all the stages, with several
+        jobs per stage."""
+        stages = [
+            Stage("double", lambda x: x * 2, jobs=3),
+            Stage("increase", lambda x: x + 1, jobs=2),
+        ]
+        results = list(run_pipeline(range(1000), stages, queue_size=2))
+        self.assertEqual(sorted(results), [x * 2 + 1 for x in range(1000)])
+
+        # Nothing to process
+        self.assertEqual(list(run_pipeline([], stages)), [])
+
+    def test_queues_are_bounded(self):
+        """Test that a blocked stage stops the reading of the source."""
+        produced = []
+        release = threading.Event()
+
+        def source():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        def blocked(x):
+            release.wait()
+            return x
+
+        results = run_pipeline(source(), [Stage("blocked", blocked)], queue_size=2)
+        consumed = []
+        thread = threading.Thread(target=lambda: consumed.extend(results))
+        thread.start()
+        time.sleep(0.2)
+        self.assertLessEqual(len(produced), 5)
+        release.set()
+        thread.join()
+        self.assertEqual(consumed, list(range(100)))
+
+    def test_errors_stop_the_pipeline(self):
+        """Test that the first error of a stage is raised to the caller."""
+
+        def fail_on_ten(x):
+            if x == 10:
+                raise ValueError(x)
+            return x
+
+        with self.assertRaises(ValueError):
+            list(run_pipeline(range(1000), [Stage("fail", fail_on_ten, jobs=2)]))
+
+        # Closing the iterator early stops the threads too
+        threads = threading.active_count()
+        results = run_pipeline(range(1000), [Stage("same", lambda x: x)])
+        next(results)
+        results.close()
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_timeouts(self):
+        """Test that a hung call is handed to the timeout function."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def hang(x):
+            release.wait()
+            return x
+
+        stage = Stage("hang", hang, timeout=0.05, on_timeout=lambda x: -x)
+        self.assertEqual(call_stage(stage, 3), -3)
+        stage.on_timeout = None
+        with self.assertRaises(TimeoutError):
+            call_stage(stage, 3)
+
+        # The errors of the calls are raised as they are
+        stage = Stage("fail", lambda x: 1 / x, timeout=1)
+        with self.assertRaises(ZeroDivisionError):
+            call_stage(stage, 0)
+
+    def test_dump_through_a_pipeline(self):
+        """Test that a dump through a pipeline applies the same tags."""
+        node, manifest_path, paths = self._make_node(1000)
+        expected = dict(self.backend.tags)
+        self.backend.tags = {paths[0]: ["Blue"]}
+
+        errors = dump_manifest(
+            manifest_path,
+            node,
+            force_overwriting=True,
+            pipeline=PipelineOptions(check_jobs=2, read_jobs=3, write_jobs=3),
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.backend.tags, expected)
+
+    def test_timed_out_writes_are_errors(self):
+        """Test that the writes that time out are reported and applied again
+        by the next dump."""
+        node, manifest_path, paths = self._make_node(3)
+        expected = dict(self.backend.tags)
+        self.backend.tags = {}
+        release = threading.Event()
+        self.addCleanup(release.set)
+        apply_many = self.backend.apply_many
+
+        def hang(changes):
+            release.wait()
+            return apply_many(changes)
+
+        with mock.patch.object(self.backend, "apply_many", side_effect=hang):
+            errors = dump_manifest(
+                manifest_path, node, pipeline=PipelineOptions(timeout=0.05)
+            )
+        self.assertEqual(sorted(e.path for e in errors), paths)
+        self.assertIsInstance(errors[0], TagOperationTimeoutError)
+        self.assertIn("writing", str(errors[0]))
+
+        self.assertEqual(dump_manifest(manifest_path, node), [])
+        self.assertEqual(self.backend.tags, expected)
+
+    def test_timed_out_writes_are_cancelled(self):
+        """Test that a timed out write does not retry once released, so it
+        neither records its paths nor races the next dump."""
+        node, manifest_path, paths = self._make_node(3)
+        expected = dict(self.backend.tags)
+        self.backend.tags = {}
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        def hang(changes):
+            calls.append(changes)
+            release.wait()
+            raise OSError(errno.EAGAIN, "Busy")  # Retried if not cancelled
+
+        threads = set(threading.enumerate())
+        executor = TagOperationExecutor(sleep=lambda seconds: None)
+        with mock.patch.object(self.backend, "apply_many", side_effect=hang):
+            errors = dump_manifest(
+                manifest_path,
+                node,
+                pipeline=PipelineOptions(timeout=0.05),
+                executor=executor,
+            )
+        self.assertEqual(sorted(e.path for e in errors), paths)
+        self.assertEqual(FailureReport.load(node, manifest_path).paths, paths)
+
+        # A second dump applies the entries, and the tags are changed later
+        self.assertEqual(dump_manifest(manifest_path, node), [])
+        self.assertEqual(self.backend.tags, expected)
+        self.backend.tags[paths[0]] = ["Manual"]
+
+        # The hung write ends without any other try
+        release.set()
+        for thread in set(threading.enumerate()) - threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.backend.tags[paths[0]], ["Manual"])
+        self.assertEqual(FailureReport.load(node, manifest_path).paths, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
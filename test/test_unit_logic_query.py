@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the tag queries"""
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_stats
+from finder_tags_butler.errors import InvalidTagQueryError
+from finder_tags_butler.logic_manifest import ManifestWriter, TagAssociation
+from finder_tags_butler.logic_query import (
+    TagIndex,
+    open_tag_index,
+    parse_query,
+    query_manifest,
+)
+from finder_tags_butler.logic_stats import Stats
+from finder_tags_butler.properties import STATE_DIR_ENV_VAR
+
+_ROOT = "/node"
+
+
+class UnitTestSuiteLogicQuery(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_stats.set_stats, logic_stats.get_stats())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manifest_path = os.path.join(self.tmp_dir.name, "manifest")
+
+    def _write_manifest(self, entries: dict) -> None:
+        with ManifestWriter(self.manifest_path, "computer", root=_ROOT) as writer:
+            for path in sorted(entries):
+                writer.write(TagAssociation(os.path.join(_ROOT, path), entries[path]))
+
+    def _query(self, index: TagIndex, expression: str) -> list:
+        return [os.path.relpath(p, _ROOT) for p in index.query(expression)]
+
+    def test_parse_query(self):
+        """Test the precedence of the operators and the invalid queries."""
+        self.assertEqual(
+            parse_query('a b OR NOT "c d"* AND (e)'),
+            (
+                "or",
+                ("and", ("tag", "a"), ("tag", "b")),
+                ("and", ("not", ("prefix", "c d")), ("tag", "e")),
+            ),
+        )
+        self.assertEqual(
+            parse_query('"AND" "say \\"hi\\""'),
+            ("and", ("tag", "AND"), ("tag", 'say "hi"')),
+        )
+        for expression, column in (
+            ("", 1),
+            ("a AND", 6),
+            ("(a OR b", 8),
+            ("a )", 3),
+            ('a "b', 3),
+            ("OR a", 1),
+        ):
+            with self.assertRaises(InvalidTagQueryError, msg=expression) as e:
+                parse_query(expression)
+            self.assertEqual(e.exception.column, column, expression)
+
+    def test_queries(self):
+        """Test the answers of the queries, with tags stored as ids and as
+        bitmaps."""
+        entries = {f"file{i:03d}": ["Dense"] for i in range(100)}
+        entries["a"] = ["Red", "Work"]
+        entries["b"] = ["Red", "Project X"]
+        entries["c"] = ["Blue", "Project Y", "Dense"]
+        entries["d"] = ["Red"]
+        self._write_manifest(entries)
+        index = TagIndex.build(self.manifest_path, _ROOT)
+
+        for expression, expected in (
+            ("Red", ["a", "b", "d"]),
+            ("Red AND NOT Work", ["b", "d"]),
+            ("Red Work OR Blue", ["a", "c"]),
+            ("Red AND (Work OR Blue)", ["a"]),
+            ('"Project *"', []),
+            ("Project*", ["b", "c"]),
+            ("NOT Dense", ["a", "b", "d"]),
+            ("Dense AND Blue", ["c"]),
+            ("Green OR NOT Red AND NOT Dense", []),
+        ):
+            self.assertEqual(self._query(index, expression), expected, expression)
+        self.assertEqual(index.count("Dense"), 101)
+
+        # The same answers once saved and loaded again
+        index_path = os.path.join(self.tmp_dir.name, "index")
+        index.save(index_path)
+        loaded = TagIndex.load(index_path)
+        self.assertEqual(loaded.tags, index.tags)
+        self.assertEqual(self._query(loaded, "Project* OR Work"), ["a", "b", "c"])
+        self.assertEqual(len(loaded.query("Dense")), 101)
+
+    def test_index_cache(self):
+        """Test that the index is only rebuilt when the manifest changes."""
+        self._write_manifest({"a": ["Red"], "b": ["Blue"]})
+        stats = logic_stats.set_stats(Stats())
+
+        self.assertEqual(len(query_manifest(self.manifest_path, _ROOT, "Red")), 1)
+        self.assertEqual(len(query_manifest(self.manifest_path, _ROOT, "Red")), 1)
+        self.assertEqual(stats.counters["index_rebuilds"], 1)
+
+        # Touched, but not changed
+        os.utime(self.manifest_path, ns=(0, 0))
+        open_tag_index(self.manifest_path, _ROOT)
+        self.assertEqual(stats.counters["index_rebuilds"], 1)
+
+        self._write_manifest({"a": ["Red"], "b": ["Red"]})
+        self.assertEqual(len(query_manifest(self.manifest_path, _ROOT, "Red")), 2)
+        self.assertEqual(stats.counters["index_rebuilds"], 2)
+
+        # An invalid query fails before the index is read
+        with mock.patch("finder_tags_butler.logic_query.open_tag_index") as index:
+            with self.assertRaises(InvalidTagQueryError):
+                query_manifest(self.manifest_path, _ROOT, "Red AND")
+        index.assert_not_called()
+
+    def test_large_index(self):
+        """Test that the queries over a large manifest are fast once its tags
+        are decoded."""
+        entries = 200000
+        with ManifestWriter(self.manifest_path, "computer", root=_ROOT) as writer:
+            for i in range(entries):
+                tags = [f"Tag {i % 7}"] + (["Rare"] if i % 997 == 0 else [])
+                writer.write(TagAssociation(f"{_ROOT}/{i:07d}", tags))
+        index = open_tag_index(self.manifest_path, _ROOT)
+        tree = parse_query('("Tag 1" OR "Tag 2") AND NOT Rare')
+        expected = [i for i in range(entries) if i % 7 in (1, 2) and i % 997]
+        self.assertEqual(len(index.query(tree)), len(expected))
+
+        start = time.perf_counter()
+        for _ in range(100):
+            index._evaluate(tree)
+        self.assertLess((time.perf_counter() - start) / 100, 0.001)
+
+
+if __name__ == "__main__":
+    unittest.main()
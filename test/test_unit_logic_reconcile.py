@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the reconcile engine"""
+
+import unittest
+from unittest import TestCase
+
+from finder_tags_butler.logic_reconcile import plan_changes, count_changes
+
+
+class UnitTestSuiteLogicReconcile(TestCase):
+    def setUp(self):
+        self.desired = {
+            "/node/same": ["A", "B"],
+            "/node/more": ["A", "B"],
+            "/node/other": ["C"],
+        }
+        self.current = {
+            "/node": [],
+            "/node/same": ["B", "A"],
+            "/node/more": ["A"],
+            "/node/other": ["A"],
+            "/node/untracked": ["D"],
+        }
+
+    def test_no_changes_when_equal(self):
+        """Test that a node already in sync does not need any change."""
+        current = {"/node": [], "/node/same": ["B", "A"]}
+        desired = {"/node/same": ["A", "B", "A"]}
+        self.assertEqual(plan_changes(desired, current, overwrite=True), [])
+        self.assertEqual(plan_changes(desired, current, overwrite=False), [])
+
+    def test_overwriting_plan(self):
+        """Test the minimal changes removing the tags not in the manifest."""
+        changes = plan_changes(self.desired, self.current, overwrite=True)
+        res = {c.path: (c.add, c.remove) for c in changes}
+        self.assertEqual(
+            res,
+            {
+                "/node/more": (["B"], []),
+                "/node/other": (["C"], ["A"]),
+                "/node/untracked": ([], ["D"]),
+            },
+        )
+        self.assertEqual(count_changes(changes), (3, 2, 2))
+
+    def test_soft_plan(self):
+        """Test the minimal changes preserving the tags not in the manifest."""
+        changes = plan_changes(self.desired, self.current, overwrite=False)
+        res = {c.path: (c.add, c.remove) for c in changes}
+        self.assertEqual(res, {"/node/more": (["B"], []), "/node/other": (["C"], [])})
+
+
+if __name__ == "__main__":
+    unittest.main()
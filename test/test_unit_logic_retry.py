@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the retries of the tag
+operations and the failure reports"""
+
+import errno
+import json
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.errors import TagOperationError, TagOperationTimeoutError
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_retry import (
+    MISSING,
+    PERMANENT,
+    TIMEOUT,
+    TRANSIENT,
+    FailureReport,
+    RateLimiter,
+    TagOperationExecutor,
+    classify_error,
+)
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+
+class UnitTestSuiteLogicRetry(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sleep = mock.Mock()
+        self.executor = TagOperationExecutor(retries=3, sleep=self.sleep)
+        self.a, self.b, self.c = (os.path.join(self.tmp_dir.name, n) for n in "abc")
+        for path in (self.a, self.b, self.c):
+            open(path, "a").close()
+
+    def _fail_paths(self, method: str, paths: set, error: Exception) -> list:
+        """Make the calls of a backend method over some paths fail."""
+        calls = []
+        original = getattr(self.backend, method)
+
+        def call(items):
+            items = list(items)
+            calls.append(items)
+            if any(getattr(i, "path", i) in paths for i in items):
+                raise error
+            return original(items)
+
+        patcher = mock.patch.object(self.backend, method, side_effect=call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def test_classify_error(self):
+        """Test the classes of the errors."""
+        for error, kind in (
+            (OSError(errno.EIO, "I/O error"), TRANSIENT),
+            (OSError(errno.EBUSY, "Busy"), TRANSIENT),
+            (PermissionError(errno.EACCES, "Denied"), PERMANENT),
+            (ValueError("bad tags"), PERMANENT),
+            (FileNotFoundError("/a"), MISSING),
+            (TagOperationTimeoutError("/a", operation="writing"), TIMEOUT),
+            (TagOperationError("/a", kind=TRANSIENT), TRANSIENT),
+        ):
+            self.assertEqual(classify_error(error), kind, repr(error))
+
+    def test_transient_errors_are_retried(self):
+        """Test that an operation is retried after a transient error, with a
+        growing wait."""
+        apply_many = self.backend.apply_many
+        failures = [OSError(errno.EIO, "I/O error")] * 2
+
+        def flaky(changes):
+            if failures:
+                raise failures.pop()
+            return apply_many(changes)
+
+        with mock.patch.object(self.backend, "apply_many", side_effect=flaky):
+            errors = self.executor.apply_many([TagChange(self.a, add=["Red"])])
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.backend.tags, {self.a: ["Red"]})
+        first, second = [c.args[0] for c in self.sleep.call_args_list]
+        self.assertTrue(0.25 <= first <= 0.5 and 0.5 <= second <= 1.0)
+
+        # Until the retries are exhausted
+        self._fail_paths("apply_many", {self.a}, OSError(errno.EIO, "I/O error"))
+        errors = self.executor.apply_many([TagChange(self.a, add=["Blue"])])
+        self.assertEqual([(e.path, e.kind) for e in errors], [(self.a, TRANSIENT)])
+        self.assertEqual(self.sleep.call_count, 5)
+
+    def test_failing_paths_are_isolated(self):
+        """Test that a failing path does not stop the rest of its call."""
+        self.backend.tags = {self.a: ["Red"], self.b: ["Blue"]}
+        denied = PermissionError(errno.EACCES, "Denied")
+        self._fail_paths("get_many", {self.b}, denied)
+        self._fail_paths("apply_many", {self.c}, denied)
+
+        tags, errors = self.executor.get_many([self.a, self.b, self.c])
+        self.assertEqual(tags, {self.a: ["Red"], self.c: []})
+        self.assertEqual([(e.path, e.kind) for e in errors], [(self.b, PERMANENT)])
+        self.assertIn("reading", str(errors[0]))
+
+        errors = self.executor.apply_many(
+            [TagChange(self.a, add=["Green"]), TagChange(self.c, add=["Green"])]
+        )
+        self.assertEqual([e.path for e in errors], [self.c])
+        self.assertEqual(self.backend.tags[self.a], ["Red", "Green"])
+        self.sleep.assert_not_called()  # The permanent errors are not retried
+
+    def test_rate_limiter(self):
+        """Test that the operations over the rate wait."""
+        sleep = mock.Mock()
+        limiter = RateLimiter(10, burst=5, sleep=sleep)
+        limiter.acquire(5)
+        sleep.assert_not_called()
+        limiter.acquire(5)
+        self.assertAlmostEqual(sleep.call_args.args[0], 0.5, delta=0.05)
+
+    def test_failure_report(self):
+        """Test that a dump keeps its failures and a later one applies only
+        them again."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        os.mkdir(node)
+        paths = [os.path.join(node, f"file{i}.txt") for i in range(3)]
+        for path in paths:
+            open(path, "a").close()
+        self.backend.apply_many([TagChange(p, add=["Red"]) for p in paths])
+        manifest_path = os.path.join(node, MANIFEST_FILE_NAME)
+        save_manifest(node, manifest_path, use_cache=False)
+        self.backend.tags = {}
+
+        # A path that can not be written
+        apply_many = self.backend.apply_many
+
+        def deny(changes):
+            if any(c.path == paths[1] for c in changes):
+                raise PermissionError(errno.EACCES, "Denied")
+            return apply_many(changes)
+
+        with mock.patch.object(self.backend, "apply_many", side_effect=deny):
+            errors = dump_manifest(manifest_path, node, executor=self.executor)
+        self.assertEqual([e.path for e in errors], [paths[1]])
+        report = FailureReport.load(node, manifest_path)
+        self.assertEqual(report.paths, [paths[1]])
+        with open(report.path, "r", encoding="utf-8") as infile:
+            failure = json.load(infile)["failures"][0]
+        self.assertEqual((failure["path"], failure["kind"]), ("file1.txt", PERMANENT))
+
+        # Only the failed path is dumped again
+        get_many = mock.patch.object(
+            self.backend, "get_many", wraps=self.backend.get_many
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+        self.assertEqual(dump_manifest(manifest_path, node, retry_failed=True), [])
+        read = [p for c in get_many.call_args_list for p in c.args[0]]
+        self.assertEqual(read, [paths[1]])
+        self.assertEqual(self.backend.tags, {p: ["Red"] for p in paths})
+        self.assertFalse(os.path.exists(report.path))
+
+        # Nothing to retry
+        get_many.reset_mock()
+        self.assertEqual(dump_manifest(manifest_path, node, retry_failed=True), [])
+        get_many.assert_not_called()
+
+        # A failure of the node itself dumps it whole, even the paths that
+        # were not in the report
+        self.backend.apply_many([TagChange(paths[0], add=["Blue"])])
+        save_manifest(node, manifest_path, use_cache=False)
+        self.backend.tags = {}
+        report.add([PermissionError(node)])
+        report.save()
+        self.assertEqual(dump_manifest(manifest_path, node, retry_failed=True), [])
+        self.assertEqual(self.backend.tags, {paths[0]: ["Red", "Blue"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the sharded manifests"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.errors import CorruptedManifestFileError
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_ignore import WalkRules
+from finder_tags_butler.logic_journal import DUMP, SOFT_DUMP
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_manifest import ManifestReader, load_manifest
+from finder_tags_butler.logic_shards import (
+    AppliedShards,
+    applied_shards_path,
+    shard_file_path,
+    shard_of,
+)
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+_SHARDS = 8
+
+
+class UnitTestSuiteLogicShards(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node = self.tmp_dir.name
+        self.manifest_path = os.path.join(self.node, MANIFEST_FILE_NAME)
+
+        # Two top level directories in different shards, with a file each
+        names = iter(f"dir{i}" for i in range(100))
+        first = next(names)
+        second = next(
+            n
+            for n in names
+            if shard_of(os.path.join(self.node, n), self.node, _SHARDS)
+            != shard_of(os.path.join(self.node, first), self.node, _SHARDS)
+        )
+        self.files = []
+        for name in (first, second):
+            os.mkdir(os.path.join(self.node, name))
+            self.files.append(os.path.join(self.node, name, "file.txt"))
+            open(self.files[-1], "a").close()
+        self.backend.apply_many(
+            [
+                TagChange(self.files[0], add=["Red"]),
+                TagChange(self.files[1], add=["Blue"]),
+            ]
+        )
+
+    def _shard_path(self, path: str) -> str:
+        shard = shard_of(path, self.node, _SHARDS)
+        return shard_file_path(self.manifest_path, shard)
+
+    def _save(self) -> None:
+        save_manifest(self.node, self.manifest_path, use_cache=False, shards=_SHARDS)
+
+    def test_sharded_round_trip(self):
+        """Test that the entries of all the shards are read back sorted."""
+        self._save()
+        with ManifestReader(self.manifest_path, self.node) as reader:
+            self.assertEqual(len(reader.shards), 2)
+            res = [(e.path, e.tags) for e in reader]
+        self.assertEqual(res, [(self.files[0], ["Red"]), (self.files[1], ["Blue"])])
+
+        # A single shard can be read too
+        shard = shard_of(self.files[1], self.node, _SHARDS)
+        manifest = load_manifest(self.manifest_path, self.node, only_shards={shard})
+        self.assertEqual([e.path for e in manifest.content], [self.files[1]])
+
+    def test_only_changed_shards_are_rewritten(self):
+        """Test that a save keeps the files of the unchanged shards."""
+        self._save()
+        inodes = [os.stat(self._shard_path(f)).st_ino for f in self.files]
+
+        self.backend.apply_many([TagChange(self.files[1], add=["Green"])])
+        self._save()
+        self.assertEqual(os.stat(self._shard_path(self.files[0])).st_ino, inodes[0])
+        self.assertNotEqual(os.stat(self._shard_path(self.files[1])).st_ino, inodes[1])
+
+        # A shard without entries any more is removed
+        self.backend.tags.pop(self.files[1])
+        self._save()
+        self.assertFalse(os.path.exists(self._shard_path(self.files[1])))
+
+        # And all of them, saving a single file again
+        save_manifest(self.node, self.manifest_path, use_cache=False)
+        self.assertFalse(os.path.exists(os.path.dirname(self._shard_path(self.node))))
+
+    def test_dump_skips_the_applied_shards(self):
+        """Test that a dump only applies the shards changed since the last
+        time."""
+        self._save()
+        applied_path = applied_shards_path(self.node, self.manifest_path)
+        self.assertEqual(os.path.dirname(applied_path), os.environ[STATE_DIR_ENV_VAR])
+        shutil.copy(applied_path, f"{applied_path}.old")
+
+        # Other machine adds a tag to the first file
+        self.backend.apply_many([TagChange(self.files[0], add=["Green"])])
+        self._save()
+        os.replace(f"{applied_path}.old", applied_path)
+
+        # The tags changed by hand in the second shard are kept
+        self.backend.tags = {self.files[1]: ["Changed"]}
+        errors = dump_manifest(self.manifest_path, self.node, force_overwriting=None)
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            self.backend.tags,
+            {self.files[0]: ["Red", "Green"], self.files[1]: ["Changed"]},
+        )
+
+        # Nothing is pending now, unless the node is fully overwritten
+        self.backend.tags = {}
+        dump_manifest(self.manifest_path, self.node, force_overwriting=None)
+        self.assertEqual(self.backend.tags, {})
+        dump_manifest(self.manifest_path, self.node, force_overwriting=True)
+        self.assertEqual(
+            self.backend.tags,
+            {self.files[0]: ["Red", "Green"], self.files[1]: ["Blue"]},
+        )
+
+    def test_soft_dump_does_not_skip_a_normal_one(self):
+        """Test that the shards applied by a soft dump are applied again by a
+        normal one."""
+        self._save()
+        self.backend.apply_many([TagChange(self.files[0], add=["Green"])])
+        applied_path = applied_shards_path(self.node, self.manifest_path)
+        with ManifestReader(self.manifest_path, self.node) as reader:
+            checksums = reader.shards
+        rules = WalkRules.load(self.node).key
+        with mock.patch("platform.node", return_value="other-machine"):
+            dump_manifest(self.manifest_path, self.node)
+            self.assertEqual(self.backend.tags[self.files[0]], ["Red", "Green"])
+            applied = AppliedShards.load(applied_path, self.node)
+            self.assertEqual(
+                applied.pending(checksums, _SHARDS, SOFT_DUMP, rules), set()
+            )
+            self.assertEqual(
+                applied.pending(checksums, _SHARDS, DUMP, rules), set(checksums)
+            )
+
+            # The tags of the foreign manifest are removed by the normal one
+            dump_manifest(self.manifest_path, self.node, force_overwriting=None)
+            self.assertEqual(self.backend.tags[self.files[0]], ["Red"])
+            applied = AppliedShards.load(applied_path, self.node)
+            self.assertEqual(applied.pending(checksums, _SHARDS, DUMP, rules), set())
+
+    def test_damaged_shards_are_corrupted(self):
+        """Test that a changed or missing shard is detected."""
+        self._save()
+        shard_path = self._shard_path(self.files[0])
+        with open(shard_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(shard_path, "w", encoding="utf-8") as f:
+            f.write(text.replace("Red", "Pink"))
+        with self.assertRaises(CorruptedManifestFileError):
+            load_manifest(self.manifest_path, self.node)
+
+        os.remove(shard_path)
+        with self.assertRaises(CorruptedManifestFileError):
+            load_manifest(self.manifest_path, self.node)
+
+
+if __name__ == "__main__":
+    unittest.main()
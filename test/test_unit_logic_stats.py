@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the instrumentation"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends, logic_stats
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_stats import Stats
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+
+class UnitTestSuiteLogicStats(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.addCleanup(logic_stats.set_stats, logic_stats.get_stats())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        patcher = mock.patch.dict(os.environ, {STATE_DIR_ENV_VAR: state_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_save_and_dump_are_instrumented(self):
+        """Test the phases and counters of a save and a dump."""
+        with tempfile.TemporaryDirectory() as sample_node:
+            paths = [os.path.join(sample_node, f"file{i}.txt") for i in range(3)]
+            for path in paths:
+                open(path, "a").close()
+            self.backend.apply_many([TagChange(paths[0], add=["Red", "Blue"])])
+            manifest_path = os.path.join(sample_node, MANIFEST_FILE_NAME)
+
+            stats = logic_stats.set_stats(Stats())
+            save_manifest(sample_node, manifest_path, use_cache=False)
+            data = stats.summary()
+            phases = {"walk", "stat", "read_tags", "write_manifest"}
+            self.assertTrue(phases.issubset(data["phases"]))
+            self.assertEqual(data["counters"]["paths_walked"], 4)
+            self.assertEqual(data["counters"]["tags_read"], 2)
+            self.assertEqual(
+                data["counters"]["manifest_bytes_written"],
+                os.path.getsize(manifest_path),
+            )
+            self.assertEqual(sum(data["histograms"]["backend.get_many"].values()), 1)
+
+            self.backend.tags = {paths[1]: ["Green"]}
+            stats = logic_stats.set_stats(Stats())
+            dump_manifest(manifest_path, sample_node, force_overwriting=True)
+            data = stats.summary()
+            self.assertTrue({"load_manifest", "apply_tags"}.issubset(data["phases"]))
+            self.assertEqual(data["counters"]["paths_changed"], 2)
+            self.assertEqual(data["counters"]["tags_added"], 2)
+            self.assertEqual(data["counters"]["tags_removed"], 1)
+            self.assertEqual(
+                data["counters"]["manifest_bytes_read"],
+                os.path.getsize(manifest_path),
+            )
+
+    def test_hooks_receive_events(self):
+        """Test that the hooks receive every event and the summary."""
+        events = []
+        stats = Stats()
+        stats.add_hook(events.append)
+        logic_stats.set_stats(stats)
+
+        with logic_stats.phase("phase"):
+            logic_stats.count("counter", 2)
+        self.assertEqual(list(logic_stats.timed_iter("walk", [1, 2])), [1, 2])
+        logic_stats.observe("call", 0.003)
+        data = stats.summary()
+
+        self.assertEqual(
+            [(e["event"], e.get("name")) for e in events],
+            [
+                ("phase", "phase"),
+                ("phase", "walk"),
+                ("call", "call"),
+                ("summary", None),
+            ],
+        )
+        self.assertEqual(data["counters"], {"counter": 2})
+        self.assertEqual(data["histograms"]["call"]["5"], 1)
+
+    def test_disabled_instrumentation(self):
+        """Test that nothing is collected without a collector."""
+        logic_stats.set_stats(None)
+        with logic_stats.phase("phase"):
+            logic_stats.count("counter")
+        self.assertEqual(list(logic_stats.timed_iter("walk", [1, 2])), [1, 2])
+        self.assertEqual(logic_stats.timed_call("call", len, [1, 2]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the subpath filters"""
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends, logic_stats
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_layer import dump_manifest, save_manifest
+from finder_tags_butler.logic_manifest import (
+    ManifestWriter,
+    TagAssociation,
+    load_manifest,
+)
+from finder_tags_butler.logic_stats import Stats
+from finder_tags_butler.logic_subpaths import SubpathFilter
+from finder_tags_butler.properties import MANIFEST_FILE_NAME, STATE_DIR_ENV_VAR
+
+_ROOT = "/node"
+
+
+class UnitTestSuiteLogicSubpaths(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.addCleanup(logic_stats.set_stats, logic_stats.get_stats())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.dict(
+            os.environ, {STATE_DIR_ENV_VAR: os.path.join(self.tmp_dir.name, ".state")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write_manifest(self, name: str, **options) -> (str, list):
+        """Write a manifest of many entries under '_ROOT'."""
+        entries = sorted(
+            TagAssociation(os.path.join(_ROOT, top, sub, f"{i}.txt"), [top])
+            for top in ("Archive", "Music", "Projects", "Projects.old")
+            for sub in ("docs", "ftb", "src")
+            for i in range(1000)
+        )
+        path = os.path.join(self.tmp_dir.name, name)
+        with ManifestWriter(path, root=_ROOT, **options) as writer:
+            for entry in entries:
+                writer.write(entry)
+        return path, entries
+
+    def test_filter(self):
+        """Test the paths selected by several patterns."""
+        only = SubpathFilter(_ROOT, ["Projects/ftb", "Projects/*/docs", "Mus?c"])
+
+        self.assertEqual(only.prefixes, ["Mus", "Projects/"])
+        self.assertEqual(only.subtrees, [_ROOT])
+        only = SubpathFilter(_ROOT, ["Projects/*/docs", "Projects/ftb", "Music"])
+        self.assertEqual(
+            only.subtrees,
+            [os.path.join(_ROOT, "Music"), os.path.join(_ROOT, "Projects")],
+        )
+        for path, expected in (
+            ("Projects/ftb", True),
+            ("Projects/ftb/a.txt", True),
+            ("Projects/ftb2/a.txt", False),
+            ("Projects/web/docs/a.txt", True),
+            ("Projects/web/src/a.txt", False),
+            ("Music/a.mp3", True),
+            ("Archive", False),
+        ):
+            self.assertEqual(only.matches(os.path.join(_ROOT, path)), expected, path)
+        self.assertTrue(only.may_contain(os.path.join(_ROOT, "Projects", "web")))
+        self.assertFalse(only.may_contain(os.path.join(_ROOT, "Archive")))
+
+        with self.assertRaises(ValueError):
+            SubpathFilter(_ROOT, ["/Projects"])
+        with self.assertRaises(ValueError):
+            SubpathFilter(_ROOT, ["Projects/../.."])
+
+    def test_partial_reads(self):
+        """Test that only the matching entries are read, in every format."""
+        patterns = ["Projects/ftb", "Archive/d*s"]
+        only = SubpathFilter(_ROOT, patterns)
+        for name, options in (
+            ("stream", {}),
+            ("binary", {"manifest_format": "binary"}),
+            ("sharded", {"shards": 4}),
+        ):
+            path, entries = self._write_manifest(name, **options)
+            expected = [(e.path, e.tags) for e in entries if only.matches(e.path)]
+            self.assertEqual(len(expected), 2000)
+
+            stats = logic_stats.set_stats(Stats())
+            manifest = load_manifest(path, root=_ROOT, only=only)
+            self.assertEqual([(e.path, e.tags) for e in manifest.content], expected)
+            if name == "stream":
+                # The rest of the file is skipped
+                read = stats.counters["manifest_bytes_read"]
+                self.assertLess(read, os.path.getsize(path) / 3)
+
+    def test_partial_dump(self):
+        """Test that a limited dump only walks and changes the selected
+        subtrees."""
+        node = os.path.join(self.tmp_dir.name, "node")
+        manifest_path = os.path.join(node, MANIFEST_FILE_NAME)
+        paths = {}
+        for name in ("a/x/1.txt", "a/y/2.txt", "b/3.txt", "c/4.txt"):
+            paths[name] = os.path.join(node, name)
+            os.makedirs(os.path.dirname(paths[name]), exist_ok=True)
+            open(paths[name], "a").close()
+            self.backend.apply_many([TagChange(paths[name], add=["Red"])])
+        save_manifest(node, manifest_path)
+
+        self.backend.tags = {paths["b/3.txt"]: ["Blue"]}
+        mock.patch("platform.node", return_value="other").start()
+        self.addCleanup(mock.patch.stopall)
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            errors = dump_manifest(
+                manifest_path, node, force_overwriting=None, only=["a/*", "b"]
+            )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            self.backend.tags,
+            {paths[p]: ["Red"] for p in ("a/x/1.txt", "a/y/2.txt", "b/3.txt")},
+        )
+        scanned = {c.args[0] for c in scandir.call_args_list}
+        self.assertNotIn(node, scanned)
+        self.assertNotIn(os.path.join(node, "c"), scanned)
+
+        # The limited dump is not recorded as a full one
+        dump_manifest(manifest_path, node)
+        self.assertEqual(self.backend.tags[paths["c/4.txt"]], ["Red"])
+
+
+if __name__ == "__main__":
+    unittest.main()
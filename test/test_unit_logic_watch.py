@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for the watch mode"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange, XattrBackend
+from finder_tags_butler.logic_identity import IdentityIndex
+from finder_tags_butler.logic_manifest import load_manifest
+from finder_tags_butler.logic_watch import (
+    EventSource,
+    InotifyEventSource,
+    ManifestWatcher,
+    PollingEventSource,
+)
+from finder_tags_butler.properties import (
+    IDENTITY_INDEX_FILE_NAME,
+    MANIFEST_FILE_NAME,
+    STATE_DIR_ENV_VAR,
+)
+
+
+class _QueueEventSource(EventSource):
+    """Event source that returns the queued events."""
+
+    def __init__(self):
+        self.queue = []
+
+    def read(self, timeout):
+        return self.queue.pop(0) if self.queue else {}
+
+
+class UnitTestSuiteLogicWatch(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.node = self.tmp_dir.name
+        self.manifest_path = os.path.join(self.node, MANIFEST_FILE_NAME)
+        os.mkdir(os.path.join(self.node, "dir"))
+        self.paths = [
+            os.path.join(self.node, "a.txt"),
+            os.path.join(self.node, "dir", "b.txt"),
+        ]
+        for path in self.paths:
+            open(path, "a").close()
+
+    def _saved_entries(self) -> dict:
+        manifest = load_manifest(self.manifest_path, root=self.node)
+        return {e.path: e.tags for e in manifest.content}
+
+    def test_only_changed_paths_are_updated(self):
+        """Test that the events update the affected entries and are written
+        after the debounce."""
+        backend = logic_backends.set_backend(MemoryBackend())
+        backend.apply_many([TagChange(self.paths[1], add=["Old"])])
+        events = _QueueEventSource()
+        watcher = ManifestWatcher(
+            self.node, self.manifest_path, events, debounce=0, flush_interval=0
+        )
+        watcher.start()
+        self.assertEqual(self._saved_entries(), {self.paths[1]: ["Old"]})
+
+        backend.apply_many([TagChange(self.paths[0], add=["New"])])
+        events.queue.append({self.paths[0]: False})
+        watcher.process(0)
+        self.assertEqual(
+            self._saved_entries(), {self.paths[0]: ["New"], self.paths[1]: ["Old"]}
+        )
+
+        # Removing a directory removes the entries of its children
+        shutil.rmtree(os.path.join(self.node, "dir"))
+        events.queue.append({os.path.join(self.node, "dir"): False})
+        watcher.process(0)
+        self.assertEqual(self._saved_entries(), {self.paths[0]: ["New"]})
+        watcher.close()
+
+    def test_bursts_are_debounced(self):
+        """Test that nothing is read or written while the events keep coming."""
+        backend = logic_backends.set_backend(MemoryBackend())
+        events = _QueueEventSource()
+        watcher = ManifestWatcher(
+            self.node, self.manifest_path, events, debounce=60, flush_interval=60
+        )
+        watcher.start()
+
+        backend.apply_many([TagChange(self.paths[0], add=["New"])])
+        events.queue.append({self.paths[0]: False})
+        watcher.process(0)
+        self.assertEqual(watcher.entries, {})
+
+        # Closing applies and writes the pending events
+        watcher.close()
+        self.assertEqual(self._saved_entries(), {self.paths[0]: ["New"]})
+
+    def test_rescan_drops_removed_paths(self):
+        """Test that reading a subtree again drops the entries of its paths
+        removed while the events were lost."""
+        backend = logic_backends.set_backend(MemoryBackend())
+        backend.apply_many([TagChange(p, add=["Old"]) for p in self.paths])
+        events = _QueueEventSource()
+        watcher = ManifestWatcher(
+            self.node, self.manifest_path, events, debounce=0, flush_interval=0
+        )
+        watcher.start()
+
+        # The queue overflows, so only the node is told to be read again
+        os.remove(self.paths[1])
+        events.queue.append({self.node: True})
+        watcher.process(0)
+        self.assertEqual(watcher.entries, {self.paths[0]: ["Old"]})
+        self.assertEqual(self._saved_entries(), {self.paths[0]: ["Old"]})
+        watcher.close()
+
+    def test_identity_index_is_kept(self):
+        """Test that the identity index is written with the manifest."""
+        state_dir = os.path.join(self.node, ".state")
+        with mock.patch.dict(os.environ, {STATE_DIR_ENV_VAR: state_dir}):
+            backend = logic_backends.set_backend(MemoryBackend())
+            backend.apply_many([TagChange(self.paths[1], add=["Old"])])
+            events = _QueueEventSource()
+            watcher = ManifestWatcher(
+                self.node,
+                self.manifest_path,
+                events,
+                debounce=0,
+                flush_interval=0,
+                identity=True,
+            )
+            watcher.start()
+            index_path = os.path.join(self.node, IDENTITY_INDEX_FILE_NAME)
+            index = IdentityIndex.load(index_path, self.node)
+            self.assertEqual(list(index.entries), [self.paths[1]])
+
+            backend.apply_many([TagChange(self.paths[0], add=["New"])])
+            events.queue.append({self.paths[0]: False})
+            watcher.process(0)
+            index = IdentityIndex.load(index_path, self.node)
+            self.assertEqual(sorted(index.entries), self.paths)
+            watcher.close()
+
+    def _check_event_source(self, events):
+        logic_backends.set_backend(XattrBackend())
+        watcher = ManifestWatcher(
+            self.node, self.manifest_path, events, debounce=0, flush_interval=0
+        )
+        watcher.start()
+        self.addCleanup(watcher.close)
+
+        # Tag a present file and a file of a new directory
+        logic_backends.get_backend().apply_many([TagChange(self.paths[0], add=["Red"])])
+        new_path = os.path.join(self.node, "new", "c.txt")
+        os.mkdir(os.path.dirname(new_path))
+        open(new_path, "a").close()
+        logic_backends.get_backend().apply_many([TagChange(new_path, add=["Blue"])])
+
+        expected = {self.paths[0]: ["Red"], new_path: ["Blue"]}
+        for _ in range(50):
+            watcher.process(0.1)
+            if not watcher.dirty and self._saved_entries() == expected:
+                break
+        self.assertEqual(self._saved_entries(), expected)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "Needs inotify")
+    def test_inotify_events(self):
+        """Test the watch mode with inotify events."""
+        self._check_event_source(InotifyEventSource(self.node))
+
+    @unittest.skipUnless(hasattr(os, "setxattr"), "Needs extended attributes")
+    def test_polling_events(self):
+        """Test the watch mode with the polling fallback."""
+        self._check_event_source(PollingEventSource(self.node, interval=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
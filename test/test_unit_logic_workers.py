@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+###########################################################
+# Finder Tags Butler
+#
+# Synchronize Mac OS Finder tags between several machines
+#
+# Copyright 2020 Borja González Seoane
+#
+# Contact: garaje@glezseoane.es
+###########################################################
+
+"""Finder Tags Butler test suite: unit tests for worker pools"""
+
+import os
+import stat
+import tempfile
+import unittest
+from unittest import TestCase
+
+from finder_tags_butler import logic_backends
+from finder_tags_butler.logic_backends import MemoryBackend, TagChange
+from finder_tags_butler.logic_walk import get_children_of_path, get_tags
+from finder_tags_butler.logic_workers import WorkerPool, stat_paths
+
+
+class UnitTestSuiteLogicWorkers(TestCase):
+    def setUp(self):
+        self.addCleanup(logic_backends.set_backend, logic_backends.get_backend())
+        self.backend = logic_backends.set_backend(MemoryBackend())
+
+    def _make_tree(self, root: str) -> None:
+        for i in range(4):
+            subdir = os.path.join(root, f"dir{i}")
+            os.makedirs(os.path.join(subdir, "nested", ".hidden"))
+            for j in range(30):
+                open(os.path.join(subdir, "nested", f"file{j}"), "a").close()
+            open(os.path.join(subdir, f"dir{i}-file"), "a").close()
+        open(os.path.join(root, ".hidden-file"), "a").close()
+
+    def test_concurrent_walk_is_deterministic(self):
+        """Test that the concurrent walk returns the sequential result."""
+        with tempfile.TemporaryDirectory() as sample_node:
+            self._make_tree(sample_node)
+            expected = get_children_of_path(sample_node)
+            self.assertEqual(len(expected), 1 + 4 * 33)
+            self.assertEqual(expected, sorted(expected))
+            with WorkerPool(4) as workers:
+                self.assertEqual(get_children_of_path(sample_node, workers), expected)
+
+    def test_concurrent_tags_reading(self):
+        """Test that the tags read concurrently are the sequential ones."""
+        with tempfile.TemporaryDirectory() as sample_node:
+            self._make_tree(sample_node)
+            children = get_children_of_path(sample_node)
+            self.backend.apply_many(
+                [TagChange(c, add=[f"Tag {i % 7}"]) for i, c in enumerate(children)]
+            )
+            with WorkerPool(4) as workers:
+                self.assertEqual(get_tags(children, workers), get_tags(children))
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "Needs symbolic links")
+    def test_stat_does_not_follow_symlinks(self):
+        """Test that the links are stat themselves, also the broken ones."""
+        with tempfile.TemporaryDirectory() as sample_node:
+            target = os.path.join(sample_node, "target")
+            open(target, "a").close()
+            links = [os.path.join(sample_node, n) for n in ("link", "broken")]
+            os.symlink(target, links[0])
+            os.symlink(os.path.join(sample_node, "missing"), links[1])
+            stats = stat_paths(links)
+            with WorkerPool(2) as workers:
+                self.assertEqual(workers.stat_many(links), stats)
+        self.assertEqual(list(stats), links)
+        self.assertTrue(all(stat.S_ISLNK(st.st_mode) for st in stats.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()